@@ -0,0 +1,392 @@
+@256
+D=A
+@SP
+M=D
+@0
+D=A
+@SP
+A=M
+M=D
+@SP
+M=M+1
+@42
+D=A
+@SP
+A=M
+M=D
+@SP
+M=M+1
+@SP
+AM=M-1
+D=M
+A=A-1
+@..BOOT..:0
+D;JEQ
+@SP
+A=M-1
+D=M
+@..BOOT..:0
+D;JEQ
+D=-1
+(..BOOT..:0)
+@SP
+A=M-1
+M=D
+@42
+D=A
+@SP
+A=M
+M=D
+@SP
+M=M+1
+@42
+D=A
+@SP
+A=M
+M=D
+@SP
+M=M+1
+@SP
+AM=M-1
+D=M
+A=A-1
+@..BOOT..:1
+D;JEQ
+@SP
+A=M-1
+D=M
+@..BOOT..:1
+D;JEQ
+D=-1
+(..BOOT..:1)
+@SP
+A=M-1
+M=D
+@0
+D=A
+@SP
+A=M
+M=D
+@SP
+M=M+1
+@0
+D=A
+@SP
+A=M
+M=D
+@SP
+M=M+1
+@SP
+AM=M-1
+D=M
+A=A-1
+@..BOOT..:2
+D;JEQ
+@SP
+A=M-1
+D=M
+@..BOOT..:2
+D;JEQ
+D=-1
+(..BOOT..:2)
+@SP
+A=M-1
+M=D
+@42
+D=A
+@SP
+A=M
+M=D
+@SP
+M=M+1
+@0
+D=A
+@SP
+A=M
+M=D
+@SP
+M=M+1
+@SP
+AM=M-1
+D=M
+A=A-1
+@..BOOT..:3
+D;JEQ
+@SP
+A=M-1
+D=M
+@..BOOT..:3
+D;JEQ
+D=-1
+(..BOOT..:3)
+@SP
+A=M-1
+M=D
+@0
+D=A
+@SP
+A=M
+M=D
+@SP
+M=M+1
+@42
+D=A
+@SP
+A=M
+M=D
+@SP
+M=M+1
+@SP
+AM=M-1
+D=M
+A=A-1
+D=D|M
+M=-1
+@..BOOT..:4
+D;JNE
+@SP
+A=M-1
+M=0
+(..BOOT..:4)
+@42
+D=A
+@SP
+A=M
+M=D
+@SP
+M=M+1
+@42
+D=A
+@SP
+A=M
+M=D
+@SP
+M=M+1
+@SP
+AM=M-1
+D=M
+A=A-1
+D=D|M
+M=-1
+@..BOOT..:5
+D;JNE
+@SP
+A=M-1
+M=0
+(..BOOT..:5)
+@0
+D=A
+@SP
+A=M
+M=D
+@SP
+M=M+1
+@0
+D=A
+@SP
+A=M
+M=D
+@SP
+M=M+1
+@SP
+AM=M-1
+D=M
+A=A-1
+D=D|M
+M=-1
+@..BOOT..:6
+D;JNE
+@SP
+A=M-1
+M=0
+(..BOOT..:6)
+@42
+D=A
+@SP
+A=M
+M=D
+@SP
+M=M+1
+@0
+D=A
+@SP
+A=M
+M=D
+@SP
+M=M+1
+@SP
+AM=M-1
+D=M
+A=A-1
+D=D|M
+M=-1
+@..BOOT..:7
+D;JNE
+@SP
+A=M-1
+M=0
+(..BOOT..:7)
+@0
+D=A
+@SP
+A=M
+M=D
+@SP
+M=M+1
+@42
+D=A
+@SP
+A=M
+M=D
+@SP
+M=M+1
+@SP
+AM=M-1
+D=M
+A=A-1
+@..BOOT..:9
+D;JEQ
+@SP
+A=M-1
+D=M
+M=-1
+@..BOOT..:8
+D;JEQ
+@SP
+A=M-1
+M=0
+@..BOOT..:8
+0;JMP
+(..BOOT..:9)
+@SP
+A=M-1
+D=M
+@..BOOT..:8
+D;JEQ
+@SP
+A=M-1
+M=-1
+(..BOOT..:8)
+@42
+D=A
+@SP
+A=M
+M=D
+@SP
+M=M+1
+@42
+D=A
+@SP
+A=M
+M=D
+@SP
+M=M+1
+@SP
+AM=M-1
+D=M
+A=A-1
+@..BOOT..:11
+D;JEQ
+@SP
+A=M-1
+D=M
+M=-1
+@..BOOT..:10
+D;JEQ
+@SP
+A=M-1
+M=0
+@..BOOT..:10
+0;JMP
+(..BOOT..:11)
+@SP
+A=M-1
+D=M
+@..BOOT..:10
+D;JEQ
+@SP
+A=M-1
+M=-1
+(..BOOT..:10)
+@0
+D=A
+@SP
+A=M
+M=D
+@SP
+M=M+1
+@0
+D=A
+@SP
+A=M
+M=D
+@SP
+M=M+1
+@SP
+AM=M-1
+D=M
+A=A-1
+@..BOOT..:13
+D;JEQ
+@SP
+A=M-1
+D=M
+M=-1
+@..BOOT..:12
+D;JEQ
+@SP
+A=M-1
+M=0
+@..BOOT..:12
+0;JMP
+(..BOOT..:13)
+@SP
+A=M-1
+D=M
+@..BOOT..:12
+D;JEQ
+@SP
+A=M-1
+M=-1
+(..BOOT..:12)
+@42
+D=A
+@SP
+A=M
+M=D
+@SP
+M=M+1
+@0
+D=A
+@SP
+A=M
+M=D
+@SP
+M=M+1
+@SP
+AM=M-1
+D=M
+A=A-1
+@..BOOT..:15
+D;JEQ
+@SP
+A=M-1
+D=M
+M=-1
+@..BOOT..:14
+D;JEQ
+@SP
+A=M-1
+M=0
+@..BOOT..:14
+0;JMP
+(..BOOT..:15)
+@SP
+A=M-1
+D=M
+@..BOOT..:14
+D;JEQ
+@SP
+A=M-1
+M=-1
+(..BOOT..:14)
@@ -0,0 +1,26 @@
+@256
+D=A
+@SP
+M=D
+@42
+D=A
+@SP
+A=M
+M=D
+@SP
+M=M+1
+@SP
+A=M
+A=A-1
+D=M
+@SP
+M=M-1
+@3003
+M=D
+@0
+D=M
+@SP
+A=M
+M=D
+@SP
+M=M+1
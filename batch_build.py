@@ -0,0 +1,272 @@
+"""
+The batch_build module translates many VM programs in one run, spreading them over a pool of worker processes.
+
+Programs are given as names under vm_input, as paths of .vm files or directories, or in a manifest file (one program
+per line, with # comments). They are scheduled largest first, so one big program started last doesn't hold up the
+whole batch. Each worker keeps a BuildCache of the files it has already parsed and translated, keyed by their contents,
+so files that are the same in many programs (like the usual Sys.vm) are only parsed and translated once per worker.
+
+After the batch, a summary lists the time, size, and number of errors of every program.
+
+Usage:
+    python batch_build.py [program ...] [--manifest FILE] [--workers N] [--optimize {speed,size}] [--json FILE]
+
+With no programs and no manifest, every program under vm_input is built.
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import config
+import main
+from code_writer_module import CodeWriter
+from error_checker import lint_vm_file
+from static_layout import overflow_message
+
+
+class BuildCache:
+    """
+    The BuildCache class remembers the parsed commands, the errors, and (where it is safe) the translated .asm code of
+    every .vm file built so far, keyed by a hash of the file's contents.
+
+    A translation is only reused when it cannot depend on the rest of the program: the file must start with a function
+    (so it doesn't continue the previous file's function), the code must not be optimized for size or with a profile
+    and must not share call stubs (shared routines and hot functions depend on the other files), and no source map may
+    be recorded. Its statics are named after the file, and may have addresses planned for the whole program, so the
+    file name and those addresses are part of the key; so are the frames planned for the functions it defines and
+    calls, which its calls and returns depend on. A shared routine (like __VM_MULT) is written in place by its first
+    use and jumped to after that, so the routines already written when the file starts are part of the key too, and a
+    reused translation adds the routines it writes to the code_writer's, as writing it would have.
+
+    Methods:
+        __init__: Constructs an empty cache.
+        parse: Returns the content hash, parsed commands, and errors of a .vm file.
+        write_file: Writes the translation of a parsed .vm file with a code_writer, reusing a cached translation if
+            possible.
+    """
+
+    def __init__(self):
+        """Construct an empty cache."""
+        self.parsed = {}        # The (commands, errors) of each file, by content hash.
+        # The (asm text, number of instructions, last function, SP offset at the end, shared routines written, prologues
+        # written) by (hash, file, optimization, static addresses, frames, shared routines already written).
+        self.translated = {}
+        self.parse_hits = 0
+        self.translation_hits = 0
+
+    def parse(self, vm_file):
+        """Return the (content hash, list of VMCommand records, list of (line, message) errors) of a .vm file."""
+        with open(vm_file, 'rb') as file:
+            digest = hashlib.sha1(file.read()).hexdigest()
+
+        if digest in self.parsed:
+            self.parse_hits += 1
+        else:
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.parsed[digest] = (main.parse_vm_file(vm_file), lint_vm_file(vm_file))
+        return (digest,) + self.parsed[digest]
+
+    def write_file(self, code_writer, digest, commands):
+        """
+        Write the translation of a .vm file with the given code_writer, which has already been told the file name.
+
+        Arguments:
+            code_writer: The code_writer to write the translation with.
+            digest: The content hash of the file, from parse().
+            commands: The list of VMCommand records of the file, from parse().
+        """
+        static_addresses = tuple(sorted(address for (file_name, _), address in code_writer.static_addresses.items()
+                                        if file_name == code_writer.current_input_file))
+        frames = tuple(sorted((name, tuple(code_writer.frame_of(name)))
+                              for name in {command.arg1 for command in commands
+                                           if command.type in ['C_FUNCTION', 'C_CALL']}))
+        shared_routines = frozenset(code_writer.shared_routines)
+        key = (digest, code_writer.current_input_file, code_writer.optimize_for, static_addresses, frames,
+               shared_routines)
+
+        if key in self.translated:
+            text, num_instructions, last_function, sp_offset, routines, prologues = self.translated[key]
+            code_writer.write_block(text, text.split('\n'), num_instructions)
+            code_writer.current_function, code_writer.sp_offset = last_function, sp_offset
+            code_writer.shared_routines |= routines
+            code_writer.prologues += prologues
+            self.translation_hits += 1
+            return
+
+        if config.WRITE_SOURCE_MAP or config.SHARE_CALL_STUBS or code_writer.optimize_for == 'size' or \
+                code_writer.hot_functions is not None or not commands or commands[0].type != 'C_FUNCTION':
+            main.write_commands(code_writer, commands)
+            return
+
+        # Record the file's translation as it is written.
+        output_file, first_instruction = code_writer.output_file, code_writer.instruction_index
+        first_prologue = len(code_writer.prologues)
+        code_writer.output_file = io.StringIO()
+        try:
+            main.write_commands(code_writer, commands)
+        finally:
+            text = code_writer.output_file.getvalue()
+            code_writer.output_file = output_file
+        if output_file is not None:
+            output_file.write(text)
+
+        self.translated[key] = (text[:-1], code_writer.instruction_index - first_instruction,
+                                code_writer.current_function, code_writer.sp_offset,
+                                frozenset(code_writer.shared_routines) - shared_routines,
+                                code_writer.prologues[first_prologue:])
+
+
+# The cache of the current worker process.
+BUILD_CACHE = BuildCache()
+
+
+def resolve_program(program):
+    """
+    Return the (name, input path, .vm files, output path) of a program given as a name under vm_input, or as the path
+    of a .vm file or directory. The .asm file goes in asm_output, like with main.py.
+    """
+    path = program if os.path.exists(program) else os.path.join(main.PROGRAM_DIR, 'vm_input', program)
+    if not os.path.exists(path) and os.path.exists(path + '.vm'):
+        path += '.vm'
+
+    name = os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+    return name, path, main.find_vm_files(path), os.path.join(main.PROGRAM_DIR, 'asm_output', name + '.asm')
+
+
+def read_manifest(manifest_file):
+    """Return the programs listed in a manifest file: one per line, ignoring blank lines and # comments."""
+    with open(manifest_file, 'r') as file:
+        lines = [line.split('#', 1)[0].strip() for line in file]
+    return [line for line in lines if line]
+
+
+def build_program(program, settings):
+    """
+    Translate one program in this worker process, using its BuildCache. Return a summary dictionary of the build.
+
+    Arguments:
+        program: The program, as given to resolve_program().
+        settings: A dictionary of config values to translate with.
+    """
+    for name, value in settings.items():
+        setattr(config, name, value)
+
+    name, input_path, vm_files, output_path = resolve_program(program)
+    parse_hits, translation_hits = BUILD_CACHE.parse_hits, BUILD_CACHE.translation_hits
+    start = time.perf_counter()
+
+    code_writer = CodeWriter(output_path, input_path)
+    errors = []
+    parsed_files = [(vm_file,) + BUILD_CACHE.parse(vm_file) for vm_file in vm_files]
+    for vm_file, _, _, file_errors in parsed_files:
+        errors += [(os.path.basename(vm_file), line, message) for line, message in file_errors]
+
+    # Write the program just like main.py does, reusing the cached translation of each file where possible.
+    digests = {vm_file: digest for vm_file, digest, _, _ in parsed_files}
+    _, overflows = main.write_program(
+        code_writer, [(vm_file, commands) for vm_file, _, commands, _ in parsed_files],
+        lambda writer, vm_file, commands: BUILD_CACHE.write_file(writer, digests[vm_file], commands))
+    errors += [(file_name + '.vm', line, overflow_message(file_name, index)) for file_name, index, line in overflows]
+
+    return {
+        'program': name,
+        'output': output_path,
+        'files': len(vm_files),
+        'seconds': time.perf_counter() - start,
+        'rom_words': code_writer.instruction_index,
+        'errors': errors,
+        'cached_parses': BUILD_CACHE.parse_hits - parse_hits,
+        'cached_translations': BUILD_CACHE.translation_hits - translation_hits,
+        'worker': os.getpid(),
+    }
+
+
+def program_size(program):
+    """Return the total size in bytes of a program's .vm files, used to schedule the largest programs first."""
+    return sum(os.path.getsize(vm_file) for vm_file in resolve_program(program)[2])
+
+
+def build_programs(programs, settings=None, workers=None):
+    """
+    Translate many programs over a pool of worker processes, largest first. Return the summaries of the builds, in
+    the order the programs were given.
+
+    Arguments:
+        programs: The programs, as given to resolve_program().
+        settings: A dictionary of config values to translate with.
+        workers: The number of worker processes (by default, one per CPU). With 1, the programs are built in this
+            process.
+    """
+    settings = dict(settings or {}, WRITE_ERRORS_TO_LOG=False, PRINT_ERRORS_TO_CONSOLE=False)
+    order = sorted(range(len(programs)), key=lambda program_idx: -program_size(programs[program_idx]))
+    summaries = [None] * len(programs)
+
+    if workers == 1:
+        saved = {name: getattr(config, name) for name in settings}
+        try:
+            for program_idx in order:
+                summaries[program_idx] = build_program(programs[program_idx], settings)
+        finally:
+            for name, value in saved.items():
+                setattr(config, name, value)
+        return summaries
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(build_program, programs[program_idx], settings): program_idx
+                   for program_idx in order}
+        for future in as_completed(futures):
+            summaries[futures[future]] = future.result()
+    return summaries
+
+
+def format_summary(summaries, wall_seconds):
+    """Return a text table of the builds, with a line of totals."""
+    out = [f"{'program':<24} {'files':>5} {'cached':>7} {'ms':>8} {'ROM words':>10} {'errors':>6}"]
+    for summary in summaries:
+        out.append(f"{summary['program']:<24} {summary['files']:>5} "
+                   f"{summary['cached_parses']:>3}/{summary['cached_translations']:<3} "
+                   f"{1000 * summary['seconds']:>8.1f} {summary['rom_words']:>10} {len(summary['errors']):>6}")
+    out.append(f"{len(summaries)} programs, {sum(len(summary['errors']) for summary in summaries)} errors, "
+               f"{1000 * sum(summary['seconds'] for summary in summaries):.1f} ms of builds in "
+               f"{1000 * wall_seconds:.1f} ms on {len(set(summary['worker'] for summary in summaries))} workers.")
+    out.append("(cached: files whose parse / translation was reused from another program in the same worker)")
+    return '\n'.join(out)
+
+
+# ************************************************************************************************
+# Program begins here:
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Translate many VM programs at once.')
+    arg_parser.add_argument('programs', nargs='*', help='Programs: names under vm_input, or .vm files or directories.')
+    arg_parser.add_argument('--manifest', help='A file listing more programs, one per line.')
+    arg_parser.add_argument('--workers', type=int, help='The number of worker processes (default: one per CPU).')
+    arg_parser.add_argument('--optimize', choices=['speed', 'size'], help='Use the speed or size templates throughout.')
+    arg_parser.add_argument('--errors', action='store_true', help='Also list every error found.')
+    arg_parser.add_argument('--json', help='Also write the summaries to this JSON file.')
+    args = arg_parser.parse_args()
+
+    batch = list(args.programs)
+    if args.manifest:
+        batch += read_manifest(args.manifest)
+    if not batch:
+        input_dir = os.path.join(main.PROGRAM_DIR, 'vm_input')
+        batch = sorted(entry[:-len('.vm')] if entry.endswith('.vm') else entry for entry in os.listdir(input_dir)
+                       if entry.endswith('.vm') or os.path.isdir(os.path.join(input_dir, entry)))
+
+    batch_start = time.perf_counter()
+    batch_summaries = build_programs(batch, {'OPTIMIZATION': args.optimize}, args.workers)
+    print(format_summary(batch_summaries, time.perf_counter() - batch_start))
+
+    if args.errors:
+        for batch_summary in batch_summaries:
+            for vm_file, error_line, error_message in batch_summary['errors']:
+                print(f"{batch_summary['program']}/{vm_file}:{error_line}: {error_message}")
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(batch_summaries, json_file, indent=1)
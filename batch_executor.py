@@ -0,0 +1,236 @@
+"""
+The batch_executor module exports the BatchHackExecutor class.
+
+BatchHackExecutor class: Runs many instances ("lanes") of the same Hack program at once, in lockstep, over a NumPy
+RAM matrix. Each lane has its own RAM, A, D, and PC, so the lanes can be given different inputs (say, different
+arguments or test data) and their results and cycle counts compared, which is much faster than running the
+hack_executor once per input.
+
+Usage:
+    python batch_executor.py <program> [--lanes N] [--input ADDRESS] [--max-cycles N]
+
+which runs the translated asm_output/<program>.asm in N lanes, with RAM[ADDRESS] of lane i set to i (for example
+--input 400 sets argument 0 of a program without a Sys.vm), and compares the time taken against running the
+hack_executor once per lane. A program without a Sys.vm has no bootstrap to call it, so every lane starts with the
+segment pointers and arguments that the course test scripts set up (diff_harness.INITIAL_RAM), before the inputs.
+
+NumPy is required for this module only.
+"""
+import argparse
+import os
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from hack_assembler import assemble, assemble_file
+from hack_executor import COMP_EXPRESSIONS, RAM_SIZE
+
+# The jump bits, as functions of the signed result r of the computation.
+JUMP_TESTS = {
+    1: lambda r: r > 0, 2: lambda r: r == 0, 3: lambda r: r >= 0, 4: lambda r: r < 0,
+    5: lambda r: r != 0, 6: lambda r: r <= 0,
+}
+
+
+class BatchHackExecutor:
+    """
+    The BatchHackExecutor class runs several lanes of the same program in lockstep: every call to step() executes one
+    instruction (one clock cycle) in every running lane.
+
+    Lanes are kept in groups that share a PC, so each instruction is executed once per group with NumPy over all the
+    lanes of the group. A group only has to be split when a jump goes different ways for different lanes, and groups
+    that reach the same PC again are merged, so lanes running the same path stay one group.
+
+    A lane halts when it reaches the end of the ROM or the '@X / 0;JMP' halting idiom, like the hack_executor.
+
+    Methods:
+        __init__: Constructs the executor, loading the machine code and allocating the lanes.
+        from_asm_file: Constructs an executor from an .asm file.
+        poke: Sets a RAM address in every lane, to one value or to one value per lane.
+        peek: Returns the signed values of a RAM address in every lane.
+        step: Executes one instruction in every running lane.
+        run: Runs every lane until it halts or a cycle limit is reached.
+    """
+
+    def __init__(self, machine_code, num_lanes):
+        """Construct the executor.
+
+        Arguments:
+            machine_code: The list of 16-bit instruction words, one per ROM address.
+            num_lanes: How many instances of the program to run.
+        """
+        if np is None:
+            raise ImportError('The batch executor needs NumPy (pip install numpy).')
+
+        self.rom = list(machine_code)
+        self.num_lanes = num_lanes
+        self.ram = np.zeros((num_lanes, RAM_SIZE), dtype=np.int16)
+        self.a_reg = np.zeros(num_lanes, dtype=np.int16)
+        self.d_reg = np.zeros(num_lanes, dtype=np.int16)
+        self.cycles = np.zeros(num_lanes, dtype=np.int64)
+        self.halted = np.zeros(num_lanes, dtype=bool)
+        self.steps = 0
+
+        # Each group is a [pc, array of lane numbers] pair. Every lane starts at PC 0.
+        self.groups = [[0, np.arange(num_lanes)]]
+
+        self.ops = [self.decode(address, word) for address, word in enumerate(self.rom)]
+
+    @classmethod
+    def from_asm_file(cls, asm_file, num_lanes):
+        """Construct an executor from an .asm file."""
+        return cls(assemble_file(asm_file), num_lanes)
+
+    @classmethod
+    def from_asm(cls, asm_lines, num_lanes):
+        """Construct an executor from lines of Hack assembly code."""
+        return cls(assemble(asm_lines), num_lanes)
+
+    def decode(self, address, word):
+        """Decode an instruction word into a (kind, ...) tuple that step() can execute."""
+        if word == address and address + 1 < len(self.rom) and self.rom[address + 1] == 0b1110101010000111:
+            return ('halt',)
+        if not word & 0x8000:
+            return ('a', np.int16(word))
+
+        expression = COMP_EXPRESSIONS[(word >> 6) & 0b1111111]
+        compute = eval(f'lambda a, d, m: {expression}')
+        return ('c', compute, 'm' in expression, (word >> 3) & 0b111, word & 0b111)
+
+    def poke(self, address, values):
+        """Set RAM[address] in every lane to the given value, or to the given array of one value per lane."""
+        self.ram[:, address] = np.asarray(values).astype(np.int64).astype(np.int16)
+
+    def peek(self, address):
+        """Return the signed values of RAM[address] in every lane."""
+        return self.ram[:, address].copy()
+
+    def step(self):
+        """Execute one instruction in every running lane. Return the number of lanes still running."""
+        self.steps += 1
+        next_groups = {}
+
+        for pc, lanes in self.groups:
+            if pc >= len(self.ops) or self.ops[pc][0] == 'halt':
+                self.halted[lanes] = True
+                continue
+
+            self.cycles[lanes] += 1
+            op = self.ops[pc]
+            if op[0] == 'a':
+                self.a_reg[lanes] = op[1]
+                self.add_group(next_groups, pc + 1, lanes)
+                continue
+
+            _, compute, reads_m, dest, jump = op
+            a = self.a_reg[lanes]
+            address = a.view(np.uint16) & 0x7FFF
+            m = self.ram[lanes, address] if reads_m else None
+            with np.errstate(over='ignore'):
+                result = np.asarray(compute(a, self.d_reg[lanes], m), dtype=np.int16)
+            if result.shape != lanes.shape:
+                result = np.broadcast_to(result, lanes.shape).astype(np.int16)
+
+            if dest & 0b001:
+                self.ram[lanes, address] = result
+            if dest & 0b100:
+                self.a_reg[lanes] = result
+            if dest & 0b010:
+                self.d_reg[lanes] = result
+
+            if not jump:
+                self.add_group(next_groups, pc + 1, lanes)
+            elif jump == 7:
+                self.split_by_target(next_groups, address, lanes)
+            else:
+                taken = JUMP_TESTS[jump](result)
+                if taken.all():
+                    self.split_by_target(next_groups, address, lanes)
+                elif not taken.any():
+                    self.add_group(next_groups, pc + 1, lanes)
+                else:
+                    self.split_by_target(next_groups, address[taken], lanes[taken])
+                    self.add_group(next_groups, pc + 1, lanes[~taken])
+
+        self.groups = [[pc, np.concatenate(parts) if len(parts) > 1 else parts[0]]
+                       for pc, parts in next_groups.items()]
+        return sum(len(lanes) for _, lanes in self.groups)
+
+    @staticmethod
+    def add_group(next_groups, pc, lanes):
+        """Add lanes to the group at the given PC for the next step, merging them with any lanes already there."""
+        next_groups.setdefault(pc, []).append(lanes)
+
+    def split_by_target(self, next_groups, targets, lanes):
+        """Send each lane to its own jump target, which is almost always the same for every lane."""
+        first = int(targets[0])
+        if (targets == first).all():
+            self.add_group(next_groups, first, lanes)
+        else:
+            for target in np.unique(targets):
+                self.add_group(next_groups, int(target), lanes[targets == target])
+
+    def run(self, max_cycles=10_000_000):
+        """Run every lane until it halts or max_cycles steps have run. Return the array of which lanes halted."""
+        for _ in range(max_cycles):
+            if not self.step():
+                break
+        return self.halted.copy()
+
+
+def run_scalar(machine_code, num_lanes, inputs, max_cycles):
+    """Run the program once per lane with the hack_executor, for comparison. Return the executors."""
+    from hack_executor import HackExecutor
+
+    runs = []
+    for lane in range(num_lanes):
+        executor = HackExecutor(machine_code)
+        for address, values in inputs.items():
+            executor.poke(address, int(values[lane]))
+        executor.run(max_cycles=max_cycles)
+        runs.append(executor)
+    return runs
+
+
+# ************************************************************************************************
+# Program begins here:
+
+if __name__ == '__main__':
+    import main
+    from diff_harness import INITIAL_RAM
+
+    arg_parser = argparse.ArgumentParser(description='Run many lanes of a translated program at once.')
+    arg_parser.add_argument('program', help='The program whose asm_output/<program>.asm should be run.')
+    arg_parser.add_argument('--lanes', type=int, default=1000, help='How many lanes to run.')
+    arg_parser.add_argument('--input', type=int, action='append', default=[],
+                            help='A RAM address to set to the lane number in every lane. May be repeated.')
+    arg_parser.add_argument('--max-cycles', type=int, default=1_000_000, help='Stop after this many cycles.')
+    args = arg_parser.parse_args()
+
+    program_code = assemble_file(os.path.join(main.PROGRAM_DIR, 'asm_output', args.program + '.asm'))
+    lane_inputs = {}
+    if not os.path.exists(os.path.join(main.PROGRAM_DIR, 'vm_input', args.program, 'Sys.vm')):
+        lane_inputs.update({address: np.full(args.lanes, value) for address, value in INITIAL_RAM.items()})
+    lane_inputs.update({address: np.arange(args.lanes) for address in args.input})
+
+    start = time.perf_counter()
+    batch = BatchHackExecutor(program_code, args.lanes)
+    for input_address, input_values in lane_inputs.items():
+        batch.poke(input_address, input_values)
+    batch.run(args.max_cycles)
+    batch_time = time.perf_counter() - start
+    print(f'{args.lanes} lanes in {batch_time:.3f} s ({batch.steps} steps, {int(batch.halted.sum())} halted, '
+          f'cycles {int(batch.cycles.min())} to {int(batch.cycles.max())})')
+
+    start = time.perf_counter()
+    scalar_runs = run_scalar(program_code, args.lanes, lane_inputs, args.max_cycles)
+    scalar_time = time.perf_counter() - start
+    print(f'{args.lanes} hack_executor runs in {scalar_time:.3f} s')
+
+    mismatched = [lane for lane, run in enumerate(scalar_runs)
+                  if run.cycles != batch.cycles[lane] or
+                  (np.array(run.ram, dtype=np.uint16).view(np.int16) != batch.ram[lane]).any()]
+    print(f'{len(mismatched)} lanes differ from the hack_executor.' if mismatched else 'All lanes match.')
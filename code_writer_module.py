@@ -5,9 +5,44 @@ CodeWriter class: Handles the translating of VM commands into Hack assembly .asm
 no matter how many .vm files are needing translation.
 """
 import os
-import pathlib
 
 import config
+from frame_layout import FRAME_POINTERS, saved_pointers
+from hack_assembler import MachineCodeBuilder, write_hack_file
+from instrumentation import timed
+from pgo import block_templates, hot_functions, load_profile
+from source_map import SourceMap, source_map_path
+from static_layout import static_file_name
+
+# The Hack jump that is taken when the comparison x <op> y is true, given D = x - y.
+COMPARISON_JUMPS = {'eq': 'JEQ', 'gt': 'JGT', 'lt': 'JLT', 'le': 'JLE', 'ge': 'JGE', 'ne': 'JNE'}
+
+# The Hack operators of the binary and unary arithmetic commands.
+BINARY_OPERATORS = {'add': '+', 'sub': '-', 'and': '&', 'or': '|'}
+UNARY_OPERATORS = {'neg': '-', 'not': '!'}
+
+# The XVM logical commands, which take any non-zero value as true.
+LOGICAL_COMMANDS = ['bool', 'l-not', 'l-and', 'l-or', 'l-xor']
+
+# The shared routine of each XVM multiply, divide, and shift command. div and mod share one routine, which leaves the
+# quotient on the stack and the remainder in R13.
+MATH_ROUTINES = {'mult': '__VM_MULT', 'div': '__VM_DIVMOD', 'mod': '__VM_DIVMOD', 'shl': '__VM_SHL', 'shr': '__VM_SHR'}
+
+# How many stack words, from the one SP points to once the routine has taken y off, each math routine writes while it
+# runs. Only __VM_DIVMOD writes above the two operands it was called with.
+ROUTINE_SCRATCH = {'__VM_MULT': 1, '__VM_DIVMOD': 4, '__VM_SHL': 0, '__VM_SHR': 1}
+
+# The stack words an inline call pushes, on top of the frame, while it works out the new ARG: SP and the number of
+# arguments. Call stubs work it out in D instead.
+CALL_SCRATCH = 2
+
+INDIRECT_SEGMENTS = ['local', 'argument', 'this', 'that']
+DIRECT_SEGMENTS = ['pointer', 'temp', 'static', 'ram']
+
+
+def hack_file_path(output_file):
+    """Return the path of the .hack file written next to the given .asm output file."""
+    return os.path.splitext(output_file)[0] + '.hack'
 
 
 class CodeWriter:
@@ -18,6 +53,10 @@ class CodeWriter:
     Methods:
         __init__: Constructs the code_writer object and opens the .asm output file, getting it ready for writing.
         set_file_name: Informs the code_writer that the translation of a new VM file is started.
+        set_static_layout: Gives the code_writer the RAM address planned for each static of the program.
+        set_source_line: Informs the code_writer of the VM line being translated, for the source map.
+        can_fuse_comparison: Returns true if a comparison followed by an if-goto should be written as one jump.
+        write_compare_if: Writes the assembly code for a comparison whose result is only used by an if-goto.
         write_arithmetic: Writes the assembly code that is the translation of the given arithmetic command.
         write_push_pop: Writes the assembly code that is the translation of the given C_PUSH or C_POP command.
         close: Closes the output file.
@@ -29,14 +68,76 @@ class CodeWriter:
         Arguments:
             output_file: The (initially empty) .asm output file to be written to.
         """
-        self.output_file = open(output_file, "w")
+        # With the integrated assembler, the instructions are assembled as they are emitted and a .hack file is written
+        # next to the .asm file, which itself is then optional.
+        self.machine_code = MachineCodeBuilder() if config.EMIT_HACK else None
+        self.output_file = open(output_file, "w") if config.WRITE_ASM or not config.EMIT_HACK else None
+        self.output_path = output_file
         self.current_input_file = None
+        self.static_addresses = {}      # The planned RAM address of each (file name, index) static, if any.
+        self.frames = {}                # The segment pointers saved in the frame of each function, if planned.
         self.current_directory = os.path.basename(input_path)
+        self.input_path = input_path
         self.current_function = ""
         self.tf_label = 0  # The number to differentiate various true-false enabling labels.
         self.call_label = 0  # The number to differentiate various call labels.
-        self.bool_label = 0     # The number to differentiate calls to bool().
         self.label_index = None
+        self.instruction_index = 0     # The ROM address of the next instruction to be written.
+
+        # If enabled, the source map records which VM command each emitted instruction came from.
+        self.source_map = SourceMap() if config.WRITE_SOURCE_MAP else None
+        self.source_line = 0
+        self.source_command = None
+
+        # The kind of templates to use: None for the plain ones, 'speed' for inlined and fused ones, or 'size' for ones
+        # that jump to shared routines. With a recorded profile, hot basic blocks use 'speed' and the rest use 'size'
+        # (or, for a profile without block counts, hot functions do). The templates of each profiled block are kept by
+        # the (.vm file, line) of its first command.
+        profile = load_profile(config.PROFILE_FILE) if config.PROFILE_FILE else None
+        self.hot_functions = hot_functions(profile) if profile is not None else None
+        self.block_templates = block_templates(profile) if profile is not None else None
+        self.optimize_for = config.OPTIMIZATION
+        self.shared_routines = set()    # The labels of the shared routines written so far.
+        # The (function, prologue strategy, words, cycles, words and cycles of pushing every local) of each function
+        # written with optimized code.
+        self.prologues = []
+
+        # With deferred SP updates, pushes and pops within a basic block address the stack relative to the SP in RAM
+        # and only move this offset; SP is brought up to date (flushed) at block exits, calls, and returns.
+        self.sp_offset = 0      # How far the top of the VM stack is above RAM[SP].
+
+        # Within a basic block, optimized code remembers which slot address is already in a register, so the next
+        # access to the same or a nearby slot of an indirect segment can step from it instead of starting over.
+        self.r13_slot = None    # The (segment, index) of the slot whose address is in R13.
+        self.d_slot = None      # The (segment, index) of the slot whose address is in D (a base, after pop pointer).
+
+        # The dispatch table of the template method of each (command, segment); arithmetic commands have no segment.
+        self.templates = {(command, None): self.write_binary for command in BINARY_OPERATORS}
+        self.templates.update({(command, None): self.write_unary for command in UNARY_OPERATORS})
+        self.templates.update({(command, None): self.write_comparison for command in COMPARISON_JUMPS})
+        self.templates.update({(command, None): self.write_logical_binary for command in ['l-and', 'l-or', 'l-xor']})
+        self.templates[('bool', None)] = self.write_bool
+        self.templates[('l-not', None)] = self.write_logical_not
+        for segment in INDIRECT_SEGMENTS:
+            self.templates[('C_PUSH', segment)] = self.write_push_indirect
+            self.templates[('C_POP', segment)] = self.write_pop_indirect
+        for segment in DIRECT_SEGMENTS:
+            self.templates[('C_PUSH', segment)] = self.write_push_direct
+            self.templates[('C_POP', segment)] = self.write_pop_direct
+        self.templates.update({(command, 'constant'): self.write_math_by_constant for command in MATH_ROUTINES})
+        self.templates[('C_PUSH', 'constant')] = self.write_push_constant
+        # The fused templates of common idioms, whose index is a tuple of the idiom's other arguments.
+        for segment in INDIRECT_SEGMENTS + DIRECT_SEGMENTS:
+            self.templates[('update', segment)] = self.write_fused_update
+            self.templates[('move', segment)] = self.write_fused_move
+        self.templates[('move', 'constant')] = self.write_fused_move
+        self.templates[('C_POP', 'constant')] = self.write_pop_constant
+
+        # The rendered block of each command written so far (see write_template), and, while one is being rendered,
+        # its lines and the kinds of its labels.
+        self.template_cache = {}
+        self.rendering = None
+        self.rendering_labels = None
 
         # Initialize the addresses dictionary, which maps VM labels to RAM addresses and .asm labels.
         self.addresses = {
@@ -57,9 +158,55 @@ class CodeWriter:
         """
         Inform the code_writer that the translation of a new VM file is started.
         """
+        self.flush_sp()
         # Sets the current filename (as the last part of the input file path).
-        self.current_input_file = os.path.basename(filename).replace('.vm', '')
+        self.current_input_file = static_file_name(filename)
         self.label_index = 0
+        self.forget_slot_addresses()
+
+    def set_static_layout(self, static_addresses):
+        """
+        Give the code_writer the RAM address planned for each static of the program, so statics are written as numeric
+        addresses rather than as symbols for the assembler to allocate. Statics without an address stay symbols.
+
+        Arguments:
+            static_addresses: A dictionary of the address of each (file name, index), from plan_static_layout().
+        """
+        self.static_addresses = static_addresses
+
+    def set_frame_layout(self, frames):
+        """
+        Give the code_writer the segment pointers planned for the frame of each function of the program, so calls and
+        returns save and restore only those. Functions without a plan get the full frame of LCL, ARG, THIS, and THAT.
+
+        Arguments:
+            frames: A dictionary of the list of pointers saved by the frame of each function, from plan_frame_layout().
+        """
+        self.frames = frames
+
+    def frame_of(self, function_name):
+        """Return the segment pointers saved in the frame of the given function, in the order a call pushes them."""
+        return saved_pointers(self.frames, function_name)
+
+    def set_source_line(self, line, command):
+        """
+        Inform the code_writer of the VM line about to be translated, so the instructions it emits can be recorded in
+        the source map.
+
+        Arguments:
+            line: The line number of the command in the current .vm file.
+            command: The VM command text, such as 'push local 0'.
+        """
+        self.source_line = line
+        self.source_command = command
+        self.optimize_for = self.profiled_templates(self.optimize_for)
+
+    def profiled_templates(self, default):
+        """Return the templates the profile picks for the basic block that starts at the current VM line, or the given
+        default if the line doesn't start a profiled block."""
+        if self.block_templates is None or not self.current_input_file:
+            return default
+        return self.block_templates.get((self.current_input_file + '.vm', self.source_line), default)
 
     def write_arithmetic(self, command):
         """
@@ -69,252 +216,162 @@ class CodeWriter:
             command: One of several operations (like add, sub, or eq) to be translated into .asm code. Has only one
             part with no arguments.
         """
-        # TODO: Encapsulate some or all of the VM commands (like 'add') into their own functions, then try to optimize
-        #  each individually. Not as clean and will repeat more, but may be easier to see and do optimizations.
-
-        # Do something different depending on the type of command.
-        if command == 'add':
-            if config.WRITE_ASM_COMMENTS:
-                self.write_output('\n// add')
-            self.pop_d()
-            self.write_output('@R14')
-            self.write_output('M=D')
-            self.pop_d()
-            self.write_output('@R14')
-            self.write_output('D=D+M')
-        elif command == 'sub':
-            if config.WRITE_ASM_COMMENTS:
-                self.write_output('\n// sub')
-            self.pop_d()
-            self.write_output('@R14')
-            self.write_output('M=D')
-            self.pop_d()
-            self.write_output('@R14')
-            self.write_output('D=D-M')
-        elif command == 'and':
-            if config.WRITE_ASM_COMMENTS:
-                self.write_output('\n// and')
-            self.pop_d()
-            self.write_output('@R14')
-            self.write_output('M=D')
-            self.pop_d()
-            self.write_output('@R14')
-            self.write_output('D=D&M')
-        elif command == 'or':
-            if config.WRITE_ASM_COMMENTS:
-                self.write_output('\n// or')
-            self.pop_d()
-            self.write_output('@R14')
-            self.write_output('M=D')
-            self.pop_d()
-            self.write_output('@R14')
-            self.write_output('D=D|M')
-        elif command == 'neg':
-            if config.WRITE_ASM_COMMENTS:
-                self.write_output('\n// neg')
-            self.pop_d()
-            self.write_output('D=-D')
-        elif command == 'not':
-            if config.WRITE_ASM_COMMENTS:
-                self.write_output('\n// not')
-            self.pop_d()
-            self.write_output('D=!D')
-        elif command == 'bool':
-            if config.WRITE_ASM_COMMENTS:
-                self.write_output('\n// bool')
-            self.dec_SP()
-            self.set_a_to_sp()
-            self.bool()
-        elif command == 'l-not':
-            if config.WRITE_ASM_COMMENTS:
-                self.write_output('\n// l-not')
-            self.dec_SP()
-            self.set_a_to_sp()
-            self.bool()
-            self.set_a_to_sp()
-            self.write_output('D=!M')
-        elif command in ['l-and', 'l-or', 'l-xor']:
+        if command in COMPARISON_JUMPS and self.optimize_for == 'size':
+            # Share one routine per comparison, which leaves its result on the stack in place. What is written depends
+            # on whether the routine has been written yet, so this is not a cached template.
             if config.WRITE_ASM_COMMENTS:
                 self.write_output(f'\n// {command}')
-            self.dec_SP()
-            self.set_a_to_sp()
-            self.bool()
-            self.dec_SP()
-            self.set_a_to_sp()
-            self.bool()
-            self.set_a_to_sp()
+            self.write_shared_call(f'__VM_{command.upper()}', lambda: self.write_compare_routine(command))
+        elif command in LOGICAL_COMMANDS and command != 'l-xor' and self.optimize_for == 'size':
+            # l-xor with shared routines takes as many words as its template, so it keeps the faster template.
+            self.write_logical_shared(command)
+        elif command in MATH_ROUTINES:
+            self.write_math(command)
+        else:
+            self.write_template(command, None, None)
+
+    def can_fuse_comparison(self, command):
+        """
+        Return true if the given arithmetic command is a comparison that, when directly followed by an if-goto, should
+        be translated together with it by write_compare_if. Only done in code optimized for speed.
+        """
+        return self.optimize_for == 'speed' and command in COMPARISON_JUMPS
+
+    def can_fold_constant(self, command, value):
+        """
+        Return true if the given arithmetic command, directly after 'push constant value', should be translated
+        together with the push by write_math_constant: a multiply, divide, or shift by a constant with simpler code than
+        its shared routine, like a multiply by a power of two. Only done in optimized code; in code optimized for size,
+        only when the code is short.
+        """
+        if self.optimize_for is None or command not in MATH_ROUTINES:
+            return False
+        if command == 'mult':
+            if value <= 1:
+                return True
+            if value & (value - 1):
+                return False
+            doublings = value.bit_length() - 1
+        elif command == 'shl':
+            if value == 0 or value >= 16:
+                return True
+            doublings = value
+        elif command == 'div':
+            return value == 1
+        elif command == 'mod':
+            return value > 0 and not value & (value - 1)
+        else:
+            return value == 0 or value >= 16
+        return self.optimize_for == 'speed' or doublings <= 4
+
+    def write_math_constant(self, command, value):
+        """
+        Write the assembly code for 'push constant value' followed by the given multiply, divide, or shift command,
+        for which can_fold_constant is true.
+        """
+        if command in ['mult', 'div'] and value == 1 or command in ['shl', 'shr'] and value == 0:
+            return      # x * 1, x / 1, and shifting by 0 are x.
+        self.write_template(command, 'constant', value)
+
+    def write_math(self, command):
+        """
+        Write the assembly code for a multiply, divide, or shift command, which calls its shared routine.
+
+        Arguments:
+            command: mult, div, mod, shl, or shr.
+        """
+        if config.WRITE_ASM_COMMENTS:
+            self.write_output(f'\n// {command}')
+        routine = MATH_ROUTINES[command]
+        self.write_shared_call(routine, {'__VM_MULT': self.write_multiply_routine,
+                                         '__VM_DIVMOD': self.write_divide_routine,
+                                         '__VM_SHL': self.write_shift_left_routine,
+                                         '__VM_SHR': self.write_shift_right_routine}[routine])
+        if command == 'mod':
+            self.write_output('@R13')
             self.write_output('D=M')
-            self.inc_SP()
-            self.write_output('A=M')
-            if command == 'l-and':
-                self.write_output('D=D&M')
-            elif command == 'l-or':
-                self.write_output('D=D|M')
-            elif command == 'l-xor':
-                self.write_output('D=D&M')
-                self.write_output('D=!D')
-                self.write_output('@R13')   # Temporarily store complement(M and D) in reg 13
-                self.write_output('M=D')
-                self.set_a_to_sp()
-                self.write_output('D=M')
-                self.dec_SP()
-                self.set_a_to_sp()
-                self.write_output('D=D|M')
-                self.write_output('@R13')   # Retrieve the sub-result from R13
-                self.write_output('D=D&M')  # Final logic for logical xor.
-        elif command in ['eq', 'gt', 'lt']:  # Each boolean operator takes 23 lines. Could be as low as 9.
-            if config.WRITE_ASM_COMMENTS:
-                self.write_output(f'\n// {command}')
-            self.pop_d()
-            self.write_output('@R14')
+            self.write_output('@SP')
+            self.write_output('A=M-1')
             self.write_output('M=D')
-            self.pop_d()
-            self.write_output('@R14')
-            self.write_output('D=D-M')
 
-            #self.write_output(f'@TRUE{self.tf_label}')
-            true_label = f'{self.current_function}' + ':' + f'{self.label_index}'
-            self.label_index += 1
-            false_label = f'{self.current_function}' + ':' + f'{self.label_index}'
-            self.label_index += 1
-            self.write_output(f'@{true_label}')
-
-
-            if command == 'eq':
-                self.write_output('D;JEQ')
-            elif command == 'gt':
-                self.write_output('D;JGT')
-            elif command == 'lt':
-                self.write_output('D;JLT')
-            # Added support for le, ge, and ne commands.
-            elif command == 'le':
-                self.write_output('D;JLE')
-            elif command == 'ge':
-                self.write_output('D;JGE')
-            elif command == 'ne':
-                self.write_output('D;JNE')
-
-            self.write_output('D=0')  # 0 is False
-            self.write_output(f'@{false_label}')
-            self.write_output('0;JMP')
+    def can_fuse_update(self, segment, index, delta):
+        """
+        Return true if 'push segment index / push constant k / add (or sub) / pop segment index', which adds delta to a
+        segment slot, should be translated by write_update as one in-place update. Only done in optimized code.
+        """
+        return self.optimize_for is not None and delta != 0 and segment in INDIRECT_SEGMENTS + DIRECT_SEGMENTS and \
+            (segment, index) != ('ram', 0)
 
-            self.write_output(f'({true_label})')
-            self.write_output('D=-1')  # -1 is True
+    def write_update(self, segment, index, delta):
+        """Write the assembly code that adds delta (which may be negative) to a segment slot in place."""
+        self.write_template('update', segment, (index, delta))
 
-            self.write_output(f'({false_label})')
-            self.tf_label += 1
+    def can_fuse_move(self, source_segment, source_index, destination_segment, destination_index):
+        """
+        Return true if 'push source / pop destination' should be translated by write_move as one move from memory to
+        memory, without going through the stack. Only done in optimized code. RAM[0] is SP itself, so moves to or from
+        it still go through the stack.
+        """
+        return self.optimize_for is not None and \
+            source_segment in INDIRECT_SEGMENTS + DIRECT_SEGMENTS + ['constant'] and \
+            destination_segment in INDIRECT_SEGMENTS + DIRECT_SEGMENTS and \
+            ('ram', 0) not in [(source_segment, source_index), (destination_segment, destination_index)]
 
-        # Finally, push the result to the top of the stack.
-        self.push_d()
+    def write_move(self, source_segment, source_index, destination_segment, destination_index):
+        """Write the assembly code that copies a value from one segment slot (or a constant) to another."""
+        self.write_template('move', source_segment, (source_index, destination_segment, destination_index))
 
-    def write_push_pop(self, command, segment, index):
+    def can_merge_discards(self):
         """
-        Write the assembly code that is the translation of the given command, where the command type must be either
-        C_PUSH or C_POP.
+        Return true if a run of pops to the constant segment, which only discard values (like the dead stores left by
+        dead store elimination), should be translated by write_discard as one SP adjustment. Done in optimized code,
+        and whenever dead stores are eliminated.
         """
-        # TODO: Not splitting push/pop into two subtasks as described in the VMT Memory commands (2:00) video may help
-        #  efficiency.
-        # Set the address in the A-register depending on what type of segment is being popped to or pushed from.
-        address = self.addresses.get(segment)
+        return self.optimize_for is not None or config.ELIMINATE_DEAD_STORES
 
-        if command == 'C_PUSH':
-            if segment == 'constant':
-                if config.WRITE_ASM_COMMENTS:
-                    self.write_output(f'\n// push constant {str(index)}')
-                self.write_output('@' + str(index))
-                self.write_output('D=A')
-            elif segment == 'pointer':
-                if config.WRITE_ASM_COMMENTS:
-                    self.write_output(f'\n// push pointer {str(index)}')
-                self.write_output('@' + str(3 + index))
-                self.write_output('D=M')
-            elif segment == 'temp':
-                if config.WRITE_ASM_COMMENTS:
-                    self.write_output(f'\n// Push temp {index}')
-                self.write_output('@' + str(5 + index))
-                self.write_output('D=M')
-            elif segment in ['local', 'argument', 'this', 'that']:  # Indirect-indexed segments.
-                if config.WRITE_ASM_COMMENTS:
-                    self.write_output(f'\n// push {segment} {index}')
-                self.write_output("@" + str(index))
-                self.write_output("D=A")
-                self.write_output("@" + str(address))
-                self.write_output("A=M")
-                self.write_output("D=D+A")
-                self.write_output("@R13")
-                self.write_output("M=D")
-                self.write_output("@R13")
-                self.write_output("A=M")
-                self.write_output("D=M")
-            elif segment == 'static':
-                if config.WRITE_ASM_COMMENTS:
-                    self.write_output(f'\n// push static {index}')
-                self.write_output('@' + self.current_input_file + '.' + str(index))
-                self.write_output('D=M')
-            elif segment == 'ram':      # Extended support for pushing/popping directly to RAM.
-                if config.WRITE_ASM_COMMENTS:
-                    self.write_output(f'\n// push ram {index}')
-                self.write_output('@' + str(index))
-                self.write_output('D=M')
+    def write_discard(self, count):
+        """Write the assembly code that removes the given number of values from the top of the stack."""
+        if config.WRITE_ASM_COMMENTS:
+            self.write_output(f'\n// discard {count}')
+        self.sp_offset -= count
+        if config.DEFER_SP_UPDATES and self.sp_offset >= -2:
+            return
+        if self.sp_offset >= -2:
+            self.flush_sp()
+            return
+        self.write_output(f'@{-self.sp_offset}')
+        self.write_output('D=A')
+        self.write_output('@SP')
+        self.write_output('M=M-D')
+        self.sp_offset = 0
 
-            # Finally, push D onto the stack
-            self.push_d()
+    def write_compare_if(self, command, label):
+        """
+        Write the assembly code for a comparison followed by an if-goto, jumping on the comparison directly instead of
+        pushing a Boolean and popping it again.
 
-        elif command == 'C_POP':
-            # Provides support for popping to the constant segment, which just removes the value on top of the stack.
-            if segment == 'constant':
-                if config.WRITE_ASM_COMMENTS:
-                    self.write_output(f'\n// pop constant {index}')
-                self.pop_d()
-            elif segment == 'pointer':
-                if config.WRITE_ASM_COMMENTS:
-                    self.write_output(f'\n// pop pointer {index}')
-                self.pop_d()
-                self.write_output('@' + str(3 + index))
-                self.write_output('M=D')
-            elif segment == 'temp':
-                if config.WRITE_ASM_COMMENTS:
-                    self.write_output(f'\n// pop temp {index}')
-                self.pop_d()
-                self.write_output('@' + str(5 + index))
-                self.write_output('M=D')
-            elif segment in ['local', 'argument', 'this', 'that']:      # TODO: FOUND THE PROBLEM! Was == instead of in
-                if config.WRITE_ASM_COMMENTS:
-                    self.write_output(f'\n// pop {segment} {index}')
-                self.pop_d()
-                self.write_output("@R14")
-                self.write_output("M=D")
-                self.write_output("@" + str(index))
-                self.write_output("D=A")
-                self.write_output("@" + str(address))
-                self.write_output("A=M")
-                self.write_output("D=D+A")
-                self.write_output("@R13")
-                self.write_output("M=D")
-                self.write_output("@R14")
-                self.write_output("D=M")
-                self.write_output("@R13")
-                self.write_output("A=M")
-                self.write_output("M=D")
-            elif segment == 'static':
-                if config.WRITE_ASM_COMMENTS:
-                    self.write_output(f'\n// pop static {index}')
-                self.pop_d()
-                self.write_output('@' + self.current_input_file + '.' + str(index))
-                self.write_output('M=D')
-            elif segment == 'ram':
-                if config.WRITE_ASM_COMMENTS:
-                    self.write_output(f'\n// pop ram {index}')
-                self.write_output('@' + str(index))
-                self.write_output('M=D')
-                # TODO: May need to change to the below instead of the above line.
-                # self.write_output('D=A')
-                # self.write_output('@R13')
-                # self.write_output('M=D')
-                # self.pop_d()
-                # self.write_output('@R13')
-                # self.write_output('A=M')
-                # self.write_output('M=D')
+        Arguments:
+            command: The comparison (eq, gt, lt, le, ge, or ne).
+            label: The label of the if-goto.
+        """
+        if config.WRITE_ASM_COMMENTS:
+            self.write_output(f'\n// {command} / if-goto {label}')
+        self.flush_sp()
+        self.write_output('@SP')
+        self.write_output('AM=M-1')
+        self.write_output('D=M')
+        self.write_output('@SP')
+        self.write_output('AM=M-1')
+        self.write_output('D=M-D')
+        self.write_output(f'@{self.current_function}${label}')
+        self.write_output(f'D;{COMPARISON_JUMPS[command]}')
+
+    def write_push_pop(self, command, segment, index):
+        """
+        Write the assembly code that is the translation of the given command, where the command type must be either
+        C_PUSH or C_POP.
+        """
+        self.write_template(command, segment, index)
 
     def write_init(self):
         """
@@ -323,6 +380,7 @@ class CodeWriter:
         """
         self.current_function = "..BOOT.."
         self.label_index = 0
+        self.set_source_line(0, 'bootstrap')
 
         # TODO: Need the below? SimpleFunction works when this is *not* included, nor the Sys.init code below.
         self.write_output('@256')
@@ -333,8 +391,9 @@ class CodeWriter:
         # self.write_call('Sys.init', 0)
 
         # If a Sys.vm file exists in the directory being translated, write a 'Sys.init' call.
-        sys_file = os.path.join(str(pathlib.Path().absolute()), 'vm_input', self.current_directory, 'Sys.vm')
+        sys_file = os.path.join(self.input_path, 'Sys.vm')
         if os.path.exists(sys_file):
+            self.set_source_line(0, 'call Sys.init 0')
             self.write_call('Sys.init', 0)
             # self.write_output('@Sys.init')
             # self.write_output('0;JMP')
@@ -345,7 +404,9 @@ class CodeWriter:
         """
         if config.WRITE_ASM_COMMENTS:
             self.write_output(f'\n// label {label}')
+        self.flush_sp()
         self.write_output(f'({self.current_function}${label})')
+        self.forget_slot_addresses()    # The label can be jumped to from anywhere.
 
     def write_goto(self, label):
         """
@@ -353,6 +414,7 @@ class CodeWriter:
         """
         if config.WRITE_ASM_COMMENTS:
             self.write_output(f'\n// goto {label}')
+        self.flush_sp()
         self.write_output(f'@{self.current_function}${label}')
         self.write_output('0;JMP')
 
@@ -363,6 +425,7 @@ class CodeWriter:
         if config.WRITE_ASM_COMMENTS:
             self.write_output(f'\n// if-goto {label}')
         self.pop_d()
+        self.flush_sp()
         self.write_output(f'@{self.current_function}${label}')
         self.write_output('D;JNE')
 
@@ -370,7 +433,16 @@ class CodeWriter:
         """
         Writes assembly code that effects the call command.
         """
+        if config.WRITE_ASM_COMMENTS:
+            self.write_output(f'\n// call {function_name} {num_args}')
+        self.forget_slot_addresses()    # The callee changes the registers and the segment bases.
 
+        # With call stubs (always used in code optimized for size), a call site only passes its return address to the
+        # stub that builds the frame for its (callee, number of arguments).
+        if (config.SHARE_CALL_STUBS or self.optimize_for == 'size') and self.current_function != "..BOOT..":
+            self.write_shared_call(f'__VM_CALL_{function_name}_{num_args}',
+                                   lambda: self.write_call_stub(function_name, num_args))
+            return
 
         #return_label = function_name + ':' + str(self.call_label)  # Generate a unique return label
         return_label = self.current_function + ':' + str(self.label_index)
@@ -378,22 +450,19 @@ class CodeWriter:
         if self.current_function != "..BOOT..":
             self.label_index += 1
 
-
-
-        if config.WRITE_ASM_COMMENTS:
-            self.write_output(f'\n// call {function_name} {num_args}')
-
         # push return address
         self.write_output('@' + return_label)
         self.write_output('D=A')
         self.push_d()
 
-        # push LCL, ARG, THIS, and THAT
-        for address in ['@LCL', '@ARG', '@THIS', '@THAT']:
-            self.write_output(address)
+        # push LCL, ARG, THIS, and THAT (or those of them the callee's frame saves)
+        frame = self.frame_of(function_name)
+        for pointer in frame:
+            self.write_output('@' + pointer)
             self.write_output('D=M')
             self.push_d()
 
+        self.flush_sp()
         self.write_output('@SP')
         self.write_output('D=M')
         self.push_d()
@@ -411,7 +480,7 @@ class CodeWriter:
         self.write_output('D=D-M')
         self.push_d()
 
-        self.write_output('@' + '5')
+        self.write_output('@' + str(1 + len(frame)))
         self.write_output('D=A')
         self.push_d()
 
@@ -428,6 +497,7 @@ class CodeWriter:
         self.write_output('@ARG')
         self.write_output('M=D')
 
+        self.flush_sp()
         self.write_output('@SP')
         self.write_output('D=M')
         self.push_d()
@@ -436,11 +506,47 @@ class CodeWriter:
         self.write_output('@LCL')
         self.write_output('M=D')
 
+        self.flush_sp()
         self.write_output('@' + function_name)
         self.write_output('0;JMP')
 
         self.write_output(f'({return_label})')
 
+    def write_call_stub(self, function_name, num_args):
+        """
+        Write the call stub shared by every call of a function with the same number of arguments. It is entered with
+        the return address in D, pushes the caller's frame, sets ARG and LCL for the callee, and jumps to it; the callee
+        returns straight to the call site.
+
+        Arguments:
+            function_name: The name of the function called.
+            num_args: The number of arguments pushed for the call.
+        """
+        frame = self.frame_of(function_name)
+        self.write_output(f'(__VM_CALL_{function_name}_{num_args})')
+        self.write_output('@SP')
+        self.write_output('A=M')
+        self.write_output('M=D')
+        for pointer in frame:
+            self.write_output('@' + pointer)
+            self.write_output('D=M')
+            self.write_output('@SP')
+            self.write_output('AM=M+1')
+            self.write_output('M=D')
+
+        # LCL = SP, and ARG = SP - frame size - num_args
+        self.write_output('@SP')
+        self.write_output('MD=M+1')
+        self.write_output('@LCL')
+        self.write_output('M=D')
+        self.write_output(f'@{1 + len(frame) + num_args}')
+        self.write_output('D=D-A')
+        self.write_output('@ARG')
+        self.write_output('M=D')
+
+        self.write_output('@' + function_name)
+        self.write_output('0;JMP')
+
     def write_return(self):
         """
         Writes assembly code that effects the return command.
@@ -449,15 +555,110 @@ class CodeWriter:
 
         if config.WRITE_ASM_COMMENTS:
             self.write_output('\n// return')
+        self.flush_sp()
+        self.forget_slot_addresses()
+
+        frame = self.frame_of(self.current_function)
+        if self.optimize_for is None:
+            self.write_return_body(frame)
+            return
+
+        # Optimized code restores the THIS and THAT that the frame saved first, walking down from its top. What is left
+        # of the frame is the return address, LCL, and ARG, just as in every other frame, so the rest of the return is
+        # the same for all of them. Code optimized for size shares one copy of each: the first one is written in place
+        # under a label, and later ones jump to it.
+        routine = '__VM_RETURN' + ''.join('_' + pointer for pointer in FRAME_POINTERS if pointer not in frame)
+        if self.optimize_for == 'size':
+            if routine in self.shared_routines:
+                self.write_output('@' + routine)
+                self.write_output('0;JMP')
+                return
+            self.shared_routines.add(routine)
+            self.write_output(f'({routine})')
+        self.write_restore_pointers(frame)
+        if self.optimize_for == 'size':
+            if '__VM_RETURN_TAIL' in self.shared_routines:
+                self.write_output('@__VM_RETURN_TAIL')
+                self.write_output('0;JMP')
+                return
+            self.shared_routines.add('__VM_RETURN_TAIL')
+            self.write_output('(__VM_RETURN_TAIL)')
+        self.write_return_tail()
+
+    def write_restore_pointers(self, frame):
+        """
+        Write the start of an optimized return: set R14 to the top of the frame (FRAME = LCL), and restore the THIS and
+        THAT that the frame saved, leaving R14 just above the return address, LCL, and ARG.
+
+        Arguments:
+            frame: The segment pointers saved in the function's frame, in the order they were pushed.
+        """
+        self.write_output('@LCL')
+        self.write_output('D=M')
+        self.write_output('@R14')
+        self.write_output('M=D')
+        for pointer in reversed(frame[2:]):
+            self.write_output('@R14')
+            self.write_output('AM=M-1')
+            self.write_output('D=M')
+            self.write_output('@' + pointer)
+            self.write_output('M=D')
+
+    def write_return_tail(self):
+        """
+        Write the rest of an optimized return, once R14 is just above the return address, LCL, and ARG of the frame:
+        move the return value to *ARG, set SP to ARG+1, restore ARG and LCL, and jump to the return address.
+        """
+        # RET = *(R14-3), before the return value can overwrite it
+        self.write_output('@R14')
+        self.write_output('D=M')
+        self.write_output('@3')
+        self.write_output('A=D-A')
+        self.write_output('D=M')
+        self.write_output('@R13')
+        self.write_output('M=D')
+
+        # *ARG = pop(), and SP = ARG+1
+        self.write_output('@SP')
+        self.write_output('A=M-1')
+        self.write_output('D=M')
+        self.write_output('@ARG')
+        self.write_output('A=M')
+        self.write_output('M=D')
+        self.write_output('@ARG')
+        self.write_output('D=M+1')
+        self.write_output('@SP')
+        self.write_output('M=D')
+        self.sp_offset = 0      # SP has just been set outright.
+
+        # ARG = *(R14-1), and LCL = *(R14-2)
+        for pointer in ['ARG', 'LCL']:
+            self.write_output('@R14')
+            self.write_output('AM=M-1')
+            self.write_output('D=M')
+            self.write_output('@' + pointer)
+            self.write_output('M=D')
+
+        # goto RET
+        self.write_output('@R13')
+        self.write_output('A=M')
+        self.write_output('0;JMP')
 
+    def write_return_body(self, frame):
+        """
+        Writes the plain assembly code that returns from the current function.
+
+        Arguments:
+            frame: The segment pointers saved in the function's frame, in the order they were pushed.
+        """
         # FRAME = LCL
         self.write_output('@LCL')
         self.write_output('D=M')
         self.write_output('@R14')
         self.write_output('M=D')
 
-        # RET = *(FRAME-5)
-        self.write_output('@5')
+        # RET = *(FRAME-5), or below a smaller frame
+        self.write_output('@' + str(1 + len(frame)))
         self.write_output('D=A')
         self.write_output('@R14')
         self.write_output('A=M')
@@ -478,13 +679,15 @@ class CodeWriter:
         self.write_output('D=D+1')
         self.write_output('@SP')
         self.write_output('M=D')
+        self.sp_offset = 0      # SP has just been set outright.
 
         # THAT = *(FRAME-1)
         # THIS = *(FRAME-2)
         # ARG = *(FRAME-3)
         # LCL = *(FRAME-4)
+        # (or, for a smaller frame, the pointers it saved, from the last one pushed)
         offset = 1
-        for address in ['@THAT', '@THIS', '@ARG', '@LCL']:
+        for address in ['@' + pointer for pointer in reversed(frame)]:
             """Old version:
             self.write_output('@' + FRAME)
             self.write_output('D=M')  # Save start of frame
@@ -511,80 +714,1206 @@ class CodeWriter:
         self.write_output('A=M')
         self.write_output('0;JMP')
 
-    def write_function(self, function_name, num_locals):
+    def write_function(self, function_name, num_locals, zeroed_locals=None):
         """
         Writes assembly code that effects the function command.
-        """
-        # TODO: See VMT Function Calling commands video 10:00 to see optimization strategies.
 
+        Arguments:
+            function_name: The name of the function.
+            num_locals: The number of local variables to push.
+            zeroed_locals: The set of locals that must be initialized to 0 (the ones that may be read before they are
+                written), or None for all of them. Plain code always initializes all of them.
+        """
         self.current_function = function_name
+        if self.hot_functions is not None:
+            self.optimize_for = self.profiled_templates('speed' if function_name in self.hot_functions else 'size')
 
         if config.WRITE_ASM_COMMENTS:
             self.write_output(f'\n// function {function_name} {num_locals}')
+        self.flush_sp()
+        self.forget_slot_addresses()
         self.write_output(f'({self.current_function})')
 
+        if self.optimize_for is None:
+            self.write_push_prologue(num_locals)
+            return
+        self.write_prologue(num_locals, set(range(num_locals)) if zeroed_locals is None else zeroed_locals)
+
+    # ************************************************************************************
+    # **** Function prologues *****
+
+    def write_prologue(self, num_locals, zeroed_locals):
+        """
+        Write the code that pushes the locals of a function, in the way that the cost model finds the fastest (or, when
+        optimizing for size, the smallest): pushing 0 for every local, storing 0 in each local that needs it and then
+        moving SP once, or calling a shared loop that zeroes them. Records the choice and its savings in self.prologues.
+        """
+        prologues = {
+            'push': lambda: self.write_push_prologue(num_locals),
+            'unrolled': lambda: self.write_unrolled_prologue(num_locals, zeroed_locals),
+        }
+        costs = {}      # The (ROM words, cycles) of each prologue. Straight-line code takes one cycle per word.
+        for strategy, write_prologue in prologues.items():
+            num_instructions = self.count_instructions(self.render(write_prologue))
+            costs[strategy] = (num_instructions, num_instructions)
+        if zeroed_locals:
+            # The call runs straight through, except for the routine (whether it is written in place or jumped to),
+            # which runs once, plus its loop once more for every local after the first.
+            prologues['loop'] = lambda: self.write_loop_prologue(num_locals)
+            num_instructions = self.count_instructions(self.render(prologues['loop']))
+            routine = self.render(self.write_zero_locals_routine)
+            loop = routine[routine.index('(__VM_ZERO_LOCALS_LOOP)'):routine.index('D;JGT') + 1]
+            call_instructions = num_instructions
+            if '__VM_ZERO_LOCALS' not in self.shared_routines:
+                call_instructions -= self.count_instructions(routine)
+            costs['loop'] = (num_instructions, call_instructions + self.count_instructions(routine) +
+                             self.count_instructions(loop) * (num_locals - 1))
+
+        if self.optimize_for == 'speed':
+            strategy = min(prologues, key=lambda name: (costs[name][1], costs[name][0]))
+        else:
+            strategy = min(prologues, key=lambda name: costs[name])
+        prologues[strategy]()
+        self.prologues.append((self.current_function, strategy) + costs[strategy] + costs['push'])
+
+    def render(self, write):
+        """Return the lines that the given method would write, without writing them or changing the SP offset, the
+        known slot addresses, the label numbers, or the set of shared routines written."""
+        rendering, sp_offset, r13_slot, d_slot = self.rendering, self.sp_offset, self.r13_slot, self.d_slot
+        label_index, shared_routines = self.label_index, set(self.shared_routines)
+        self.rendering = []
+        try:
+            write()
+            return self.rendering
+        finally:
+            self.rendering, self.sp_offset, self.r13_slot, self.d_slot = rendering, sp_offset, r13_slot, d_slot
+            self.label_index, self.shared_routines = label_index, shared_routines
+
+    @staticmethod
+    def count_instructions(lines):
+        """Return how many of the given lines of rendered code are instructions (not labels or comments)."""
+        return sum(1 for line in lines if line and line[0] not in '(\n/')
+
+    def write_push_prologue(self, num_locals):
+        """Write the plain prologue, which pushes 0 for every local."""
         self.write_output('D=0')
 
         for _ in range(num_locals):  # Initialize local vars to 0
             self.push_d()
 
-    def close(self):
+    def write_unrolled_prologue(self, num_locals, zeroed_locals):
+        """Write a prologue that stores 0 in each of the given locals, walking A along them, and then moves SP past all
+        the locals at once."""
+        last_zeroed = max(zeroed_locals, default=-1)
+        if zeroed_locals:
+            self.write_output('@SP')
+            self.write_output('A=M')
+            for local in range(last_zeroed + 1):
+                if local:
+                    self.write_output('A=A+1')
+                if local in zeroed_locals:
+                    self.write_output('M=0')
+
+        # Move SP in whichever of these ways takes the fewest instructions.
+        if not num_locals:
+            return
+        elif config.DEFER_SP_UPDATES and num_locals <= 2:
+            self.sp_offset += num_locals
+        elif zeroed_locals and num_locals - last_zeroed + 2 < min(num_locals + 1, 4):
+            # A is at the last local zeroed: SP goes one past the last local.
+            for _ in range(num_locals - last_zeroed - 1):
+                self.write_output('A=A+1')
+            self.write_output('D=A+1')
+            self.write_output('@SP')
+            self.write_output('M=D')
+        elif num_locals <= 3:
+            self.write_output('@SP')
+            for _ in range(num_locals):
+                self.write_output('M=M+1')
+        else:
+            self.write_output(f'@{num_locals}')
+            self.write_output('D=A')
+            self.write_output('@SP')
+            self.write_output('M=D+M')
+
+    def write_loop_prologue(self, num_locals):
+        """Write a prologue that calls the shared routine that pushes 0 for each local, passing their number in R14."""
+        self.write_output(f'@{num_locals}')
+        self.write_output('D=A')
+        self.write_output('@R14')
+        self.write_output('M=D')
+        self.write_shared_call('__VM_ZERO_LOCALS', self.write_zero_locals_routine)
+
+    def write_zero_locals_routine(self):
         """
-        Closes the output file.
+        Write the shared routine that pushes 0 R14 times (at least once). It is entered with the return address in D,
+        and returns through R15.
         """
-        self.output_file.close()
+        self.write_output('(__VM_ZERO_LOCALS)')
+        self.write_output('@R15')
+        self.write_output('M=D')
+        self.write_output('(__VM_ZERO_LOCALS_LOOP)')
+        self.write_output('@SP')
+        self.write_output('AM=M+1')
+        self.write_output('A=A-1')
+        self.write_output('M=0')
+        self.write_output('@R14')
+        self.write_output('MD=M-1')
+        self.write_output('@__VM_ZERO_LOCALS_LOOP')
+        self.write_output('D;JGT')
+        self.write_output('@R15')
+        self.write_output('A=M')
+        self.write_output('0;JMP')
 
+    def close(self):
+        """
+        Closes the output file, and writes the .hack file and the source map next to it if they were asked for.
+        """
+        self.flush_sp()
+        if self.output_file is not None:
+            self.output_file.close()
+        if self.machine_code is not None:
+            write_hack_file(self.machine_code.machine_code(), hack_file_path(self.output_path))
+        if self.source_map is not None:
+            self.source_map.write(source_map_path(self.output_path))
+
+    @timed('emit instructions')
     def write_output(self, asm_command):
         """
-        Writes one .asm command (one line) to the output .asm file.
+        Writes one .asm command (one line) to the output .asm file, and/or to the integrated assembler. While a
+        template is being rendered, the line is recorded instead.
+        """
+        # Any instruction may change D, and any instruction that addresses R13 may change it.
+        if asm_command and asm_command[0] not in '(\n/':
+            self.d_slot = None
+            if asm_command == '@R13':
+                self.r13_slot = None
+
+        if self.rendering is not None:
+            self.rendering.append(asm_command)
+            return
+
+        if self.output_file is not None:
+            self.output_file.write(asm_command + '\n')
+        if self.machine_code is not None:
+            self.machine_code.add(asm_command)
+
+        if self.source_command is not None and asm_command and asm_command[0] != '\n':
+            self.record_source_line()
+
+        # Labels, comments, and blank lines do not take up a ROM address.
+        if asm_command and asm_command[0] not in '(\n/':
+            self.instruction_index += 1
+
+    @timed('emit instructions')
+    def write_block(self, text, lines, num_instructions):
         """
-        self.output_file.write(asm_command + '\n')
+        Writes a block of .asm lines at once, just like calling write_output on each of them.
+
+        Arguments:
+            text: The lines joined by newlines.
+            lines: The lines to write, which must start with an instruction or label after any comments.
+            num_instructions: How many of the lines are instructions (not labels or comments).
+        """
+        if self.output_file is not None:
+            self.output_file.write(text + '\n')
+        if self.machine_code is not None:
+            for line in lines:
+                self.machine_code.add(line)
+
+        # Comments take up no ROM address, so the block's first instruction is at the current instruction index.
+        if self.source_command is not None:
+            self.record_source_line()
+        self.instruction_index += num_instructions
+
+    def record_source_line(self):
+        """
+        Records in the source map (if enabled) that the VM command being translated starts at the next instruction.
+        """
+        if self.source_map is not None:
+            vm_file = self.current_input_file + '.vm' if self.current_input_file else ''
+            self.source_map.record(self.instruction_index, vm_file, self.source_line, self.current_function,
+                                   self.source_command)
+        self.source_command = None
 
     # ************************************************************************************
-    # **** ASM code-writing methods *****
+    # **** Shared routines *****
 
-    def inc_SP(self):
-        """Write ASM code to increment the stack pointer."""
-        self.write_output('@SP')
-        self.write_output('M=M+1')
+    def write_shared_call(self, routine, write_routine):
+        """
+        Write a call to the given shared routine, passing the return address in D. The first call writes the routine
+        itself in place (it returns to the very next instruction), and later calls jump to it.
 
-    def dec_SP(self):
-        """Write ASM code to decrement the stack pointer."""
-        self.write_output('@SP')
-        self.write_output('M=M-1')
+        Arguments:
+            routine: The label of the shared routine.
+            write_routine: The method that writes the routine's code, starting with its label.
+        """
+        self.flush_sp()
+        return_label = f'{self.current_function}' + ':' + f'{self.label_index}'
+        self.label_index += 1
+        self.write_output(f'@{return_label}')
+        self.write_output('D=A')
+        if routine in self.shared_routines:
+            self.write_output(f'@{routine}')
+            self.write_output('0;JMP')
+        else:
+            self.shared_routines.add(routine)
+            write_routine()
+        self.write_output(f'({return_label})')
+        self.forget_slot_addresses()    # Shared routines may use R13.
 
-    def set_a_to_sp(self):
-        """Set the address (A) register to the stack pointer location (0)."""
+    def write_compare_routine(self, command):
+        """
+        Write the shared routine for a comparison. It is entered with the return address in D, replaces the top two
+        values of the stack with the Boolean result, and returns through R15.
+        """
+        self.write_output(f'(__VM_{command.upper()})')
+        self.write_output('@R15')
+        self.write_output('M=D')
+        self.write_output('@SP')
+        self.write_output('AM=M-1')
+        self.write_output('D=M')
+        self.write_output('A=A-1')
+        self.write_output('D=M-D')
+        self.write_output('M=-1')  # -1 is True
+        self.write_output(f'@__VM_{command.upper()}_END')
+        self.write_output(f'D;{COMPARISON_JUMPS[command]}')
         self.write_output('@SP')
+        self.write_output('A=M-1')
+        self.write_output('M=0')  # 0 is False
+        self.write_output(f'(__VM_{command.upper()}_END)')
+        self.write_output('@R15')
         self.write_output('A=M')
+        self.write_output('0;JMP')
 
-    def pop_d(self):
-        """Pop the top of the stack into the D register."""
-        # if config.WRITE_ASM_COMMENTS:
-        #     self.write_output('\t// pop_d')
-        self.set_a_to_sp()
-        self.write_output('A=A-1')
-        self.write_output('D=M')
-        self.dec_SP()
+    def write_logical_shared(self, command):
+        """
+        Write an XVM logical command in code optimized for size, with calls to the shared routine that makes the top of
+        the stack a Boolean (see write_bool_routine). Once its operands are Booleans (0 or -1), l-not and l-and are just
+        not and and, and l-or is a bool of the or of its operands.
 
-    def push_d(self):
+        Arguments:
+            command: One of bool, l-not, l-and, and l-or.
+        """
+        if config.WRITE_ASM_COMMENTS:
+            self.write_output(f'\n// {command}')
+        def call_bool():
+            self.write_shared_call('__VM_BOOL', self.write_bool_routine)
+
+        if command == 'l-and':
+            call_bool()
+            self.pop_d_to_top()
+            self.write_output('M=D&M')
+        elif command == 'l-or':
+            self.pop_d_to_top()
+            self.write_output('M=D|M')
+        call_bool()
+        if command == 'l-not':
+            self.set_a_to_top()
+            self.write_output('M=!M')
+
+    def write_bool_routine(self):
+        """
+        Write the shared routine for bool. It is entered with the return address in D, replaces a non-zero value on top
+        of the stack with -1 (true), and returns through R15.
+        """
+        self.write_output('(__VM_BOOL)')
+        self.write_output('@R15')
+        self.write_output('M=D')
+        self.write_output('@SP')
+        self.write_output('A=M-1')
+        self.write_output('D=M')
+        self.write_output('@__VM_BOOL_END')
+        self.write_output('D;JEQ')
+        self.write_output('@SP')
+        self.write_output('A=M-1')
+        self.write_output('M=-1')   # -1 is True
+        self.write_output('(__VM_BOOL_END)')
+        self.write_output('@R15')
+        self.write_output('A=M')
+        self.write_output('0;JMP')
+
+    def write_multiply_routine(self):
+        """
+        Write the shared routine for mult. It is entered with the return address in D, replaces the top two values
+        of the stack (x and y) with x * y, and returns through R15. It adds up x shifted left by each set bit of y (of
+        -y for a negative y, with x negated too), and stops after the highest set bit.
+        """
+        self.write_output('(__VM_MULT)')
+        self.write_output('@R15')
+        self.write_output('M=D')
+        self.write_output('@SP')
+        self.write_output('AM=M-1')
+        self.write_output('D=M')    # y
+        self.write_output('@__VM_MULT_POSITIVE')
+        self.write_output('D;JGE')
+        self.write_output('@SP')
+        self.write_output('A=M')
+        self.write_output('M=-M')
+        self.write_output('A=A-1')
+        self.write_output('M=-M')
+        self.write_output('(__VM_MULT_POSITIVE)')
+        self.write_output('@SP')
+        self.write_output('A=M')
+        self.write_output('D=M')
+        self.write_output('@R14')   # R14: the bits of y still to add
+        self.write_output('M=D')
+        self.write_output('@SP')
+        self.write_output('A=M-1')
+        self.write_output('D=M')
+        self.write_output('@R13')   # R13: x shifted left to the current bit
+        self.write_output('M=D')
+        self.write_output('@SP')
+        self.write_output('A=M-1')
+        self.write_output('M=0')    # The product builds up in x's place on the stack.
+        self.write_output('@SP')
+        self.write_output('A=M')
+        self.write_output('M=1')    # The current bit, in y's old place.
+        self.write_output('(__VM_MULT_LOOP)')
+        self.write_output('@R14')
+        self.write_output('D=M')
+        self.write_output('@__VM_MULT_END')
+        self.write_output('D;JEQ')
+        self.write_output('@SP')
+        self.write_output('A=M')
+        self.write_output('D=M')
+        self.write_output('@R14')
+        self.write_output('D=D&M')
+        self.write_output('@__VM_MULT_NEXT')
+        self.write_output('D;JEQ')
+        self.write_output('@R14')
+        self.write_output('M=M-D')
+        self.write_output('@R13')
+        self.write_output('D=M')
+        self.write_output('@SP')
+        self.write_output('A=M-1')
+        self.write_output('M=D+M')
+        self.write_output('(__VM_MULT_NEXT)')
+        self.write_output('@R13')
+        self.write_output('D=M')
+        self.write_output('M=D+M')
+        self.write_output('@SP')
+        self.write_output('A=M')
+        self.write_output('D=M')
+        self.write_output('M=D+M')
+        self.write_output('@__VM_MULT_LOOP')
+        self.write_output('0;JMP')
+        self.write_output('(__VM_MULT_END)')
+        self.write_output('@R15')
+        self.write_output('A=M')
+        self.write_output('0;JMP')
+
+    def write_divide_routine(self):
+        """
+        Write the shared routine for div and mod. It is entered with the return address in D, replaces the top two
+        values of the stack (x and y) with x / y rounded towards zero, leaves the remainder (which has the sign of x) in
+        R13, and returns through R15. It does binary long division of |x| by |y|, starting from the highest set bit of
+        |x|. Dividing by zero gives 0, with x as the remainder.
+
+        While it runs, the slots above the stack hold |x| as it is shifted out (at SP), the number of bits left (SP+1),
+        x (SP+2), and y (SP+3).
+        """
+        self.write_output('(__VM_DIVMOD)')
+        self.write_output('@R15')
+        self.write_output('M=D')
+        self.write_output('@SP')
+        self.write_output('AM=M-1')
+        self.write_output('D=M')    # y
+        self.write_output('@R14')   # R14: |y|
+        self.write_output('M=D')
+        self.write_output('@__VM_DIVMOD_Y_POSITIVE')
+        self.write_output('D;JGE')
+        self.write_output('@R14')
+        self.write_output('M=-M')
+        self.write_output('(__VM_DIVMOD_Y_POSITIVE)')
+        self.write_output('@SP')
+        self.write_output('A=M+1')
+        self.write_output('A=A+1')
+        self.write_output('A=A+1')
+        self.write_output('M=D')
+        self.write_output('@SP')
+        self.write_output('A=M-1')
+        self.write_output('D=M')    # x
+        self.write_output('M=0')    # The quotient builds up in x's place on the stack.
+        self.write_output('@SP')
+        self.write_output('A=M+1')
+        self.write_output('A=A+1')
+        self.write_output('M=D')
+        self.write_output('@SP')
+        self.write_output('A=M')
+        self.write_output('M=D')
+        self.write_output('@__VM_DIVMOD_X_POSITIVE')
+        self.write_output('D;JGE')
+        self.write_output('@SP')
+        self.write_output('A=M')
+        self.write_output('M=-M')
+        self.write_output('(__VM_DIVMOD_X_POSITIVE)')
+        self.write_output('@R13')   # R13: the remainder
+        self.write_output('M=0')
+        self.write_output('@R14')
+        self.write_output('D=M')
+        self.write_output('@__VM_DIVMOD_BY_NONZERO')
+        self.write_output('D;JNE')
+        self.write_output('@SP')
+        self.write_output('A=M')
+        self.write_output('D=M')
+        self.write_output('@R13')
+        self.write_output('M=D')
+        self.write_output('@__VM_DIVMOD_SIGNS')
+        self.write_output('0;JMP')
+        self.write_output('(__VM_DIVMOD_BY_NONZERO)')
+        self.write_output('@16')
+        self.write_output('D=A')
+        self.write_output('@SP')
+        self.write_output('A=M+1')
+        self.write_output('M=D')
+        # Skip the leading zero bits of |x|; |x| = 0 is done already.
+        self.write_output('(__VM_DIVMOD_SKIP)')
+        self.write_output('@SP')
+        self.write_output('A=M')
+        self.write_output('D=M')
+        self.write_output('@__VM_DIVMOD_LOOP')
+        self.write_output('D;JLT')
+        self.write_output('@__VM_DIVMOD_SIGNS')
+        self.write_output('D;JEQ')
+        self.write_output('@SP')
+        self.write_output('A=M')
+        self.write_output('M=D+M')
+        self.write_output('A=A+1')
+        self.write_output('M=M-1')
+        self.write_output('@__VM_DIVMOD_SKIP')
+        self.write_output('0;JMP')
+        # Shift the next bit of |x| into the remainder, and subtract |y| from it if it fits.
+        self.write_output('(__VM_DIVMOD_LOOP)')
+        self.write_output('@R13')
+        self.write_output('D=M')
+        self.write_output('M=D+M')
+        self.write_output('@SP')
+        self.write_output('A=M')
+        self.write_output('D=M')
+        self.write_output('M=D+M')
+        self.write_output('@__VM_DIVMOD_BIT_ZERO')
+        self.write_output('D;JGE')
+        self.write_output('@R13')
+        self.write_output('M=M+1')
+        self.write_output('(__VM_DIVMOD_BIT_ZERO)')
+        self.write_output('@SP')
+        self.write_output('A=M-1')
+        self.write_output('D=M')
+        self.write_output('M=D+M')
+        self.write_output('@R14')
+        self.write_output('D=M')
+        self.write_output('@R13')
+        self.write_output('D=M-D')
+        self.write_output('@__VM_DIVMOD_NEXT')
+        self.write_output('D;JLT')
+        self.write_output('@R13')
+        self.write_output('M=D')
+        self.write_output('@SP')
+        self.write_output('A=M-1')
+        self.write_output('M=M+1')
+        self.write_output('(__VM_DIVMOD_NEXT)')
+        self.write_output('@SP')
+        self.write_output('A=M+1')
+        self.write_output('MD=M-1')
+        self.write_output('@__VM_DIVMOD_LOOP')
+        self.write_output('D;JGT')
+        # The quotient is negative if one of x and y is, and the remainder if x is.
+        self.write_output('(__VM_DIVMOD_SIGNS)')
+        self.write_output('@SP')
+        self.write_output('A=M+1')
+        self.write_output('A=A+1')
+        self.write_output('D=M')
+        self.write_output('@__VM_DIVMOD_X_WAS_POSITIVE')
+        self.write_output('D;JGE')
+        self.write_output('@R13')
+        self.write_output('M=-M')
+        self.write_output('@SP')
+        self.write_output('A=M-1')
+        self.write_output('M=-M')
+        self.write_output('(__VM_DIVMOD_X_WAS_POSITIVE)')
+        self.write_output('@SP')
+        self.write_output('A=M+1')
+        self.write_output('A=A+1')
+        self.write_output('A=A+1')
+        self.write_output('D=M')
+        self.write_output('@__VM_DIVMOD_END')
+        self.write_output('D;JGE')
+        self.write_output('@SP')
+        self.write_output('A=M-1')
+        self.write_output('M=-M')
+        self.write_output('(__VM_DIVMOD_END)')
+        self.write_output('@R15')
+        self.write_output('A=M')
+        self.write_output('0;JMP')
+
+    def write_shift_count_jump(self, routine):
+        """
+        Write the start of a shift routine: save the return address (in D) in R15, pop the shift count, and jump to
+        <routine>_OUT if it is 16 or more (as an unsigned number). Otherwise, leave in R13 the address to jump to in the
+        routine's table of 15 doublings of D ('A=D / D=D+A', starting at <routine>_DOUBLINGS) to double D count times.
+        """
+        self.write_output(f'({routine})')
+        self.write_output('@R15')
+        self.write_output('M=D')
+        self.write_output('@SP')
+        self.write_output('AM=M-1')
+        self.write_output('D=M')
+        self.write_output(f'@{routine}_OUT')
+        self.write_output('D;JLT')
+        self.write_output('@15')
+        self.write_output('D=D-A')
+        self.write_output(f'@{routine}_OUT')
+        self.write_output('D;JGT')
+        self.write_output('@R13')
+        self.write_output('M=D')
+        self.write_output('D=D+M')  # 2 * count - 30
+        self.write_output(f'@{routine}_DOUBLINGS')
+        self.write_output('D=A-D')
+        self.write_output('@R13')
+        self.write_output('M=D')
+
+    def write_doublings(self, routine):
+        """Write the table of 15 doublings of D of a shift routine, which is entered through R13."""
+        self.write_output(f'({routine}_DOUBLINGS)')
+        for _ in range(15):
+            self.write_output('A=D')
+            self.write_output('D=D+A')
+
+    def write_shift_left_routine(self):
+        """
+        Write the shared routine for shl. It is entered with the return address in D, replaces the top two values of
+        the stack (x and a count) with x shifted left count bits, and returns through R15. A count of 16 or more
+        (unsigned) shifts out every bit.
+        """
+        self.write_shift_count_jump('__VM_SHL')
+        self.write_output('@SP')
+        self.write_output('A=M-1')
+        self.write_output('D=M')
+        self.write_output('@R13')
+        self.write_output('A=M')
+        self.write_output('0;JMP')
+        self.write_doublings('__VM_SHL')
+        self.write_output('@SP')
+        self.write_output('A=M-1')
+        self.write_output('M=D')
+        self.write_output('@R15')
+        self.write_output('A=M')
+        self.write_output('0;JMP')
+        self.write_output('(__VM_SHL_OUT)')
+        self.write_output('@SP')
+        self.write_output('A=M-1')
+        self.write_output('M=0')
+        self.write_output('@R15')
+        self.write_output('A=M')
+        self.write_output('0;JMP')
+
+    def write_shift_right_routine(self):
+        """
+        Write the shared routine for shr, an arithmetic (sign-extending) shift. It is entered with the return address
+        in D, replaces the top two values of the stack (x and a count) with x shifted right count bits, and returns
+        through R15. A count of 16 or more (unsigned) shifts out every bit, leaving 0 or -1.
+
+        It copies the bits of x from bit count upwards to the result from bit 0 upwards, which builds up in the
+        count's old place on the stack, and then fills the bits above them with the sign of x.
+        """
+        self.write_shift_count_jump('__VM_SHR')
+        self.write_output('D=1')
+        self.write_output('@R13')
+        self.write_output('A=M')
+        self.write_output('0;JMP')
+        self.write_doublings('__VM_SHR')
+        self.write_output('@R13')   # R13: the bit of x to copy (1 << count)
+        self.write_output('M=D')
+        self.write_output('@R14')   # R14: the bit of the result to copy it to
+        self.write_output('M=1')
+        self.write_output('@SP')
+        self.write_output('A=M')
+        self.write_output('M=0')
+        self.write_output('(__VM_SHR_LOOP)')
+        self.write_output('@SP')
+        self.write_output('A=M-1')
+        self.write_output('D=M')
+        self.write_output('@R13')
+        self.write_output('D=D&M')
+        self.write_output('@__VM_SHR_NEXT')
+        self.write_output('D;JEQ')
+        self.write_output('@R14')
+        self.write_output('D=M')
+        self.write_output('@SP')
+        self.write_output('A=M')
+        self.write_output('M=D|M')
+        self.write_output('(__VM_SHR_NEXT)')
+        self.write_output('@R14')
+        self.write_output('D=M')
+        self.write_output('M=D+M')
+        self.write_output('@R13')
+        self.write_output('D=M')
+        self.write_output('MD=D+M')
+        self.write_output('@__VM_SHR_LOOP')
+        self.write_output('D;JNE')
+        # Fill the bits from R14 upwards with the sign of x.
+        self.write_output('(__VM_SHR_SIGN)')
+        self.write_output('@SP')
+        self.write_output('A=M-1')
+        self.write_output('D=M')
+        self.write_output('@__VM_SHR_END')
+        self.write_output('D;JGE')
+        self.write_output('@R14')
+        self.write_output('D=-M')
+        self.write_output('@SP')
+        self.write_output('A=M')
+        self.write_output('M=D|M')
+        self.write_output('(__VM_SHR_END)')
+        self.write_output('@SP')
+        self.write_output('A=M')
+        self.write_output('D=M')
+        self.write_output('A=A-1')
+        self.write_output('M=D')
+        self.write_output('@R15')
+        self.write_output('A=M')
+        self.write_output('0;JMP')
+        self.write_output('(__VM_SHR_OUT)')
+        self.write_output('@SP')
+        self.write_output('A=M')
+        self.write_output('M=0')
+        self.write_output('@R14')
+        self.write_output('M=1')
+        self.write_output('@__VM_SHR_SIGN')
+        self.write_output('0;JMP')
+
+    # ************************************************************************************
+    # **** Templates *****
+
+    def write_template(self, command, segment, index):
+        """
+        Write the translation of an arithmetic, push, or pop command from its template. The first time a command is
+        seen, the template method for its (command, segment) in the dispatch table renders its block of instructions,
+        which is cached; later uses of the same command write the cached block, only filling in new unique labels.
+
+        Arguments:
+            command: The arithmetic command (like 'add'), or C_PUSH or C_POP.
+            segment: The segment pushed or popped, or None for an arithmetic command.
+            index: The index in the segment, or None for an arithmetic command.
+        """
+        # Statics are named after their file, and the templates differ between optimization settings.
+        uses_statics = segment == 'static' or isinstance(index, tuple) and 'static' in index
+        key = (command, segment, index, self.optimize_for, self.current_input_file if uses_statics else None,
+               self.sp_offset, self.r13_slot, self.d_slot)
+        block = self.template_cache.get(key)
+        if block is None:
+            block = self.render_template(command, segment, index)
+            self.template_cache[key] = block
+
+        text, lines, num_instructions, label_kinds, self.sp_offset, self.r13_slot, self.d_slot = block
+        if label_kinds:
+            labels = [self.new_label(kind) for kind in label_kinds]
+            text = text.format(*labels)
+            lines = text.split('\n')
+        self.write_block(text, lines, num_instructions)
+
+    def render_template(self, command, segment, index):
+        """
+        Run the template method of a command, recording the lines it writes instead of writing them. Return the
+        (text, lines, number of instructions, kinds of the labels, and SP offset and known slot addresses at the end)
+        of the block, where the text and lines use placeholders like {0} for the labels.
+        """
+        self.rendering, self.rendering_labels = [], []
+        try:
+            if config.WRITE_ASM_COMMENTS:
+                self.write_output('\n// ' + self.template_comment(command, segment, index))
+            self.templates[(command, segment)](command, segment, index)
+            lines, label_kinds = self.rendering, self.rendering_labels
+        finally:
+            self.rendering, self.rendering_labels = None, None
+
+        num_instructions = sum(1 for line in lines if line[0] not in '(\n/')
+        return '\n'.join(lines), lines, num_instructions, label_kinds, self.sp_offset, self.r13_slot, self.d_slot
+
+    @staticmethod
+    def template_comment(command, segment, index):
+        """Return the VM command(s) that a template translates, for the comment above its code."""
+        if segment is None:
+            return command
+        elif command in MATH_ROUTINES:
+            return f'push {segment} {index} / {command}'
+        elif command == 'update':
+            slot, delta = index
+            return (f'push {segment} {slot} / push constant {abs(delta)} / {"add" if delta > 0 else "sub"} / '
+                    f'pop {segment} {slot}')
+        elif command == 'move':
+            source, destination_segment, destination = index
+            return f'push {segment} {source} / pop {destination_segment} {destination}'
+        return f'{command[2:].lower()} {segment} {index}'
+
+    def new_label(self, kind):
+        """
+        Return a new unique label, numbered within the current function. While a template is being rendered, return a
+        placeholder for the label instead.
+        """
+        if self.rendering_labels is not None:
+            self.rendering_labels.append(kind)
+            return '{' + str(len(self.rendering_labels) - 1) + '}'
+
+        label = f'{self.current_function}' + ':' + f'{self.label_index}'
+        self.label_index += 1
+        return label
+
+    def direct_address(self, segment, index):
+        """Return the address (or symbol) of a segment that is mapped directly onto RAM: pointer, temp, static, or
+        ram."""
+        if segment == 'static':
+            address = self.static_addresses.get((self.current_input_file, index))
+            return str(address) if address is not None else self.current_input_file + '.' + str(index)
+        return str(self.addresses.get(segment, 0) + index)
+
+    def write_binary(self, command, segment, index):
+        """Template for add, sub, and, and or."""
+        self.pop_d()
+        self.write_output('@R14')
+        self.write_output('M=D')
+        self.pop_d()
+        self.write_output('@R14')
+        self.write_output(f'D=D{BINARY_OPERATORS[command]}M')
+        self.push_d()
+
+    def write_unary(self, command, segment, index):
+        """Template for neg and not."""
+        self.pop_d()
+        self.write_output(f'D={UNARY_OPERATORS[command]}D')
+        self.push_d()
+
+    def write_bool(self, command, segment, index):
+        """Template for bool: 0 stays 0, and any other value becomes -1 (true)."""
+        end_label = self.new_label('local')
+        self.set_a_to_top()
+        self.write_output('D=M')
+        self.write_output(f'@{end_label}')
+        self.write_output('D;JEQ')
+        self.set_a_to_top()
+        self.write_output('M=-1')
+        self.write_output(f'({end_label})')
+
+    def write_logical_not(self, command, segment, index):
+        """Template for l-not: 0 becomes -1 (true), and any other value becomes 0."""
+        end_label = self.new_label('local')
+        self.set_a_to_top()
+        self.write_output('D=M')
+        self.write_output('M=-1')
+        self.write_output(f'@{end_label}')
+        self.write_output('D;JEQ')
+        self.set_a_to_top()
+        self.write_output('M=0')
+        self.write_output(f'({end_label})')
+
+    def write_logical_binary(self, command, segment, index):
+        """Template for l-and, l-or, and l-xor, which take any non-zero value as true."""
+        end_label = self.new_label('local')
+        self.pop_d_to_top()     # D = y, and A points to x.
+        if command == 'l-and':
+            # Both jumps to the end leave D = 0 (false).
+            self.write_output(f'@{end_label}')
+            self.write_output('D;JEQ')
+            self.set_a_to_top()
+            self.write_output('D=M')
+            self.write_output(f'@{end_label}')
+            self.write_output('D;JEQ')
+            self.write_output('D=-1')
+            self.write_output(f'({end_label})')
+            self.set_a_to_top()
+            self.write_output('M=D')
+            return
+        if command == 'l-or':
+            # x or y is true when any bit of either is set.
+            self.write_output('D=D|M')
+            self.write_output('M=-1')
+            self.write_output(f'@{end_label}')
+            self.write_output('D;JNE')
+            self.set_a_to_top()
+            self.write_output('M=0')
+        else:
+            # x xor y is l-not x when y is true, and bool x when it isn't.
+            y_false_label = self.new_label('local')
+            self.write_output(f'@{y_false_label}')
+            self.write_output('D;JEQ')
+            self.set_a_to_top()
+            self.write_output('D=M')
+            self.write_output('M=-1')
+            self.write_output(f'@{end_label}')
+            self.write_output('D;JEQ')
+            self.set_a_to_top()
+            self.write_output('M=0')
+            self.write_output(f'@{end_label}')
+            self.write_output('0;JMP')
+            self.write_output(f'({y_false_label})')
+            self.set_a_to_top()
+            self.write_output('D=M')
+            self.write_output(f'@{end_label}')
+            self.write_output('D;JEQ')
+            self.set_a_to_top()
+            self.write_output('M=-1')
+        self.write_output(f'({end_label})')
+
+    def write_comparison(self, command, segment, index):
+        """Template for eq, gt, lt, le, ge, and ne. Each boolean operator takes 23 lines. Could be as low as 9."""
+        self.pop_d()
+        self.write_output('@R14')
+        self.write_output('M=D')
+        self.pop_d()
+        self.write_output('@R14')
+        self.write_output('D=D-M')
+
+        true_label = self.new_label('local')
+        false_label = self.new_label('local')
+        self.write_output(f'@{true_label}')
+        self.write_output(f'D;{COMPARISON_JUMPS[command]}')
+
+        self.write_output('D=0')  # 0 is False
+        self.write_output(f'@{false_label}')
+        self.write_output('0;JMP')
+
+        self.write_output(f'({true_label})')
+        self.write_output('D=-1')  # -1 is True
+
+        self.write_output(f'({false_label})')
+        self.push_d()
+
+    def write_math_by_constant(self, command, segment, index):
+        """Template for 'push constant index' followed by mult, div, mod, shl, or shr (see can_fold_constant)."""
+        self.pop_d()
+        if command == 'mod' and index > 1:
+            # The remainder has the sign of x: mask the low bits of |x|.
+            positive_label = self.new_label('local')
+            end_label = self.new_label('local')
+            self.write_output(f'@{positive_label}')
+            self.write_output('D;JGE')
+            self.write_output('D=-D')
+            self.write_output(f'@{index - 1}')
+            self.write_output('D=D&A')
+            self.write_output('D=-D')
+            self.write_output(f'@{end_label}')
+            self.write_output('0;JMP')
+            self.write_output(f'({positive_label})')
+            self.write_output(f'@{index - 1}')
+            self.write_output('D=D&A')
+            self.write_output(f'({end_label})')
+        elif command == 'shr':
+            # Shifting every bit out leaves only the sign: 0 or -1.
+            negative_label = self.new_label('local')
+            end_label = self.new_label('local')
+            self.write_output(f'@{negative_label}')
+            self.write_output('D;JLT')
+            self.write_output('D=0')
+            self.write_output(f'@{end_label}')
+            self.write_output('0;JMP')
+            self.write_output(f'({negative_label})')
+            self.write_output('D=-1')
+            self.write_output(f'({end_label})')
+        elif command == 'mod' or index == 0 or command == 'shl' and index >= 16:
+            # x % 1, x * 0, and shifting every bit out left are 0.
+            self.write_output('D=0')
+        else:
+            # A multiply by a power of two, or a shift left, by doubling.
+            for _ in range(index.bit_length() - 1 if command == 'mult' else index):
+                self.write_output('A=D')
+                self.write_output('D=D+A')
+        self.push_d()
+
+    def slot_address(self, segment, index):
+        """
+        Return the instructions that set A to the address of a segment slot without changing D: one for a direct
+        segment, and a few for an indirect one at a small index. Return None if that would take D as well.
+        """
+        if segment in DIRECT_SEGMENTS:
+            return ['@' + self.direct_address(segment, index)]
+        if index <= 2:
+            return ['@' + self.addresses[segment], 'A=M'] + ['A=A+1'] * index
+        return None
+
+    def note_slot_write(self, segment, index, value_in_d):
+        """
+        Note that a segment slot was just written. A write to pointer (or to ram, which can be anywhere) may have moved
+        a segment base or changed R13, so the address in R13 is forgotten; and after a write to pointer in optimized
+        code, a value that is still in D is the new base of this or that.
+        """
+        if segment in ['pointer', 'ram']:
+            self.r13_slot = None
+            if segment == 'pointer' and value_in_d and self.optimize_for is not None:
+                self.d_slot = (['this', 'that'][index], 0)
+
+    def r13_step(self, segment, index):
+        """
+        Return the instructions that set A to the address of an indirect segment slot, and R13 too, by stepping from the
+        address of a slot of the same segment up to 2 away that is already in R13. Return None if there is none.
+        """
+        if self.r13_slot is None or self.r13_slot[0] != segment or abs(index - self.r13_slot[1]) > 2:
+            return None
+        distance = index - self.r13_slot[1]
+        step = 'M+1' if distance > 0 else 'M-1'
+        if distance == 0:
+            return ['@R13', 'A=M']
+        return ['@R13'] + [f'M={step}'] * (abs(distance) - 1) + [f'AM={step}']
+
+    def save_slot_address(self, segment, index):
+        """Write the instructions that save the address of an indirect segment slot in R13. Return the instructions
+        that then set A to it."""
+        self.write_output('@' + str(index))
+        self.write_output('D=A')
+        self.write_output('@' + self.addresses[segment])
+        self.write_output('D=D+M')
+        self.write_output('@R13')
+        self.write_output('M=D')
+        return ['@R13', 'A=M']
+
+    def write_fused_update(self, command, segment, index):
+        """Template for 'push x / push constant k / add or sub / pop x', which updates x in place."""
+        slot, delta = index
+        address = self.slot_address(segment, slot)
+        if address is None:
+            address = self.save_slot_address(segment, slot)
+
+        if abs(delta) <= 2:
+            for line in address:
+                self.write_output(line)
+            for _ in range(abs(delta)):
+                self.write_output('M=M+1' if delta > 0 else 'M=M-1')
+        else:
+            self.write_output(f'@{abs(delta)}')
+            self.write_output('D=A')
+            for line in address:
+                self.write_output(line)
+            self.write_output('M=D+M' if delta > 0 else 'M=M-D')
+        self.note_slot_write(segment, slot, False)
+
+    def write_fused_move(self, command, segment, index):
+        """Template for 'push x / pop y', which copies x to y in D instead of through the stack."""
+        source, destination_segment, destination = index
+        # The address of y is worked out first if it needs D.
+        address = self.slot_address(destination_segment, destination)
+        if address is None:
+            address = self.save_slot_address(destination_segment, destination)
+
+        if segment == 'constant':
+            if source <= 1:
+                self.write_output(f'D={source}')
+            else:
+                self.write_output(f'@{source}')
+                self.write_output('D=A')
+        else:
+            source_address = self.slot_address(segment, source)
+            if source_address is None:
+                self.write_output('@' + self.addresses[segment])
+                self.write_output('D=M')
+                self.write_output(f'@{source}')
+                source_address = ['A=D+A']
+            for line in source_address:
+                self.write_output(line)
+            self.write_output('D=M')
+
+        for line in address:
+            self.write_output(line)
+        self.write_output('M=D')
+        self.note_slot_write(destination_segment, destination, True)
+
+    def write_push_constant(self, command, segment, index):
+        """Template for push constant."""
+        self.write_output('@' + str(index))
+        self.write_output('D=A')
+        self.push_d()
+
+    def write_push_direct(self, command, segment, index):
+        """Template for pushing from the pointer, temp, static, and ram segments."""
+        address = self.direct_address(segment, index)
+        if address == '0':
+            self.flush_sp()     # RAM[0] is SP itself, so it has to be up to date.
+        self.write_output('@' + address)
+        self.write_output('D=M')
+        self.push_d()
+
+    def write_push_indirect(self, command, segment, index):
+        """Template for pushing from the indirect-indexed segments: local, argument, this, and that."""
+        if self.optimize_for is not None:
+            # Address the slot from its segment base, or step from a known address, whichever is shortest.
+            if self.d_slot == (segment, 0):
+                address = ['A=D'] if index == 0 else [f'@{index}', 'A=D+A']
+            elif index <= 2:
+                address = ['@' + self.addresses[segment], 'A=M'] + ['A=A+1'] * index
+            else:
+                address = [f'@{index}', 'D=A', '@' + self.addresses[segment], 'A=D+M']
+            step = self.r13_step(segment, index)
+            for line in step if step is not None and len(step) < len(address) else address:
+                self.write_output(line)
+            if step is not None and len(step) < len(address):
+                self.r13_slot = (segment, index)
+            self.write_output('D=M')
+            self.push_d()
+            return
+
+        self.write_output("@" + str(index))
+        self.write_output("D=A")
+        self.write_output("@" + str(self.addresses[segment]))
+        self.write_output("A=M")
+        self.write_output("D=D+A")
+        self.write_output("@R13")
+        self.write_output("M=D")
+        self.write_output("@R13")
+        self.write_output("A=M")
+        self.write_output("D=M")
+        self.push_d()
+
+    def write_pop_constant(self, command, segment, index):
+        """Template for popping to the constant segment, which just removes the value on top of the stack."""
+        self.pop_d()
+
+    def write_pop_direct(self, command, segment, index):
+        """Template for popping to the pointer, temp, static, and ram segments."""
+        address = self.direct_address(segment, index)
+        self.pop_d()
+        if address == '0':
+            self.flush_sp()     # RAM[0] is SP itself, so it has to be up to date before it is set.
+        self.write_output('@' + address)
+        self.write_output('M=D')
+        self.note_slot_write(segment, index, True)
+
+    def write_pop_indirect(self, command, segment, index):
+        """Template for popping to the indirect-indexed segments: local, argument, this, and that."""
+        if self.optimize_for is not None:
+            # A slot at a small index is addressed from its base after the pop, and a slot near the one whose address
+            # is in R13 by stepping R13. Otherwise its address is worked out in R13 before the pop, which leaves it
+            # there for the next access.
+            step = self.r13_step(segment, index)
+            if step is not None and (index > 2 or len(step) < 2 + index):
+                self.pop_d()
+                for line in step:
+                    self.write_output(line)
+                self.r13_slot = (segment, index)
+            elif index <= 2:
+                self.pop_d()
+                self.write_output('@' + self.addresses[segment])
+                self.write_output('A=M')
+                for _ in range(index):
+                    self.write_output('A=A+1')
+            else:
+                if self.d_slot == (segment, 0):
+                    self.write_output(f'@{index}')
+                    self.write_output('D=D+A')
+                    self.write_output('@R13')
+                    self.write_output('M=D')
+                else:
+                    self.save_slot_address(segment, index)
+                self.pop_d()
+                self.write_output('@R13')
+                self.write_output('A=M')
+                self.r13_slot = (segment, index)
+            self.write_output('M=D')
+            return
+
+        self.pop_d()
+        self.write_output("@R14")
+        self.write_output("M=D")
+        self.write_output("@" + str(index))
+        self.write_output("D=A")
+        self.write_output("@" + str(self.addresses[segment]))
+        self.write_output("A=M")
+        self.write_output("D=D+A")
+        self.write_output("@R13")
+        self.write_output("M=D")
+        self.write_output("@R14")
+        self.write_output("D=M")
+        self.write_output("@R13")
+        self.write_output("A=M")
+        self.write_output("M=D")
+
+    # ************************************************************************************
+    # **** ASM code-writing methods *****
+
+    def inc_SP(self):
+        """Write ASM code to increment the stack pointer."""
+        self.flush_sp()
+        self.write_output('@SP')
+        self.write_output('M=M+1')
+
+    def dec_SP(self):
+        """Write ASM code to decrement the stack pointer."""
+        self.flush_sp()
+        self.write_output('@SP')
+        self.write_output('M=M-1')
+
+    def set_a_to_sp(self):
+        """Set the address (A) register to the stack pointer location (0)."""
+        self.flush_sp()
+        self.write_output('@SP')
+        self.write_output('A=M')
+
+    def forget_slot_addresses(self):
+        """Forget which slot addresses are in R13 and D, at the start of a basic block or where R13 may change."""
+        self.r13_slot = None
+        self.d_slot = None
+
+    def flush_sp(self):
+        """Bring SP in RAM up to date with any pushes and pops deferred by push_d and pop_d. Leaves D unchanged."""
+        if self.sp_offset:
+            self.write_output('@SP')
+            for _ in range(abs(self.sp_offset)):
+                self.write_output('M=M+1' if self.sp_offset > 0 else 'M=M-1')
+            self.sp_offset = 0
+
+    def set_a_to_stack_slot(self, offset):
+        """Set the address (A) register to RAM[SP] + offset, for an offset of -1, 0, or 1."""
+        self.write_output('@SP')
+        self.write_output({-1: 'A=M-1', 0: 'A=M', 1: 'A=M+1'}[offset])
+
+    def pop_d(self):
+        """Pop the top of the stack into the D register."""
+        # if config.WRITE_ASM_COMMENTS:
+        #     self.write_output('\t// pop_d')
+        if config.DEFER_SP_UPDATES:
+            # The value popped is at RAM[SP] + offset - 1, which must be one that can be addressed directly.
+            if not 0 <= self.sp_offset <= 2:
+                self.flush_sp()
+            self.sp_offset -= 1
+            self.set_a_to_stack_slot(self.sp_offset)
+            self.write_output('D=M')
+            return
+        self.set_a_to_sp()
+        self.write_output('A=A-1')
+        self.write_output('D=M')
+        self.dec_SP()
+
+    def push_d(self):
         """Push the data from the D register onto the top of the stack."""
         # if config.WRITE_ASM_COMMENTS:
         #     self.write_output('\t// push_d')
+        if config.DEFER_SP_UPDATES:
+            # The value pushed goes to RAM[SP] + offset, which must be one that can be addressed directly.
+            if not -1 <= self.sp_offset <= 1:
+                self.flush_sp()
+            self.set_a_to_stack_slot(self.sp_offset)
+            self.write_output('M=D')
+            self.sp_offset += 1
+            return
         self.set_a_to_sp()  # Set SP to register A.
         self.write_output('M=D')
         self.inc_SP()  # Increment the stack pointer.
 
-    def bool(self):
-        """An XVM command that replaces the value on top of the stack with its Boolean equivalent. This means
-        replacing and non-zero value on top of the stack with a -1."""
-        self.write_output('D=0')
-        self.write_output('D=M-D')
-        # If the top of the stack = 0, skip the below and do nothing. Else, change the top of the stack to -1.
-        self.write_output(f'@BOOL{self.bool_label}')
-        self.write_output('D;JEQ')
+    def set_a_to_top(self):
+        """Set the address (A) register to the top of the stack. Only the first call in a template may flush SP, since
+        later calls can come after a branch."""
+        if config.DEFER_SP_UPDATES:
+            if not 0 <= self.sp_offset <= 2:
+                self.flush_sp()
+            self.set_a_to_stack_slot(self.sp_offset - 1)
+            return
         self.write_output('@SP')
-        self.write_output('A=M')
-        self.write_output('M=-1')
-        self.write_output(f'(BOOL{self.bool_label})')
-        self.bool_label += 1
+        self.write_output('A=M-1')
+
+    def pop_d_to_top(self):
+        """Pop the top of the stack into the D register, and set the address (A) register to the new top."""
+        if config.DEFER_SP_UPDATES:
+            self.pop_d()
+            self.set_a_to_top()
+            return
+        self.write_output('@SP')
+        self.write_output('AM=M-1')
+        self.write_output('D=M')
+        self.write_output('A=A-1')
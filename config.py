@@ -3,3 +3,16 @@ PRINT_ERRORS_TO_CONSOLE = True
 WRITE_ERRORS_TO_LOG = True
 GENERATE_HAL_ONLY = True        # Switch to generate only HAL, and not XHAL code.
 WRITE_ASM_COMMENTS = False      # Switch to generate comments in the ASM code that display corresponding VM commands.
+EMIT_HACK = False               # Switch to assemble the code in the translator and write a .hack file directly.
+WRITE_ASM = True                # With EMIT_HACK, switch to also write the .asm file (it is always written otherwise).
+WRITE_SOURCE_MAP = False        # Switch to write a side-car .map.json file mapping each ASM instruction to its VM line.
+OPTIMIZATION = None             # Templates to use: None for the plain ones, 'speed' (inlined/fused) or 'size' (shared).
+DEFER_SP_UPDATES = False        # Switch to address the stack relative to SP in basic blocks, updating SP once at exits.
+SIMPLIFY_CONTROL_FLOW = False   # Switch to thread jumps, drop jumps to the next label, and drop unreachable VM code.
+STATIC_LAYOUT = True            # Switch to write statics as RAM addresses planned for the whole program, not symbols.
+INSTRUMENTATION = None          # Translator self-instrumentation: None (off), 'json' (a report) or 'trace' (Chrome).
+SHARE_CALL_STUBS = False        # Switch to make calls jump to one shared stub per (callee, nArgs), as size mode does.
+ELIDE_FRAME_SAVES = False       # Switch to save only the THIS/THAT a callee may change, as optimized builds always do.
+ELIMINATE_DEAD_STORES = False   # Switch to discard pops to temp, local and pointer slots that are never read after them.
+PROFILE_FILE = None             # A profile recorded by pgo.py. If set, hot functions get 'speed' and the rest 'size'.
+HOT_CYCLE_FRACTION = 0.9        # With a profile, the hottest functions that together take this share of cycles are hot.
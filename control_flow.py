@@ -0,0 +1,191 @@
+"""
+The control_flow module simplifies the control flow of VM code before it is translated, one function at a time:
+
+    - Jump threading: a goto or if-goto to a label that only leads to another goto jumps straight to its final label.
+    - Branches over jumps: 'eq / if-goto A / goto B / label A' becomes 'ne / if-goto B / label A' (and so on for the
+      other comparisons), which saves the goto.
+    - Fallthrough: a goto to the very next label is dropped, and an if-goto to it only pops its condition.
+    - Unreachable code: the commands after a goto or return, up to the next label that is jumped to, are dropped, as
+      are labels that nothing jumps to (with deferred SP updates, every label costs an SP update).
+
+It also finds which locals of a function may be read before they are written, so the function's prologue only has to
+initialize those to 0.
+
+Function labels are left alone: they are jumped to by calls (and by fallthrough in programs without a Sys.vm), and
+like all labels they take up no ROM.
+"""
+from parser_module import VMCommand
+
+# The comparison that is true exactly when the given one is false.
+INVERTED_COMPARISONS = {'eq': 'ne', 'ne': 'eq', 'lt': 'ge', 'ge': 'lt', 'gt': 'le', 'le': 'gt'}
+
+JUMP_COMMANDS = ['C_GOTO', 'C_IF']
+
+
+def simplify_control_flow(commands):
+    """
+    Return a simplified copy of one .vm file's list of VMCommand records. Each function is simplified on its own; any
+    commands before the first function are left as they are, since they belong to the previous file's function.
+    """
+    simplified = []
+    function = []
+    for command in commands:
+        if command.type == 'C_FUNCTION' and function:
+            simplified += simplify_function(function) if function[0].type == 'C_FUNCTION' else function
+            function = []
+        function.append(command)
+    if function:
+        simplified += simplify_function(function) if function[0].type == 'C_FUNCTION' else function
+    return simplified
+
+
+def simplify_function(commands):
+    """Simplify the commands of one function (starting with its function command) until nothing more changes."""
+    changed = True
+    while changed:
+        commands, threaded = thread_jumps(commands)
+        commands, inverted = invert_branches_over_jumps(commands)
+        commands, fallen_through = remove_jumps_to_next(commands)
+        commands, removed = remove_unreachable_code(commands)
+        changed = threaded or inverted or fallen_through or removed
+    return commands
+
+
+def retarget(command, label):
+    """Return a copy of a goto or if-goto command that jumps to the given label instead."""
+    return command._replace(arg1=label, text=f'{command.text.split()[0]} {label}')
+
+
+def thread_jumps(commands):
+    """Make every jump to a label that is directly followed by a goto jump to where that goto ends up. Return the new
+    commands, and whether anything changed."""
+    # The label each label leads straight on to with a goto, if any.
+    forwards = {}
+    for command_idx, command in enumerate(commands):
+        if command.type == 'C_LABEL':
+            next_idx = command_idx + 1
+            while next_idx < len(commands) and commands[next_idx].type == 'C_LABEL':
+                next_idx += 1
+            if next_idx < len(commands) and commands[next_idx].type == 'C_GOTO':
+                forwards[command.arg1] = commands[next_idx].arg1
+
+    def final_label(label):
+        seen = {label}
+        while label in forwards and forwards[label] not in seen:
+            label = forwards[label]
+            seen.add(label)
+        return label
+
+    threaded = []
+    changed = False
+    for command in commands:
+        if command.type in JUMP_COMMANDS and final_label(command.arg1) != command.arg1:
+            command = retarget(command, final_label(command.arg1))
+            changed = True
+        threaded.append(command)
+    return threaded, changed
+
+
+def invert_branches_over_jumps(commands):
+    """Replace 'compare / if-goto A / goto B / label A' with 'inverted compare / if-goto B / label A'. Return the new
+    commands, and whether anything changed."""
+    inverted = []
+    changed = False
+    command_idx = 0
+    while command_idx < len(commands):
+        window = commands[command_idx:command_idx + 4]
+        if len(window) == 4 and window[0].type == 'C_ARITHMETIC' and window[0].arg1 in INVERTED_COMPARISONS and \
+                window[1].type == 'C_IF' and window[2].type == 'C_GOTO' and window[3].type == 'C_LABEL' and \
+                window[3].arg1 == window[1].arg1:
+            comparison = INVERTED_COMPARISONS[window[0].arg1]
+            inverted.append(window[0]._replace(arg1=comparison, text=comparison))
+            inverted.append(retarget(window[1], window[2].arg1))
+            inverted.append(window[3])
+            command_idx += 4
+            changed = True
+        else:
+            inverted.append(commands[command_idx])
+            command_idx += 1
+    return inverted, changed
+
+
+def remove_jumps_to_next(commands):
+    """Drop every goto to a label that directly follows it, and make every such if-goto only pop its condition.
+    Return the new commands, and whether anything changed."""
+    kept = []
+    changed = False
+    for command_idx, command in enumerate(commands):
+        if command.type in JUMP_COMMANDS:
+            next_idx = command_idx + 1
+            following_labels = set()
+            while next_idx < len(commands) and commands[next_idx].type == 'C_LABEL':
+                following_labels.add(commands[next_idx].arg1)
+                next_idx += 1
+            if command.arg1 in following_labels:
+                changed = True
+                if command.type == 'C_IF':
+                    kept.append(VMCommand('C_POP', 'constant', 0, command.line, 'pop constant 0'))
+                continue
+        kept.append(command)
+    return kept, changed
+
+
+def remove_unreachable_code(commands):
+    """Drop the commands that can't be reached: those after a goto or return up to the next label that is jumped to.
+    Labels that nothing jumps to are dropped too. Return the new commands, and whether anything changed."""
+    targets = {command.arg1 for command in commands if command.type in JUMP_COMMANDS}
+    kept = []
+    reachable = True
+    for command in commands:
+        if command.type == 'C_LABEL':
+            if command.arg1 not in targets:
+                continue
+            reachable = True
+        if not reachable:
+            continue
+        kept.append(command)
+        if command.type in ['C_GOTO', 'C_RETURN']:
+            reachable = False
+    return kept, len(kept) != len(commands)
+
+
+def locals_read_before_written(commands):
+    """
+    Return the set of the local variables of a function (given by its commands, starting with its function command)
+    that may be read before they are written, on some path through the function. Only those have to be initialized to
+    0; every other local is always popped to before it is pushed. A function that uses the ram segment could read its
+    locals through any address, so then every local counts as read.
+    """
+    num_locals = commands[0].arg2
+    if any(command.type in ['C_PUSH', 'C_POP'] and command.arg1 == 'ram' for command in commands):
+        return set(range(num_locals))
+
+    label_indexes = {command.arg1: command_idx for command_idx, command in enumerate(commands)
+                     if command.type == 'C_LABEL'}
+
+    # The locals written on every path to each command (None for a command not yet reached), found by propagating
+    # the written locals along the jumps and fallthroughs until nothing changes.
+    written = [None] * len(commands)
+    written[0] = frozenset()
+    work = [0]
+    while work:
+        command_idx = work.pop()
+        command = commands[command_idx]
+        written_after = written[command_idx]
+        if command.type == 'C_POP' and command.arg1 == 'local':
+            written_after = written_after | {command.arg2}
+
+        successors = []
+        if command.type in JUMP_COMMANDS and command.arg1 in label_indexes:
+            successors.append(label_indexes[command.arg1])
+        if command.type not in ['C_GOTO', 'C_RETURN'] and command_idx + 1 < len(commands):
+            successors.append(command_idx + 1)
+        for successor in successors:
+            merged = written_after if written[successor] is None else written[successor] & written_after
+            if merged != written[successor]:
+                written[successor] = merged
+                work.append(successor)
+
+    return {command.arg2 for command_idx, command in enumerate(commands)
+            if command.type == 'C_PUSH' and command.arg1 == 'local' and written[command_idx] is not None and
+            command.arg2 not in written[command_idx] and command.arg2 < num_locals}
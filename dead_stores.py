@@ -0,0 +1,145 @@
+"""
+The dead_stores module removes the stores of VM code that nothing reads, before it is translated, one function at a
+time. A pop to a temp, local, or pointer slot is dead when, on every path from it, the slot is written again (or, for
+a local or pointer, the function returns) before it is read. A dead pop still has to take its value off the stack, so
+it becomes 'pop constant 0', which only discards it, and the code writer turns a run of discards into one SP
+adjustment. A value pushed only to be discarded is not pushed at all.
+
+When a slot can be read:
+    - local: by a push of it. A function that uses the ram segment could read its locals through any address, so all
+      of its local stores are kept.
+    - pointer: by a push of it, by every access to this (pointer 0) or that (pointer 1), and by a call, whose callee
+      starts out with the caller's THIS and THAT. A return restores them from the frame, so they are dead there.
+    - temp: by a push of it, and by every call and return. The temp segment is shared by all functions, so the callee
+      or the caller may read what a function leaves there, and the test scripts check it (like the 'pop temp 0' that
+      NestedCall's Sys.main does just before it returns). So a store to a temp is only dead when the function itself
+      writes the temp again before any call or return, as in the 'pop temp 0' that drops the value of a void function
+      when an array assignment follows it.
+    - any of them: by 'push ram k' of its address.
+
+Code that can't reach a return (like the loop Sys.init halts in) keeps every slot live, since the final values of the
+temps and pointers are what the test scripts check.
+"""
+from control_flow import JUMP_COMMANDS
+from parser_module import VMCommand
+
+# The RAM address of each slot that the ram segment can reach directly.
+SLOT_ADDRESSES = {3: ('pointer', 0), 4: ('pointer', 1)}
+SLOT_ADDRESSES.update({5 + index: ('temp', index) for index in range(8)})
+
+TEMP_SLOTS = frozenset(('temp', index) for index in range(8))
+
+# The pointer slot that the this and that segments are addressed through.
+SEGMENT_POINTERS = {'this': ('pointer', 0), 'that': ('pointer', 1)}
+
+
+def eliminate_dead_stores(commands):
+    """
+    Return a copy of one .vm file's list of VMCommand records with its dead stores turned into discards. Each function
+    is done on its own; any commands before the first function are left as they are, since they belong to the previous
+    file's function.
+    """
+    eliminated = []
+    function = []
+    for command in commands:
+        if command.type == 'C_FUNCTION' and function:
+            eliminated += eliminate_function_dead_stores(function) if function[0].type == 'C_FUNCTION' else function
+            function = []
+        function.append(command)
+    if function:
+        eliminated += eliminate_function_dead_stores(function) if function[0].type == 'C_FUNCTION' else function
+    return eliminated
+
+
+def store_slot(command, uses_ram):
+    """Return the (segment, index) slot that the given command writes, if it is a pop that the analysis tracks."""
+    if command.type != 'C_POP':
+        return None
+    if command.arg1 in ['temp', 'pointer'] or command.arg1 == 'local' and not uses_ram:
+        return command.arg1, command.arg2
+    if command.arg1 == 'ram':
+        return SLOT_ADDRESSES.get(command.arg2)
+    return None
+
+
+def read_slots(command):
+    """Return the set of (segment, index) slots that the given command may read."""
+    if command.type == 'C_PUSH' and command.arg1 in ['temp', 'pointer', 'local']:
+        return {(command.arg1, command.arg2)}
+    elif command.type == 'C_PUSH' and command.arg1 == 'ram' and command.arg2 in SLOT_ADDRESSES:
+        return {SLOT_ADDRESSES[command.arg2]}
+    elif command.type in ['C_PUSH', 'C_POP'] and command.arg1 in SEGMENT_POINTERS:
+        return {SEGMENT_POINTERS[command.arg1]}
+    elif command.type == 'C_CALL':
+        return set(SEGMENT_POINTERS.values()) | TEMP_SLOTS
+    elif command.type == 'C_RETURN':
+        return set(TEMP_SLOTS)
+    return set()
+
+
+def eliminate_function_dead_stores(commands):
+    """Turn the dead stores of one function (given by its commands, starting with its function command) into discards,
+    and drop the pushes whose values are discarded straight away. Return the new commands."""
+    uses_ram = any(command.type in ['C_PUSH', 'C_POP'] and command.arg1 == 'ram' for command in commands)
+    label_indexes = {command.arg1: command_idx for command_idx, command in enumerate(commands)
+                     if command.type == 'C_LABEL'}
+
+    def successors(command_idx):
+        command = commands[command_idx]
+        following = []
+        if command.type in JUMP_COMMANDS:
+            following.append(label_indexes.get(command.arg1))
+        if command.type not in ['C_GOTO', 'C_RETURN'] and command_idx + 1 < len(commands):
+            following.append(command_idx + 1)
+        return following
+
+    # The commands that can reach a return, found by going backwards from the returns along the jumps and
+    # fallthroughs. A jump out of the function (to a label it doesn't have) can't be followed, so it doesn't count.
+    predecessors = [[] for _ in commands]
+    for command_idx in range(len(commands)):
+        for successor in successors(command_idx):
+            if successor is not None:
+                predecessors[successor].append(command_idx)
+    returning = set()
+    work = [command_idx for command_idx, command in enumerate(commands) if command.type == 'C_RETURN']
+    while work:
+        command_idx = work.pop()
+        if command_idx not in returning:
+            returning.add(command_idx)
+            work += predecessors[command_idx]
+
+    # Every slot the function touches, which is what is live where the code can't reach a return.
+    all_slots = set()
+    for command in commands:
+        all_slots |= read_slots(command)
+        slot = store_slot(command, uses_ram)
+        if slot is not None:
+            all_slots.add(slot)
+    all_slots = frozenset(all_slots)
+
+    # The slots live after each command, found by propagating the reads backwards until nothing changes.
+    live_in = [frozenset() if command_idx in returning else all_slots for command_idx in range(len(commands))]
+    live_out = [all_slots] * len(commands)
+    work = sorted(returning)
+    while work:
+        command_idx = work.pop()
+        command = commands[command_idx]
+        out = frozenset().union(*(all_slots if successor is None else live_in[successor]
+                                   for successor in successors(command_idx)))
+        live_out[command_idx] = out
+        slot = store_slot(command, uses_ram)
+        live = (out - {slot}) | read_slots(command)
+        if live != live_in[command_idx]:
+            live_in[command_idx] = live
+            work += [predecessor for predecessor in predecessors[command_idx] if predecessor in returning]
+
+    eliminated = []
+    for command_idx, command in enumerate(commands):
+        slot = store_slot(command, uses_ram)
+        if slot is not None and command_idx in returning and slot not in live_out[command_idx]:
+            command = VMCommand('C_POP', 'constant', 0, command.line, 'pop constant 0')
+        if command.type == 'C_POP' and command.arg1 == 'constant' and eliminated and eliminated[-1].type == 'C_PUSH':
+            eliminated.pop()
+            continue
+        eliminated.append(command)
+    return eliminated
@@ -0,0 +1,327 @@
+"""
+The diff_harness module is a differential correctness harness for the translator's optimizations. It translates each
+program at every optimization setting, runs every build in the hack_executor, and checks that the optimized builds
+leave exactly the same observable results as the plain build:
+
+    - For the test programs (those that tick RAM[2999]/RAM[3000] like the VMTa and XVMT tests), the RAM[3000..3008]
+      snapshot at every test checkpoint, just like the output rows of their test.tst scripts.
+    - For every program that halts, the final values of the pointers, temps, statics (by name), and the RAM above the
+      stack.
+      Programs without a Sys.vm also have their stack compared, since that is where their results are left.
+
+It can also fuzz the optimizations with random programs from the vm_generator module.
+
+Usage:
+    python diff_harness.py [program ...] [--random N] [--seed S] [--max-cycles N] [--keep DIR]
+
+With no programs, every program under vm_input (apart from those with errors) is checked.
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+
+import config
+from error_checker import lint_vm_file
+from hack_assembler import AssemblerError, assemble, clean_lines, resolve_symbols
+from hack_executor import HackExecutor
+from vm_generator import VMProgramGenerator
+
+VM_INPUT_DIR = os.path.join(os.path.split(os.path.abspath(__file__))[0], 'vm_input')
+
+# Every optimization setting, as the config values to translate with. 'pgo' also records a profile of the plain build.
+OPTIMIZATION_SETTINGS = {
+    'plain': {},
+    'speed': {'OPTIMIZATION': 'speed'},
+    'size': {'OPTIMIZATION': 'size'},
+    'pgo': {},
+    'sp': {'DEFER_SP_UPDATES': True},
+    'speed+sp': {'OPTIMIZATION': 'speed', 'DEFER_SP_UPDATES': True},
+    'size+sp': {'OPTIMIZATION': 'size', 'DEFER_SP_UPDATES': True},
+    'cfg': {'SIMPLIFY_CONTROL_FLOW': True},
+    'stubs': {'SHARE_CALL_STUBS': True},
+    'frames': {'ELIDE_FRAME_SAVES': True},
+    'dead': {'ELIMINATE_DEAD_STORES': True},
+    'speed+sp+dead': {'OPTIMIZATION': 'speed', 'DEFER_SP_UPDATES': True, 'ELIMINATE_DEAD_STORES': True},
+    'speed+sp+cfg': {'OPTIMIZATION': 'speed', 'DEFER_SP_UPDATES': True, 'SIMPLIFY_CONTROL_FLOW': True},
+}
+
+# The test programs tick RAM[TEST-1] and then tock RAM[TEST]; their test scripts output a row after every tick.
+TEST_ADDRESS = 3000
+TEST_OUTPUTS = range(3000, 3009)
+
+# Programs without a Sys.vm are started with the segment pointers and arguments the course test scripts set up.
+INITIAL_RAM = {1: 300, 2: 400, 3: 3000, 4: 3010, 400: 6, 401: 3000, 402: 5, 403: 7, 404: 9}
+
+STACK_BASE = 256
+DATA_BASE = 2048
+
+
+class Observation:
+    """
+    The Observation class holds what one build of a program did when it was run.
+
+    Attributes:
+        checkpoints: The RAM[3000..3008] snapshot at every test checkpoint.
+        final_state: A dictionary of the observable final values in RAM.
+        cycles: The number of cycles the run took.
+        rom_words: The size of the program in ROM words.
+        halted: True if the program halted before the cycle limit.
+    """
+
+    def __init__(self):
+        self.checkpoints = []
+        self.final_state = {}
+        self.cycles = 0
+        self.rom_words = 0
+        self.halted = False
+
+
+def translate(input_path, output_file, settings, profile_file=None):
+    """
+    Translate a .vm file or directory into output_file with the given config settings, quietly. Return the lines of
+    the .asm code, and the RAM address of each (file name, index) static that was written as a numeric address.
+
+    Arguments:
+        input_path: The .vm file or directory of .vm files.
+        output_file: The .asm file to write.
+        settings: A dictionary of config values to translate with.
+        profile_file: A profile to translate with, if any.
+    """
+    import main
+
+    settings = dict(settings, PROFILE_FILE=profile_file, WRITE_ERRORS_TO_LOG=False, PRINT_ERRORS_TO_CONSOLE=False)
+    saved = {name: getattr(config, name) for name in settings}
+    for name, value in settings.items():
+        setattr(config, name, value)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            static_addresses = main.process_vm_files(main.find_vm_files(input_path), output_file, input_path)
+            if not config.STATIC_LAYOUT:
+                static_addresses = {}
+    finally:
+        for name, value in saved.items():
+            setattr(config, name, value)
+
+    with open(output_file, 'r') as file:
+        return file.readlines(), static_addresses
+
+
+def observe(asm_lines, has_sys, max_cycles, static_addresses):
+    """Run the given .asm code, whose statics have the given addresses (or are symbols), and return an Observation of
+    what it did."""
+    machine_code = assemble(asm_lines)
+    executor = HackExecutor(machine_code, watch=[TEST_ADDRESS - 1, TEST_ADDRESS])
+    observation = Observation()
+
+    # Take a snapshot every time the test ticks, that is, whenever RAM[TEST-1] and RAM[TEST] start to differ.
+    ticking = [False]
+
+    def write_hook(address, run):
+        if run.ram[TEST_ADDRESS - 1] != run.ram[TEST_ADDRESS]:
+            if not ticking[0]:
+                observation.checkpoints.append([run.peek(a) for a in TEST_OUTPUTS])
+            ticking[0] = True
+        else:
+            ticking[0] = False
+
+    executor.write_hook = write_hook
+    if not has_sys:
+        for address, value in INITIAL_RAM.items():
+            executor.poke(address, value)
+
+    observation.halted = executor.run(max_cycles=max_cycles)
+    observation.cycles = executor.cycles
+    observation.rom_words = len(machine_code)
+
+    # Collect the final values that every correct translation must agree on.
+    state = observation.final_state
+    for address in range(3, 13):
+        state[f'RAM[{address}]'] = executor.peek(address)
+    state.update(static_values(asm_lines, executor, static_addresses))
+    for address in range(DATA_BASE, 16384):
+        value = executor.peek(address)
+        if value:
+            state[f'RAM[{address}]'] = value
+    if not has_sys:
+        state['SP'] = executor.peek(0)
+        for address in range(STACK_BASE, min(executor.peek(0), DATA_BASE)):
+            state[f'RAM[{address}]'] = executor.peek(address)
+
+    return observation
+
+
+def static_values(asm_lines, executor, static_addresses):
+    """Return the final value of every static variable in the given run, by name (like File.3). Statics written as
+    numeric addresses are read at their planned address; the others are symbols, allocated in order of first use, just
+    like hack_assembler.assemble() does."""
+    values = {f'{file_name}.{index}': executor.peek(address)
+              for (file_name, index), address in static_addresses.items()}
+    _, labels = resolve_symbols(clean_lines(asm_lines))
+    next_variable = 16
+    for line in clean_lines(asm_lines):
+        symbol = line[1:]
+        if line.startswith('@') and not symbol.isdigit() and symbol not in labels and symbol not in values:
+            if '.' in symbol:
+                values[symbol] = executor.peek(next_variable)
+            next_variable += 1
+    return values
+
+
+def check_program(name, input_path, work_dir, max_cycles, settings=None):
+    """
+    Translate and run one program at every optimization setting, and compare every build against the plain build.
+    Return a list of (setting, observation, list of differences) tuples, which is empty if the plain build doesn't
+    fit in ROM.
+
+    Arguments:
+        name: The name of the program, used for its output files.
+        input_path: The .vm file or directory of .vm files.
+        work_dir: The directory to write the builds to.
+        max_cycles: The most cycles to run each build for.
+        settings: The optimization settings to check (by default, all of them).
+    """
+    from pgo import write_profile
+
+    has_sys = os.path.isdir(input_path) and os.path.exists(os.path.join(input_path, 'Sys.vm'))
+    results = []
+    baseline = None
+
+    for setting in settings or OPTIMIZATION_SETTINGS:
+        output_file = os.path.join(work_dir, f'{name}.{setting}.asm')
+        profile_file = None
+        if setting == 'pgo':
+            # Profile the plain build first, then translate with the profile.
+            plain_file = os.path.join(work_dir, f'{name}.pgo-profiling.asm')
+            write_source_map = config.WRITE_SOURCE_MAP
+            config.WRITE_SOURCE_MAP = True
+            try:
+                translate(input_path, plain_file, OPTIMIZATION_SETTINGS['plain'])
+            finally:
+                config.WRITE_SOURCE_MAP = write_source_map
+            profile_file = os.path.join(work_dir, f'{name}.profile.json')
+            write_profile(name, plain_file, plain_file[:-len('.asm')] + '.map.json', profile_file, max_cycles)
+
+        asm_lines, static_addresses = translate(input_path, output_file, OPTIMIZATION_SETTINGS[setting], profile_file)
+        try:
+            observation = observe(asm_lines, has_sys, max_cycles, static_addresses)
+        except AssemblerError as error:
+            # A plain build that doesn't fit in ROM can't be checked at all.
+            if baseline is None:
+                return []
+            results.append((setting, Observation(), [f'does not assemble: {error}']))
+            continue
+
+        if baseline is None:
+            baseline = observation
+            results.append((setting, observation, []))
+        else:
+            results.append((setting, observation, compare(baseline, observation)))
+
+    return results
+
+
+def compare(expected, actual):
+    """Return a list of the differences between two observations of the same program."""
+    differences = []
+    for row_idx in range(max(len(expected.checkpoints), len(actual.checkpoints))):
+        expected_row = expected.checkpoints[row_idx] if row_idx < len(expected.checkpoints) else None
+        actual_row = actual.checkpoints[row_idx] if row_idx < len(actual.checkpoints) else None
+        if expected_row != actual_row:
+            differences.append(f'checkpoint {row_idx + 1}: expected {expected_row}, got {actual_row}')
+
+    # A run that was stopped by the cycle limit stops at an arbitrary point, so its final state is meaningless.
+    if not expected.halted and not actual.halted:
+        return differences
+
+    for key in sorted(set(expected.final_state) | set(actual.final_state)):
+        if expected.final_state.get(key) != actual.final_state.get(key):
+            differences.append(f'{key}: expected {expected.final_state.get(key)}, got {actual.final_state.get(key)}')
+
+    if expected.halted != actual.halted:
+        differences.append(f'halted: expected {expected.halted}, got {actual.halted}')
+    return differences
+
+
+def vm_input_programs():
+    """Return the (name, path) of every program under vm_input: each directory, and each top-level .vm file. Programs
+    with errors are left out: their invalid commands are dropped, so they can do anything (like jump to an undefined
+    function's 'address'), and need not behave the same at every setting."""
+    programs = []
+    for entry in sorted(os.listdir(VM_INPUT_DIR)):
+        path = os.path.join(VM_INPUT_DIR, entry)
+        if os.path.isdir(path):
+            vm_files = [os.path.join(path, file) for file in os.listdir(path) if file.endswith('.vm')]
+            name = entry
+        elif entry.endswith('.vm'):
+            vm_files = [path]
+            name = entry[:-len('.vm')]
+        else:
+            continue
+        if not any(lint_vm_file(vm_file) for vm_file in vm_files):
+            programs.append((name, path))
+    return programs
+
+
+def report(name, results):
+    """Print one line per optimization setting of a checked program, and the differences of any that disagree.
+    Return the number of settings that disagreed with the plain build."""
+    if not results:
+        print(f'{name:<24} skipped: the plain build does not fit in ROM')
+        return 0
+
+    failures = 0
+    baseline = results[0][1]
+    for setting, observation, differences in results:
+        status = 'ok' if not differences else 'MISMATCH'
+        print(f'{name:<24} {setting:<12} {status:<9} {observation.cycles:>9} cycles '
+              f'({observation.cycles - baseline.cycles:+d})  {observation.rom_words:>6} words '
+              f'({observation.rom_words - baseline.rom_words:+d})')
+        for difference in differences[:10]:
+            print(f'    {difference}')
+        if differences:
+            failures += 1
+    return failures
+
+
+# ************************************************************************************************
+# Program begins here:
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Check optimized translations against the plain translation.')
+    arg_parser.add_argument('programs', nargs='*', help='Programs under vm_input to check (default: all of them).')
+    arg_parser.add_argument('--random', type=int, default=0, help='Also check this many random programs.')
+    arg_parser.add_argument('--seed', type=int, default=0, help='The seed of the first random program.')
+    arg_parser.add_argument('--max-cycles', type=int, default=2_000_000, help='Stop each run after this many cycles.')
+    arg_parser.add_argument('--keep', help='Write the builds to this directory and keep them.')
+    args = arg_parser.parse_args()
+
+    build_dir = args.keep or tempfile.mkdtemp(prefix='diff_harness_')
+    os.makedirs(build_dir, exist_ok=True)
+
+    if args.programs:
+        checked = [(program, os.path.join(VM_INPUT_DIR, program) + ('' if os.path.isdir(
+            os.path.join(VM_INPUT_DIR, program)) else '.vm')) for program in args.programs]
+    elif args.random:
+        checked = []
+    else:
+        checked = vm_input_programs()
+
+    for seed in range(args.seed, args.seed + args.random):
+        program_dir = os.path.join(build_dir, f'random{seed}')
+        VMProgramGenerator(seed).write(program_dir)
+        checked.append((f'random{seed}', program_dir))
+
+    total_failures = 0
+    try:
+        for program_name, program_path in checked:
+            total_failures += report(program_name, check_program(program_name, program_path, build_dir,
+                                                                 args.max_cycles))
+    finally:
+        if not args.keep:
+            shutil.rmtree(build_dir)
+
+    print(f'\n{total_failures} mismatched builds.' if total_failures else '\nAll builds match.')
+    exit(1 if total_failures else 0)
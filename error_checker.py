@@ -1,21 +1,44 @@
 """
 The error_checker module provides error and warning checking functions and creates an error file for exporting.
+
+It also provides a fast validate-only checker (lint_vm_file and lint_vm_files), which finds the same errors as the
+parser does during translation, but without generating code, for checking many .vm files at once.
 """
 import datetime as dt
 import re
 import config
 import os
+from concurrent.futures import ProcessPoolExecutor
+
+from instrumentation import timed
 
 # Initialize a global variable to hold the error file name.
 FILENAME = "default_filename.txt"
 
-valid_vm_commands = ['add', 'sub', 'neg', 'eq', 'gt', 'lt', 'and', 'or', 'not', 'push', 'pop', 'label', 'goto',
+valid_vm_commands = {'add', 'sub', 'neg', 'eq', 'gt', 'lt', 'and', 'or', 'not', 'push', 'pop', 'label', 'goto',
                      'if-goto', 'function', 'return', 'call', 'bool', 'le', 'ge', 'ne', 'l-not',
-                     'l-and', 'l-or', 'l-xor']
-valid_mem_segments = ['argument', 'local', 'static', 'constant', 'this', 'that', 'pointer', 'temp', 'ram']
+                     'l-and', 'l-or', 'l-xor', 'mult', 'div', 'mod', 'shl', 'shr'}
+valid_mem_segments = {'argument', 'local', 'static', 'constant', 'this', 'that', 'pointer', 'temp', 'ram'}
 
 regex_legal_name = re.compile(r'^[A-Za-z_.:][A-Za-z0-9_.:]*$')
 
+# The arithmetic and logical commands whose format is checked: the standard ones, and the XVM multiply, divide, and
+# shift commands.
+ARITHMETIC_COMMANDS = ['add', 'sub', 'neg', 'eq', 'gt', 'lt', 'and', 'or', 'not', 'mult', 'div', 'mod', 'shl', 'shr']
+
+# The number of elements each command with a checked format must have, and how its format error describes it.
+COMMAND_FORMATS = {command: (1, 'an arithmetic or logical command', 'only one element')
+                   for command in ARITHMETIC_COMMANDS}
+COMMAND_FORMATS.update({command: (3, 'a push or pop command', 'exactly three elements') for command in ['push', 'pop']})
+COMMAND_FORMATS.update({command: (2, 'a program flow command', 'exactly two elements')
+                        for command in ['label', 'goto', 'if-goto']})
+COMMAND_FORMATS.update({command: (3, 'a function or call command', 'exactly three elements')
+                        for command in ['function', 'call']})
+COMMAND_FORMATS['return'] = (1, 'a return command', 'only one element')
+
+# The highest legal index of the segments that have a known size.
+SEGMENT_MAX_INDEX = {'pointer': 1, 'temp': 7, 'constant': 32767}
+
 
 def create_error_file(io_file):
     # Below lines generate a random error file name based on the current date and time.
@@ -28,8 +51,9 @@ def create_error_file(io_file):
     file_name_suffix = dt.datetime.now().strftime("%y%m%d_%H%M%S") + ".txt"
 
     file_path = os.path.abspath(__file__)
-    file_dir = os.path.split(file_path)[0] + '/' 'error_logs' + '/' + base_filename + '_' \
-               + io_file + '_' + file_name_suffix
+    log_dir = os.path.split(file_path)[0] + '/' 'error_logs'
+    os.makedirs(log_dir, exist_ok=True)
+    file_dir = log_dir + '/' + base_filename + '_' + io_file.replace('/', '_') + '_' + file_name_suffix
 
     # Set the module-scope error output filename
     global FILENAME
@@ -53,6 +77,7 @@ def write_warning(warning_line, warning_content):
         error_file.write(f"\n!!!!!!!!!!\n\nWarning, line {warning_line}: {warning_content}\n\n!!!!!!!!!!\n")
 
 
+@timed('error checks')
 def check_unknown_command(command, line):
     """Ensure the validity of a given VM command."""
     if command[0] not in valid_vm_commands:
@@ -62,11 +87,12 @@ def check_unknown_command(command, line):
         return False
 
 
+@timed('error checks')
 def check_improper_command_format(command, line, write=True):
     """Check that the VM command follows the format specified for its type. Primarily, this means detecting if the
     command has the wrong number of elements."""
     num_elems = len(command)
-    if command[0] in ['add', 'sub', 'neg', 'eq', 'gt', 'lt', 'and', 'or', 'not'] and num_elems != 1:
+    if command[0] in ARITHMETIC_COMMANDS and num_elems != 1:
         if write:
             write_error(line, f"'{' '.join(command)}'\n is an arithmetic or logical command that does not conform to "
                               f"its specified format (there should be only one element in the command).")
@@ -95,6 +121,7 @@ def check_improper_command_format(command, line, write=True):
         return False
 
 
+@timed('error checks')
 def check_unknown_mem_segment(command, line):
     """Ensure that the given push or pop command does not refer to an invalid memory segment."""
     if command[1] not in valid_mem_segments:
@@ -104,6 +131,7 @@ def check_unknown_mem_segment(command, line):
         return False
 
 
+@timed('error checks')
 def check_illegal_index(command, index, line):
     """Ensure that the given push or pop command does not contain a negative index."""
     try:
@@ -117,6 +145,7 @@ def check_illegal_index(command, index, line):
         return True
 
 
+@timed('error checks')
 def check_index_out_of_range(command, index, line):
     """For any memory segment that has a known size, checks that the given push or pop instruction does not use an
     index outside of that known region."""
@@ -135,6 +164,7 @@ def check_index_out_of_range(command, index, line):
         return False
 
 
+@timed('error checks')
 def check_illegal_label(command, line):
     """Ensure that the given label, goto, or if-goto command does not reference an illegal label.That is, the label
     must follow the syntax outlined on page 159: the label is an arbitrary string composed of any sequence
@@ -146,6 +176,7 @@ def check_illegal_label(command, line):
         return False
 
 
+@timed('error checks')
 def check_unresolved_label(command, line, current_fn, fn_dict):
     """Check that the given goto or if-goto command does not refer to a label not defined within the
     current function."""
@@ -157,6 +188,7 @@ def check_unresolved_label(command, line, current_fn, fn_dict):
         return False
 
 
+@timed('error checks')
 def check_illegal_fn_name(command, line):
     """Ensure that the given function or call command is not using an illegal function name. That is, the command
     must follow the syntax outlined on page 160: the function name is an arbitrary string composed of any sequence
@@ -168,6 +200,7 @@ def check_illegal_fn_name(command, line):
         return False
 
 
+@timed('error checks')
 def check_illegal_arg_count(command, line):
     """Ensure that the given function or call command uses a non-negative integer for the number of locals/args."""
     try:
@@ -181,3 +214,115 @@ def check_illegal_arg_count(command, line):
         write_error(line, f"'{' '.join(command)}'\n is a function or call command with a non-integer as a number of "
                           f"local variables or arguments.")
         return True
+
+
+# ************************************************************************************
+# **** Validate-only checking *****
+
+def parse_index(token):
+    """Return the integer value of a decimal, binary (0b...), or hexadecimal (0x...) index, or None if it is not an
+    integer. Follows Parser.translate_bin_hex."""
+    try:
+        if token[:2] in ('0b', '0B'):
+            return int(token.replace('0b', '').replace('0B', ''), 2)
+        elif token[:2] in ('0x', '0X'):
+            return int(token.replace('0x', '').replace('0X', ''), 16)
+        return int(token)
+    except ValueError:
+        return None
+
+
+def lint_vm_file(vm_file):
+    """
+    Check one .vm file for errors without translating it, and return the list of (line, message) errors found, in
+    line order. Finds the same errors as the parser (at most one per line), but in a single pass that tokenizes each
+    line once: gotos are checked against the labels of their function once the whole file has been read.
+
+    Arguments:
+        vm_file: The path of the .vm file to check.
+    """
+    with open(vm_file, 'r') as file:
+        lines = file.readlines()
+
+    errors = []
+    labels = {}     # The labels defined in each function.
+    gotos = []      # The (line, command text, function, label) of each goto and if-goto, to resolve at the end.
+    current_function = None
+
+    for line_number, line in enumerate(lines, 1):
+        command = line.split('//', 1)[0].split()
+        if not command:
+            continue
+        text = ' '.join(command)
+        name = command[0]
+
+        if name not in valid_vm_commands:
+            errors.append((line_number, f"'{text}' is an invalid standard VM command."))
+            continue
+        if name in COMMAND_FORMATS and len(command) != COMMAND_FORMATS[name][0]:
+            _, description, elements = COMMAND_FORMATS[name]
+            errors.append((line_number, f"'{text}' is {description} that does not conform to its specified format "
+                                        f"(there should be {elements} in the command)."))
+            continue
+
+        if name == 'push' or name == 'pop':
+            segment = command[1]
+            index = parse_index(command[2])
+            if segment not in valid_mem_segments:
+                errors.append((line_number, f"'{text}' is a push or pop command with an invalid memory segment."))
+            elif index is None:
+                errors.append((line_number, f"'{text}' is a push or pop command with a non-integer index."))
+            elif index < 0:
+                errors.append((line_number, f"'{text}' is a push or pop command with a negative index."))
+            elif index > SEGMENT_MAX_INDEX.get(segment, index):
+                errors.append((line_number, f"'{text}' has an index that is out of range of the {segment} segment."))
+
+        elif name == 'label' or name == 'goto' or name == 'if-goto':
+            if name == 'label':
+                # Labels are collected before checking, like Parser.collect_fn_labels, so even illegal ones count.
+                labels.setdefault(current_function, set()).add(command[1])
+            if not regex_legal_name.fullmatch(command[1]):
+                errors.append((line_number, f"'{text}' contains an illegal label."))
+            elif name != 'label':
+                gotos.append((line_number, text, current_function, command[1]))
+
+        elif name == 'function' or name == 'call':
+            if name == 'function':
+                current_function = command[1]
+            if not regex_legal_name.fullmatch(command[1]):
+                errors.append((line_number, f"'{text}' contains an illegal function name."))
+            else:
+                try:
+                    if int(command[2]) < 0:
+                        errors.append((line_number, f"'{text}' is a function or call command with a negative number "
+                                                    f"of local variables or arguments."))
+                except ValueError:
+                    errors.append((line_number, f"'{text}' is a function or call command with a non-integer as a "
+                                                f"number of local variables or arguments."))
+
+    for line_number, text, function, label in gotos:
+        if label not in labels.get(function, ()):
+            errors.append((line_number, f"'{text}' has a label not defined within the current function."))
+
+    errors.sort()
+    return errors
+
+
+def lint_vm_files(vm_files, workers=None):
+    """
+    Check several .vm files for errors without translating them, spreading the files over worker processes. Return a
+    dictionary mapping each file to its list of (line, message) errors.
+
+    Arguments:
+        vm_files: The paths of the .vm files to check.
+        workers: The number of worker processes (by default, one per CPU). With 1, or only one file, the files are
+            checked in this process.
+    """
+    vm_files = list(vm_files)
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(vm_files) < 2:
+        return {vm_file: lint_vm_file(vm_file) for vm_file in vm_files}
+
+    chunk_size = max(1, len(vm_files) // (4 * workers))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(vm_files, executor.map(lint_vm_file, vm_files, chunksize=chunk_size)))
@@ -0,0 +1,113 @@
+"""
+The frame_layout module works out which segment pointers the frame of each function of a program must save. A call
+saves the caller's LCL, ARG, THIS, and THAT in a frame on the stack, and the callee's return restores all four. But a
+function that never writes pointer 0 (or pointer 1), and calls nothing that can, leaves THIS (or THAT) just as it found
+it, so there is nothing to save or restore. The planner looks at every .vm file of the program before any code is
+written, finds the pointers each function writes, and spreads them through the call graph to every function that can
+call it.
+
+A function's frame is pushed by every call of it and taken apart by each of its returns, so the frame of each function
+is planned once for the whole program, and its calls and returns always agree on it. LCL and ARG are always saved,
+since every call sets them. A function that isn't part of the program (like an OS one) may write anything, so it and
+its callers keep the full frame. Only programs with a Sys.init get smaller frames: the functions of a program without
+one are entered by a test script, which sets up a full frame for them.
+
+Usage:
+    python frame_layout.py <program>
+"""
+import argparse
+
+# The segment pointers of a full frame, in the order a call pushes them. The first two are always saved.
+FRAME_POINTERS = ['LCL', 'ARG', 'THIS', 'THAT']
+
+# The RAM addresses of the pointers that a function can leave alone, as the pointer segment and ram segment see them.
+POINTER_ADDRESSES = {3: 'THIS', 4: 'THAT'}
+
+
+def written_pointers(command):
+    """Return the set of segment pointers (THIS and THAT) that the given VMCommand writes."""
+    if command.type == 'C_POP' and command.arg1 == 'pointer' and 3 + command.arg2 in POINTER_ADDRESSES:
+        return {POINTER_ADDRESSES[3 + command.arg2]}
+    elif command.type == 'C_POP' and command.arg1 == 'ram' and command.arg2 in POINTER_ADDRESSES:
+        return {POINTER_ADDRESSES[command.arg2]}
+    return set()
+
+
+def saved_pointers(frames, function_name):
+    """Return the segment pointers that the frame of the named function saves under the given frame layout, in the
+    order a call pushes them: all four for a function without a plan."""
+    return frames.get(function_name, FRAME_POINTERS)
+
+
+def plan_frame_layout(program_files):
+    """
+    Return a dictionary of the segment pointers that the frame of each function of a program saves, in the order a call
+    pushes them: LCL and ARG, then THIS and THAT if the function or anything it can call may write them. Functions that
+    aren't part of the program aren't in it, and the dictionary is empty for a program without a Sys.init.
+
+    Arguments:
+        program_files: The (.vm file, list of VMCommand records) of every file of the program, in translation order.
+    """
+    writes = {}
+    callees = {}
+    for _, commands in program_files:
+        function = None
+        for command in commands:
+            if command.type == 'C_FUNCTION':
+                function = command.arg1
+                writes.setdefault(function, set())
+                callees.setdefault(function, set())
+            elif function is None:
+                continue
+            elif command.type == 'C_CALL':
+                callees[function].add(command.arg1)
+            else:
+                writes[function] |= written_pointers(command)
+    if 'Sys.init' not in writes:
+        return {}
+
+    # A function may write whatever the functions it calls may write, so spread the writes to the callers until
+    # nothing changes.
+    changed = True
+    while changed:
+        changed = False
+        for function, called in callees.items():
+            for callee in called:
+                callee_writes = writes.get(callee, set(POINTER_ADDRESSES.values()))
+                if not callee_writes <= writes[function]:
+                    writes[function] |= callee_writes
+                    changed = True
+
+    return {function: FRAME_POINTERS[:2] + [pointer for pointer in FRAME_POINTERS[2:] if pointer in written]
+            for function, written in writes.items()}
+
+
+def analyze_program(program_name):
+    """Parse the named program with main.read_program() and return its frame layout, like plan_frame_layout()."""
+    import main
+
+    return plan_frame_layout(main.read_program(program_name))
+
+
+def format_report(frames):
+    """Return a text table of the pointers saved in the frame of every function, and a line on how many are left out."""
+    if not frames:
+        return "The program has no Sys.init, so every function keeps the full frame."
+    out = [f"{'frame':>5}  {'saves':<18}  function"]
+    for function, pointers in sorted(frames.items()):
+        out.append(f"{1 + len(pointers):>5}  {' '.join(pointers):<18}  {function}")
+    left_out = sum(len(FRAME_POINTERS) - len(pointers) for pointers in frames.values())
+    out.append(f"The frames of the program's {len(frames)} functions leave out {left_out} of their "
+               f"{len(FRAME_POINTERS) * len(frames)} segment pointers.")
+    return '\n'.join(out)
+
+
+# ************************************************************************************************
+# Program begins here:
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Report which segment pointers the frame of each function saves.')
+    arg_parser.add_argument('program', help='The .vm file (without extension) or directory under vm_input.')
+    args = arg_parser.parse_args()
+
+    print(format_report(analyze_program(args.program)))
@@ -0,0 +1,179 @@
+"""
+The hack_assembler module provides a small in-memory Hack assembler, so that translated .asm code can be turned into
+machine code (for the hack_executor module, or for writing a .hack file) without a separate assembler program.
+
+It also exports the MachineCodeBuilder class, which the CodeWriter uses to assemble its instructions as it emits them,
+so a .hack file can be written without writing and re-reading the .asm text.
+"""
+
+# Predefined symbols of the Hack platform.
+PREDEFINED_SYMBOLS = {
+    'SP': 0, 'LCL': 1, 'ARG': 2, 'THIS': 3, 'THAT': 4,
+    'SCREEN': 16384, 'KBD': 24576,
+}
+PREDEFINED_SYMBOLS.update({f'R{i}': i for i in range(16)})
+
+# The a-bit and the six c-bits of every legal computation.
+COMP_CODES = {
+    '0': '0101010', '1': '0111111', '-1': '0111010',
+    'D': '0001100', 'A': '0110000', '!D': '0001101', '!A': '0110001', '-D': '0001111', '-A': '0110011',
+    'D+1': '0011111', 'A+1': '0110111', 'D-1': '0001110', 'A-1': '0110010',
+    'D+A': '0000010', 'D-A': '0010011', 'A-D': '0000111', 'D&A': '0000000', 'D|A': '0010101',
+    'M': '1110000', '!M': '1110001', '-M': '1110011', 'M+1': '1110111', 'M-1': '1110010',
+    'D+M': '1000010', 'D-M': '1010011', 'M-D': '1000111', 'D&M': '1000000', 'D|M': '1010101',
+}
+# Commuted spellings that some code writers produce.
+COMP_CODES.update({'1+D': COMP_CODES['D+1'], '1+A': COMP_CODES['A+1'], '1+M': COMP_CODES['M+1'],
+                   'A+D': COMP_CODES['D+A'], 'M+D': COMP_CODES['D+M'], 'A&D': COMP_CODES['D&A'],
+                   'M&D': COMP_CODES['D&M'], 'A|D': COMP_CODES['D|A'], 'M|D': COMP_CODES['D|M']})
+
+JUMP_CODES = {'': 0, 'JGT': 1, 'JEQ': 2, 'JGE': 3, 'JLT': 4, 'JNE': 5, 'JLE': 6, 'JMP': 7}
+
+FIRST_VARIABLE_ADDRESS = 16
+
+
+class AssemblerError(Exception):
+    """Raised when the assembly code cannot be assembled."""
+
+
+def split_c_instruction(instruction):
+    """Split a C-instruction into its (dest, comp, jump) parts. Missing parts are returned as ''."""
+    dest, comp, jump = '', instruction, ''
+    if '=' in comp:
+        dest, comp = comp.split('=', 1)
+    if ';' in comp:
+        comp, jump = comp.split(';', 1)
+    return dest, comp, jump
+
+
+def clean_lines(asm_lines):
+    """Strip comments and whitespace from the given lines of assembly, dropping lines that end up empty."""
+    cleaned = []
+    for line in asm_lines:
+        line = line.split('//', 1)[0].strip().replace(' ', '')
+        if line:
+            cleaned.append(line)
+    return cleaned
+
+
+def resolve_symbols(asm_lines):
+    """Do the first pass of the assembler: collect the ROM address of every label, and return the instructions (with
+    labels removed) along with the symbol table."""
+    symbols = dict(PREDEFINED_SYMBOLS)
+    instructions = []
+    for line in asm_lines:
+        if line.startswith('('):
+            symbols[line[1:-1]] = len(instructions)
+        else:
+            instructions.append(line)
+    return instructions, symbols
+
+
+def encode_c_instruction(instruction):
+    """Return the 16-bit machine code of the given C-instruction."""
+    dest, comp, jump = split_c_instruction(instruction)
+    if comp not in COMP_CODES or jump not in JUMP_CODES or set(dest) - set('ADM'):
+        raise AssemblerError(f"'{instruction}' is not a valid C-instruction.")
+
+    dest_bits = (4 if 'A' in dest else 0) | (2 if 'D' in dest else 0) | (1 if 'M' in dest else 0)
+    return 0b111 << 13 | int(COMP_CODES[comp], 2) << 6 | dest_bits << 3 | JUMP_CODES[jump]
+
+
+def assemble(asm_lines):
+    """
+    Assemble the given lines of Hack assembly code and return the list of 16-bit machine code words (one per ROM
+    address). Variables are allocated from RAM[16] upwards in order of first use, like the standard assembler.
+
+    Arguments:
+        asm_lines: The lines of the .asm file, with or without comments, blank lines, and newlines.
+    """
+    instructions, symbols = resolve_symbols(clean_lines(asm_lines))
+    next_variable = FIRST_VARIABLE_ADDRESS
+
+    machine_code = []
+    for instruction in instructions:
+        if instruction.startswith('@'):
+            value = instruction[1:]
+            if value.isdigit():
+                address = int(value)
+            else:
+                if value not in symbols:
+                    symbols[value] = next_variable
+                    next_variable += 1
+                address = symbols[value]
+            if address > 32767:
+                raise AssemblerError(f"'{instruction}' does not fit in an A-instruction.")
+            machine_code.append(address)
+        else:
+            machine_code.append(encode_c_instruction(instruction))
+
+    return machine_code
+
+
+class MachineCodeBuilder:
+    """
+    The MachineCodeBuilder class assembles instructions one at a time, as a code writer emits them. Every instruction
+    is kept as a structured record: C-instructions and numeric A-instructions are encoded to their machine code word
+    straight away, and A-instructions of symbols are recorded as (address, symbol) fix-ups to resolve once every label
+    is known. Variables (like static File.3) are allocated from RAM[16] upwards in order of first use, so the machine
+    code is exactly what assemble() produces from the same .asm code.
+
+    Methods:
+        __init__: Constructs an empty builder.
+        add: Adds one line of assembly code (an instruction, label, comment, or blank line).
+        machine_code: Resolves the symbols and returns the list of machine code words.
+    """
+
+    def __init__(self):
+        """Construct an empty builder."""
+        self.words = []         # The machine code word of each instruction, or None until its symbol is resolved.
+        self.fixups = []        # The (ROM address, symbol) of each A-instruction of a symbol.
+        self.labels = {}        # The ROM address of each label.
+        self.c_codes = {}       # The encoding of each distinct C-instruction seen so far.
+
+    def add(self, line):
+        """Add one line of assembly code, as written to an .asm file."""
+        if not line or line[0] in '\n/':
+            return
+        if line[0] == '(':
+            self.labels[line[1:-1]] = len(self.words)
+        elif line[0] == '@':
+            value = line[1:]
+            if value.isdigit():
+                if int(value) > 32767:
+                    raise AssemblerError(f"'{line}' does not fit in an A-instruction.")
+                self.words.append(int(value))
+            else:
+                self.fixups.append((len(self.words), value))
+                self.words.append(None)
+        else:
+            if line not in self.c_codes:
+                self.c_codes[line] = encode_c_instruction(line)
+            self.words.append(self.c_codes[line])
+
+    def machine_code(self):
+        """Resolve the labels and variables of every A-instruction, and return the list of machine code words."""
+        symbols = {**PREDEFINED_SYMBOLS, **self.labels}
+        next_variable = FIRST_VARIABLE_ADDRESS
+        for address, symbol in self.fixups:
+            if symbol not in symbols:
+                symbols[symbol] = next_variable
+                next_variable += 1
+            if symbols[symbol] > 32767:
+                raise AssemblerError(f"'@{symbol}' does not fit in an A-instruction.")
+            self.words[address] = symbols[symbol]
+        self.fixups = []
+        return self.words
+
+
+def assemble_file(asm_file):
+    """Assemble the given .asm file and return its machine code words."""
+    with open(asm_file, 'r') as file:
+        return assemble(file.readlines())
+
+
+def write_hack_file(machine_code, hack_file):
+    """Write machine code words to a .hack file, one 16-character binary string per line."""
+    with open(hack_file, 'w') as file:
+        for word in machine_code:
+            file.write(f'{word:016b}\n')
@@ -0,0 +1,226 @@
+"""
+The hack_executor module exports the HackExecutor class.
+
+HackExecutor class: Runs Hack machine code (as produced by the hack_assembler module) on a simulated Hack CPU, so that
+translated programs can be timed, profiled, and checked without the course's CPU emulator.
+"""
+from hack_assembler import assemble, assemble_file
+
+RAM_SIZE = 32768
+WORD_MASK = 0xFFFF
+ADDRESS_MASK = 0x7FFF
+
+# Python expressions for every computation, over the unsigned 16-bit values a, d, and m.
+COMP_EXPRESSIONS = {
+    0b0101010: '0', 0b0111111: '1', 0b0111010: '-1',
+    0b0001100: 'd', 0b0110000: 'a', 0b0001101: '~d', 0b0110001: '~a', 0b0001111: '-d', 0b0110011: '-a',
+    0b0011111: 'd + 1', 0b0110111: 'a + 1', 0b0001110: 'd - 1', 0b0110010: 'a - 1',
+    0b0000010: 'd + a', 0b0010011: 'd - a', 0b0000111: 'a - d', 0b0000000: 'd & a', 0b0010101: 'd | a',
+    0b1110000: 'm', 0b1110001: '~m', 0b1110011: '-m', 0b1110111: 'm + 1', 0b1110010: 'm - 1',
+    0b1000010: 'd + m', 0b1010011: 'd - m', 0b1000111: 'm - d', 0b1000000: 'd & m', 0b1010101: 'd | m',
+}
+
+# Python conditions on the unsigned 16-bit result r for every jump field.
+JUMP_CONDITIONS = {
+    1: '0 < r < 0x8000', 2: 'r == 0', 3: 'r < 0x8000', 4: 'r >= 0x8000', 5: 'r != 0', 6: 'r == 0 or r >= 0x8000',
+    7: 'True',
+}
+
+HALT = -1
+
+
+class ExecutorError(Exception):
+    """Raised when the machine code cannot be executed."""
+
+
+def to_signed(value):
+    """Convert an unsigned 16-bit word to the signed value the Hack platform treats it as."""
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def is_jump(word):
+    """Return true if the given machine code word is a C-instruction with a jump."""
+    return bool(word & 0x8000 and word & 0b111)
+
+
+class HackExecutor:
+    """
+    The HackExecutor class simulates the Hack CPU one instruction (one clock cycle) at a time. Each distinct
+    instruction word is compiled once into a small Python function that performs it and returns the next PC, which
+    keeps the simulation fast enough to run whole test programs.
+
+    A program halts when it reaches the end of the ROM, or when it enters the standard Hack halting idiom of an
+    '@X / 0;JMP' pair that jumps to itself (the translation of 'label TRAP / goto TRAP').
+
+    Methods:
+        __init__: Constructs the executor and loads the machine code into its ROM.
+        from_asm: Constructs an executor from lines of .asm code.
+        from_asm_file: Constructs an executor from an .asm file.
+        reset: Resets the PC, the registers, the cycle count, and (optionally) the RAM.
+        run: Runs the program until it halts or a cycle limit is reached.
+        peek: Returns the signed value at a RAM address.
+        poke: Sets the value at a RAM address.
+    """
+
+    def __init__(self, machine_code, watch=()):
+        """Construct the executor and load the given machine code words into its ROM.
+
+        Arguments:
+            machine_code: The list of 16-bit instruction words, one per ROM address.
+            watch: RAM addresses to watch. Whenever an instruction writes one of them, self.write_hook (if set) is
+                called as write_hook(address, executor).
+        """
+        self.rom = list(machine_code)
+        self.ram = [0] * RAM_SIZE
+        self.regs = [0, 0]      # The A and D registers.
+        self.pc = 0
+        self.cycles = 0
+        self.halted = False
+        self.watch = set(watch)
+        self.write_hook = None
+
+        # The number of times each ROM address has been executed. Only kept up to date by run(count=True).
+        self.counts = [0] * (len(self.rom) + 1)
+
+        self.ops = self.compile_rom()
+
+    @classmethod
+    def from_asm(cls, asm_lines):
+        """Construct an executor from lines of Hack assembly code."""
+        return cls(assemble(asm_lines))
+
+    @classmethod
+    def from_asm_file(cls, asm_file):
+        """Construct an executor from an .asm file."""
+        return cls(assemble_file(asm_file))
+
+    def compile_rom(self):
+        """Compile every ROM word into a function of the current PC that executes it and returns the next PC."""
+        compiled = {}
+        ops = []
+        for address, word in enumerate(self.rom):
+            # '@address / 0;JMP' jumping to itself is the halting idiom.
+            if word == address and address + 1 < len(self.rom) and self.rom[address + 1] == 0b1110101010000111:
+                ops.append(self.halt_op)
+                continue
+            if word not in compiled:
+                compiled[word] = self.compile_word(word)
+            ops.append(compiled[word])
+
+        # Running off the end of the ROM halts the program.
+        ops.append(self.halt_op)
+        return ops
+
+    @staticmethod
+    def halt_op(pc):
+        """The operation placed at every halting address."""
+        return HALT
+
+    def compile_word(self, word):
+        """Compile a single machine code word into a function of the current PC that returns the next PC."""
+        if not word & 0x8000:
+            source = f'def op(pc):\n    regs[0] = {word}\n    return pc + 1\n'
+        else:
+            comp = (word >> 6) & 0b1111111
+            dest = (word >> 3) & 0b111
+            jump = word & 0b111
+            if comp not in COMP_EXPRESSIONS:
+                raise ExecutorError(f"'{word:016b}' is not a valid instruction.")
+            expression = COMP_EXPRESSIONS[comp]
+
+            lines = ['def op(pc):']
+            if 'a' in expression or 'm' in expression or dest & 0b001 or jump:
+                lines.append('    a = regs[0]')
+            if 'd' in expression:
+                lines.append('    d = regs[1]')
+            if 'm' in expression:
+                lines.append('    m = ram[a & 0x7FFF]')
+            lines.append(f'    r = ({expression}) & 0xFFFF')
+            if dest & 0b001:
+                lines.append('    ram[a & 0x7FFF] = r')
+                if self.watch:
+                    lines.append('    if (a & 0x7FFF) in watch:')
+                    lines.append('        on_watched_write(a & 0x7FFF)')
+            if dest & 0b100:
+                lines.append('    regs[0] = r')
+            if dest & 0b010:
+                lines.append('    regs[1] = r')
+            if jump:
+                lines.append(f'    return a & 0x7FFF if {JUMP_CONDITIONS[jump]} else pc + 1')
+            else:
+                lines.append('    return pc + 1')
+            source = '\n'.join(lines) + '\n'
+
+        namespace = {'regs': self.regs, 'ram': self.ram, 'watch': self.watch,
+                     'on_watched_write': self.on_watched_write}
+        exec(source, namespace)
+        return namespace['op']
+
+    def on_watched_write(self, address):
+        """Called whenever a watched RAM address is written."""
+        if self.write_hook is not None:
+            self.write_hook(address, self)
+
+    def reset(self, clear_ram=True):
+        """Reset the PC, the registers, the cycle count, and the execution counts, and optionally clear the RAM."""
+        self.pc = 0
+        self.cycles = 0
+        self.halted = False
+        self.regs[0] = self.regs[1] = 0
+        self.counts[:] = [0] * len(self.counts)
+        if clear_ram:
+            self.ram[:] = [0] * RAM_SIZE
+
+    def run(self, max_cycles=10_000_000, count=False, jump_hook=None):
+        """
+        Run the program from the current PC until it halts or max_cycles more cycles have run. Return true if the
+        program halted.
+
+        Arguments:
+            max_cycles: The most cycles to run before giving up.
+            count: If true, count how many times each ROM address is executed in self.counts.
+            jump_hook: If given, called as jump_hook(from_pc, to_pc, cycle) after every jump instruction is executed,
+                where to_pc is the next PC (from_pc + 1 if a conditional jump was not taken).
+        """
+        ops = self.ops
+        pc = self.pc
+        cycles = self.cycles
+        limit = cycles + max_cycles
+
+        if jump_hook is not None:
+            counts = self.counts
+            jumps = [is_jump(word) for word in self.rom] + [False]
+            while pc != HALT and cycles < limit:
+                counts[pc] += 1
+                cycles += 1
+                next_pc = ops[pc](pc)
+                if jumps[pc] and next_pc != HALT:
+                    jump_hook(pc, next_pc, cycles)
+                pc = next_pc
+        elif count:
+            counts = self.counts
+            while pc != HALT and cycles < limit:
+                counts[pc] += 1
+                cycles += 1
+                pc = ops[pc](pc)
+        else:
+            while pc != HALT and cycles < limit:
+                cycles += 1
+                pc = ops[pc](pc)
+
+        # Don't count the step that discovered the halt as a cycle.
+        if pc == HALT:
+            cycles -= 1
+            self.halted = True
+        else:
+            self.pc = pc
+        self.cycles = cycles
+        return self.halted
+
+    def peek(self, address):
+        """Return the signed value stored at the given RAM address."""
+        return to_signed(self.ram[address])
+
+    def poke(self, address, value):
+        """Store the given (signed or unsigned) value at the given RAM address."""
+        self.ram[address] = value & WORD_MASK
@@ -0,0 +1,112 @@
+"""
+The idiom_miner module finds the sequences of VM commands (n-grams) that occur most often in a corpus of .vm files,
+such as the programs under vm_input. The most frequent idioms are the candidates for fused templates in the CodeWriter,
+like the in-place update of a segment slot or a move from one slot to another.
+
+Sequences are only counted within basic blocks: they never run past a goto, if-goto, call, or return, or into a label
+or function. By default, indices and constants are replaced by names, so that 'push local 2 / pop local 2' and
+'push local 5 / pop local 5' count as the same idiom 'push local a / pop local a' (a slot named twice gets the same
+name), while 'push local 2 / pop local 3' is 'push local a / pop local b'.
+
+Usage:
+    python idiom_miner.py [path ...] [--min-n N] [--max-n N] [--top N] [--exact]
+
+where each path is a .vm file or directory (searched recursively), or a program under vm_input. With no paths, the
+whole of vm_input is mined.
+"""
+import argparse
+import os
+from collections import Counter
+
+# VM commands that end a basic block, and those that start one.
+BLOCK_ENDING_COMMANDS = ['C_GOTO', 'C_IF', 'C_CALL', 'C_RETURN']
+BLOCK_STARTING_COMMANDS = ['C_LABEL', 'C_FUNCTION']
+
+SLOT_NAMES = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def basic_blocks(commands):
+    """Split a list of VMCommand records into the lists of commands of its basic blocks."""
+    blocks = []
+    block = []
+    for command in commands:
+        if command.type in BLOCK_STARTING_COMMANDS and block:
+            blocks.append(block)
+            block = []
+        block.append(command)
+        if command.type in BLOCK_ENDING_COMMANDS:
+            blocks.append(block)
+            block = []
+    if block:
+        blocks.append(block)
+    return blocks
+
+
+def idiom(commands, exact=False):
+    """
+    Return the text of a sequence of VMCommand records as an idiom, with the commands separated by ' / '. Unless exact,
+    the index of each push and pop is replaced by a name for its (segment, index) slot.
+    """
+    names = {}
+    parts = []
+    for command in commands:
+        if command.type in ['C_PUSH', 'C_POP'] and not exact:
+            slot = names.setdefault((command.arg1, command.arg2), SLOT_NAMES[len(names) % len(SLOT_NAMES)])
+            parts.append(f'{command.text.split()[0]} {command.arg1} {slot}')
+        else:
+            parts.append(' '.join(command.text.split()))
+    return ' / '.join(parts)
+
+
+def mine_idioms(commands, min_n=2, max_n=4, exact=False):
+    """
+    Return a Counter of how many times each idiom of min_n to max_n commands occurs in the given VMCommand records.
+    """
+    counts = Counter()
+    for block in basic_blocks(commands):
+        for start_idx in range(len(block)):
+            for n in range(min_n, min(max_n, len(block) - start_idx) + 1):
+                counts[idiom(block[start_idx:start_idx + n], exact)] += 1
+    return counts
+
+
+def read_corpus(paths):
+    """Parse every .vm file in the given paths (by default, vm_input) and return all of their VMCommand records, and the
+    number of files."""
+    import main
+
+    paths = paths or [os.path.join(main.PROGRAM_DIR, 'vm_input')]
+    program_files = [program_file for path in paths for program_file in main.read_program(path)]
+    return [command for _, commands in program_files for command in commands], len(program_files)
+
+
+def format_report(counts, num_commands, top=20):
+    """
+    Return a text table of the most frequent idioms, with how many commands they cover: each occurrence of an idiom
+    of n commands covers n of them (occurrences may overlap).
+    """
+    out = [f"{'count':>6} {'covers':>7}  idiom"]
+    ranked = sorted(counts.items(), key=lambda item: (-item[1] * (item[0].count(' / ') + 1), item[0]))
+    for text, count in ranked[:top]:
+        covered = count * (text.count(' / ') + 1)
+        out.append(f"{count:>6} {100 * covered / max(num_commands, 1):>6.1f}%  {text}")
+    out.append(f"(covers: the share of the corpus's {num_commands} commands in occurrences of the idiom)")
+    return '\n'.join(out)
+
+
+# ************************************************************************************************
+# Program begins here:
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Find the most frequent sequences of VM commands.')
+    arg_parser.add_argument('paths', nargs='*',
+                            help='The .vm files and directories to mine (default: vm_input).')
+    arg_parser.add_argument('--min-n', type=int, default=2, help='The fewest commands in an idiom.')
+    arg_parser.add_argument('--max-n', type=int, default=4, help='The most commands in an idiom.')
+    arg_parser.add_argument('--top', type=int, default=20, help='How many idioms to list.')
+    arg_parser.add_argument('--exact', action='store_true', help='Keep the indices and constants of the commands.')
+    args = arg_parser.parse_args()
+
+    corpus, num_files = read_corpus(args.paths)
+    print(f'Mined {len(corpus)} commands in {num_files} files.')
+    print(format_report(mine_idioms(corpus, args.min_n, args.max_n, args.exact), len(corpus), args.top))
@@ -0,0 +1,199 @@
+"""
+The instrumentation module measures the translator itself, to show where the time of a slow translation goes. While
+it is on, it records the wall time of each phase (parsing, laying out statics, and writing each file, and the time
+spent in marked functions like Parser.strip_comments, the error checks, and CodeWriter.write_output), the number of
+VM commands of each type, the number of instructions emitted for each kind of VM command, and the peak memory use
+(with tracemalloc).
+
+It is off by default (config.INSTRUMENTATION is None), and then costs next to nothing: the phases of each file are
+entered through a shared do-nothing context, and the marked functions are only wrapped in timers while a translation
+is instrumented. With 'json', a report is written next to the .asm file; with 'trace', a Chrome trace (for
+chrome://tracing or Perfetto) of the phases of each file, with the totals in the trace's metadata.
+
+Usage:
+    python main.py <program> --instrument {json,trace}
+"""
+import contextlib
+import json
+import os
+import time
+import tracemalloc
+from collections import Counter
+
+from profiler import command_kind
+
+# The instruments of the translation in progress, or None while instrumentation is off.
+ACTIVE = None
+
+# The do-nothing context phase() returns while instrumentation is off.
+NO_PHASE = contextlib.nullcontext()
+
+
+def instrumentation_path(output_file, kind):
+    """Return the path of the instrumentation report ('json') or Chrome trace ('trace') of the given .asm file."""
+    return os.path.splitext(output_file)[0] + ('.trace.json' if kind == 'trace' else '.instrumentation.json')
+
+
+def timed(phase):
+    """
+    Mark a function or method to be timed as the given phase while a translation is instrumented. Marking costs
+    nothing otherwise: start() swaps a timing wrapper in for each marked function, and stop() swaps the function back.
+    """
+    def mark(function):
+        function.instrumented_phase = phase
+        return function
+    return mark
+
+
+def phase(name, vm_file=None):
+    """Return a context that times the given phase (of one .vm file, if given) while instrumentation is on."""
+    return ACTIVE.phase(name, vm_file) if ACTIVE is not None else NO_PHASE
+
+
+class Instruments:
+    """
+    The Instruments class records the timings and counts of one instrumented translation.
+
+    Attributes:
+        program: The name of the program (its .asm file).
+        started: The perf_counter() time the translation started at.
+        phases: The [number of calls, seconds] of each phase; the times of nested phases are included in both.
+        file_phases: The seconds of each phase of each .vm file.
+        events: The Chrome trace events of the per-file phases.
+        command_types: The number of VM commands of each type.
+        instructions: The number of instructions emitted for each kind of VM command.
+        peak_memory: The most bytes allocated at once during the translation, once it has stopped.
+    """
+
+    def __init__(self, program):
+        self.program = program
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.file_phases = {}
+        self.events = []
+        self.command_types = Counter()
+        self.instructions = Counter()
+        self.peak_memory = None
+        self.current_file = None
+        self.patched = []       # The (owner, name, original) of each function wrapped in a timer.
+        self.started_tracemalloc = False
+
+    def add_time(self, name, seconds):
+        """Add the time of one call of the given phase, to the current file too."""
+        calls_seconds = self.phases.setdefault(name, [0, 0.0])
+        calls_seconds[0] += 1
+        calls_seconds[1] += seconds
+        if self.current_file is not None:
+            file_phases = self.file_phases.setdefault(self.current_file, {})
+            file_phases[name] = file_phases.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, name, vm_file=None):
+        """Time the given phase, of one .vm file if given, as a Chrome trace event as well."""
+        outer_file = self.current_file
+        if vm_file is not None:
+            self.current_file = os.path.basename(vm_file)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.add_time(name, end - start)
+            self.events.append({'name': name, 'cat': 'phase', 'ph': 'X', 'pid': 1, 'tid': 1,
+                                'ts': 1e6 * (start - self.started), 'dur': 1e6 * (end - start),
+                                'args': {'file': self.current_file} if self.current_file else {}})
+            if tracemalloc.is_tracing():
+                self.events.append({'name': 'memory', 'ph': 'C', 'pid': 1, 'ts': 1e6 * (end - self.started),
+                                    'args': {'bytes': tracemalloc.get_traced_memory()[0]}})
+            self.current_file = outer_file
+
+    def count_commands(self, commands):
+        """Count the VM commands of a parsed file by type."""
+        self.command_types.update(command.type for command in commands)
+
+    def count_instructions(self, command_text, num_instructions):
+        """Count the instructions emitted for one VM command (or fused group of commands starting with it)."""
+        self.instructions[command_kind(command_text)] += num_instructions
+
+    def timer(self, name, function):
+        """Return a wrapper of the given function that times each call of it as the given phase."""
+        def timed_function(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add_time(name, time.perf_counter() - start)
+        return timed_function
+
+    def start(self, owners):
+        """
+        Start instrumenting: wrap every marked function of the given classes and modules in a timer, and start
+        tracing memory allocations.
+        """
+        for owner in owners:
+            for name, function in list(vars(owner).items()):
+                if callable(function) and hasattr(function, 'instrumented_phase'):
+                    self.patched.append((owner, name, function))
+                    setattr(owner, name, self.timer(function.instrumented_phase, function))
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+
+    def stop(self):
+        """Stop instrumenting: put back the marked functions, and record the peak memory use."""
+        for owner, name, function in reversed(self.patched):
+            setattr(owner, name, function)
+        self.patched = []
+        if tracemalloc.is_tracing():
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+
+    def report(self):
+        """Return the timings and counts as a dictionary, ready to write as JSON."""
+        return {
+            'program': self.program,
+            'seconds': time.perf_counter() - self.started,
+            'peak_memory_bytes': self.peak_memory,
+            'phases': {name: {'calls': calls, 'seconds': seconds}
+                       for name, (calls, seconds) in sorted(self.phases.items(), key=lambda item: -item[1][1])},
+            'files': self.file_phases,
+            'command_types': dict(self.command_types.most_common()),
+            'instructions': dict(self.instructions.most_common()),
+        }
+
+    def trace(self):
+        """Return the phases as a Chrome trace (in its JSON object format), with the report in its metadata."""
+        return {'traceEvents': self.events, 'displayTimeUnit': 'ms', 'otherData': self.report()}
+
+
+def start(program):
+    """Start instrumenting the translation of the given program (its .asm file), and return the Instruments."""
+    import code_writer_module
+    import error_checker
+    import parser_module
+
+    global ACTIVE
+    ACTIVE = Instruments(os.path.basename(program))
+    # The parser imports the error checks with 'from error_checker import *', so they are wrapped in both modules.
+    ACTIVE.start([parser_module.Parser, parser_module, error_checker, code_writer_module.CodeWriter])
+    return ACTIVE
+
+
+def cancel():
+    """Stop instrumenting without writing a report, as after a translation that failed, and return the Instruments.
+    Does nothing (and returns None) while instrumentation is off."""
+    global ACTIVE
+    instruments, ACTIVE = ACTIVE, None
+    if instruments is not None:
+        instruments.stop()
+    return instruments
+
+
+def stop(output_file, kind):
+    """Stop instrumenting, write the report or trace of the given kind next to the .asm file, and return its path."""
+    instruments = cancel()
+    path = instrumentation_path(output_file, kind)
+    with open(path, 'w') as file:
+        json.dump(instruments.trace() if kind == 'trace' else instruments.report(), file, indent=1)
+    return path
@@ -10,120 +10,388 @@ compatible with the XHAL Assembler.
 Much of the un-optimized ASM code is based on Professor Bahn's basic VM translator.
 """
 
+import argparse
+import contextlib
+import io
 import os
-from sys import argv
 
 import config
-from parser_module import Parser
+import instrumentation
+from parser_module import Parser, VMCommand
 from code_writer_module import CodeWriter
-from error_checker import create_error_file
+from control_flow import locals_read_before_written, simplify_control_flow
+from dead_stores import eliminate_dead_stores
+from error_checker import create_error_file, lint_vm_files, write_error
+from frame_layout import plan_frame_layout
+from stack_analysis import analyze_commands, format_report as format_stack_report
+from static_layout import overflow_message, plan_static_layout
 
+PROGRAM_DIR = os.path.split(os.path.abspath(__file__))[0]
 
 # ************************************************************************************************
 # Main functions:
 
 
-def get_vm_files(input_path):
-    """Detect if there is one or several (a directory of) .vm files, and return a list of them.
+def parse_vm_file(input_file):
+    """
+    Parse one .vm file, checking it for errors, and return the list of its valid commands as VMCommand records.
     Arguments:
-        input_path: The path of this VM translator program.
+        input_file: The path of the .vm file to be parsed.
     """
-    vm_files = []
-    if os.path.isdir(input_path):
-        for _, _, files in os.walk(input_path, topdown=True):
-            print(f'All files: {files}')
-            # Ensure we grab only the .vm files.
-            for file in files:
-                print(str(file))
-                if str(file).endswith('.vm'):
-                    vm_files.append(file)
-        # Join the input path with the files to get the full paths.
-        vm_files = [os.path.join(input_path, f) for f in vm_files]
-        print(f'VM files: {vm_files}')
+    parser = Parser(input_file)
 
-    # Else there is only one vm file, so append it with .vm and add just it to the list.
-    else:
-        vm_files.append(input_path + ".vm")
+    print("Conducting first pass to collect labels.")
+    while parser.has_more_commands():
+        parser.advance()
+        parser.collect_fn_labels()
 
-    return vm_files
+    parser.reset_parser()
 
+    print("\n\n\n\n\nSecond pass\n\n")
+    commands = []
+    while parser.has_more_commands():
+        parser.advance()
+        print(f"\n\nCurrent command: {parser.current_command}")
+        parser.current_command_type = parser.command_type()
+        print(f"Current command type: {parser.current_command_type}")
 
-def process_vm_files(vm_files, output_path, input_path):
+        # If the command returns and error, it is invalid, so record the error and skip to the next command.
+        if parser.current_command_type in ['INVALID', 'COMMENT', 'BLANK']:
+            continue
+
+        arg1 = parser.arg1() if parser.current_command_type != 'C_RETURN' else None
+        arg2 = parser.arg2() if parser.current_command_type in ['C_PUSH', 'C_POP', 'C_FUNCTION', 'C_CALL'] else None
+        commands.append(VMCommand(parser.current_command_type, arg1, arg2, parser.current_line,
+                                  ' '.join(parser.current_command)))
+
+    return commands
+
+
+def match_update(command, following):
     """
-    Processes each of the .vm files, which includes both parsing them (one parser per file) and writing the translated
-    .asm code to output using one code_writer.
+    If a push command and the three commands following it are 'push x / push constant k / add (or sub) / pop x', which
+    updates x in place, return what is added to x (k, or -k). Otherwise return None.
+    """
+    if len(following) == 3 and following[0].type == 'C_PUSH' and following[0].arg1 == 'constant' and \
+            following[1].type == 'C_ARITHMETIC' and following[1].arg1 in ['add', 'sub'] and \
+            following[2].type == 'C_POP' and (following[2].arg1, following[2].arg2) == (command.arg1, command.arg2):
+        return following[0].arg2 if following[1].arg1 == 'add' else -following[0].arg2
+    return None
+
+
+def write_commands(code_writer, commands):
+    """
+    Write the translation of a list of VMCommand records (one .vm file's worth) using the given code_writer.
     Arguments:
-        vm_files: The list of .vm files to be translated.
-        output_path: The location of where the translated .asm code should go.
+        code_writer: The code_writer to write the translated .asm code with.
+        commands: The VMCommand records to be translated, in order.
+    """
+    if config.SIMPLIFY_CONTROL_FLOW:
+        commands = simplify_control_flow(commands)
+    if config.ELIMINATE_DEAD_STORES:
+        commands = eliminate_dead_stores(commands)
+
+    instruments = instrumentation.ACTIVE
+    command_idx = 0
+    while command_idx < len(commands):
+        command = commands[command_idx]
+        next_command = commands[command_idx + 1] if command_idx + 1 < len(commands) else None
+        command_idx += 1
+        first_instruction = code_writer.instruction_index
+
+        code_writer.set_source_line(command.line, command.text)
+
+        if command.type == 'C_PUSH':
+            update = match_update(command, commands[command_idx:command_idx + 3])
+            # A multiply, divide, or shift by a constant often has simpler code than the general routine.
+            if command.arg1 == 'constant' and next_command is not None and next_command.type == 'C_ARITHMETIC' and \
+                    code_writer.can_fold_constant(next_command.arg1, command.arg2):
+                code_writer.write_math_constant(next_command.arg1, command.arg2)
+                command_idx += 1
+            # Updating a slot in place, and moving a value from one slot to another, have fused templates.
+            elif update is not None and code_writer.can_fuse_update(command.arg1, command.arg2, update):
+                code_writer.write_update(command.arg1, command.arg2, update)
+                command_idx += 3
+            elif next_command is not None and next_command.type == 'C_POP' and \
+                    code_writer.can_fuse_move(command.arg1, command.arg2, next_command.arg1, next_command.arg2):
+                code_writer.write_move(command.arg1, command.arg2, next_command.arg1, next_command.arg2)
+                command_idx += 1
+            else:
+                code_writer.write_push_pop('C_PUSH', command.arg1, command.arg2)
+        elif command.type == 'C_POP' and command.arg1 == 'constant' and code_writer.can_merge_discards():
+            # A run of discards, like those left by dead store elimination, moves SP once.
+            count = 1
+            while command_idx < len(commands) and commands[command_idx].type == 'C_POP' and \
+                    commands[command_idx].arg1 == 'constant':
+                count += 1
+                command_idx += 1
+            code_writer.write_discard(count)
+        elif command.type == 'C_POP':
+            code_writer.write_push_pop('C_POP', command.arg1, command.arg2)
+        elif command.type == 'C_ARITHMETIC':
+            # A comparison that only feeds an if-goto can jump directly on its result when optimizing for speed.
+            if next_command is not None and next_command.type == 'C_IF' and \
+                    code_writer.can_fuse_comparison(command.arg1):
+                code_writer.write_compare_if(command.arg1, next_command.arg1)
+                command_idx += 1
+            else:
+                code_writer.write_arithmetic(command.arg1)
+        elif command.type == 'C_LABEL':
+            code_writer.write_label(command.arg1)
+        elif command.type == 'C_GOTO':
+            code_writer.write_goto(command.arg1)
+        elif command.type == 'C_IF':
+            code_writer.write_if(command.arg1)
+        elif command.type == 'C_FUNCTION':
+            # In optimized code, only the locals that may be read before they are written need initializing.
+            zeroed_locals = None
+            if code_writer.optimize_for is not None or code_writer.hot_functions is not None:
+                end_idx = next((function_idx for function_idx in range(command_idx, len(commands))
+                                if commands[function_idx].type == 'C_FUNCTION'), len(commands))
+                zeroed_locals = locals_read_before_written(commands[command_idx - 1:end_idx])
+            code_writer.write_function(command.arg1, command.arg2, zeroed_locals)
+        elif command.type == 'C_CALL':
+            code_writer.write_call(command.arg1, command.arg2)
+        elif command.type == 'C_RETURN':
+            code_writer.write_return()
+
+        if instruments is not None:
+            instruments.count_instructions(command.text, code_writer.instruction_index - first_instruction)
+
+
+def write_vm_file(code_writer, input_file, commands):
+    """
+    Write the translation of one parsed .vm file with the given code_writer, announcing it on the console.
+    Arguments:
+        code_writer: The code_writer to write the translated .asm code with, already told the file name.
+        input_file: The path of the .vm file.
+        commands: The VMCommand records of the file.
+    """
+    print(f"\nTRANSLATING FILE {input_file}")
+    write_commands(code_writer, commands)
+
+
+def plan_frames(program_files):
+    """
+    Return the frame layout that a program is translated with: the one plan_frame_layout() plans, with ELIDE_FRAME_SAVES
+    or optimized code, and otherwise an empty one, which gives every function the full frame.
+    Arguments:
+        program_files: The (.vm file, list of VMCommand records) of every file of the program, in translation order.
+    """
+    if not config.ELIDE_FRAME_SAVES and config.OPTIMIZATION is None:
+        return {}
+    with instrumentation.phase('plan frames'):
+        return plan_frame_layout(program_files)
+
+
+def write_program(code_writer, program_files, write_file=write_vm_file):
     """
-    # Instantiate a code_writer, opening the .asm output file and preparing it for being written to.
-    code_writer = CodeWriter(output_path, input_path)
+    Write the translation of a whole parsed program with the given code_writer, and close it: lay out the statics and
+    the call frames of the program, write the bootstrap code, and then write each file in turn. This is shared by
+    process_vm_files() and the batch builder, so both write exactly the same .asm code. Return the planned address of
+    each (file name, index) static, and the (file name, index, line) of the statics that don't fit.
+    Arguments:
+        code_writer: The code_writer to write the translated .asm code with.
+        program_files: The (.vm file, list of VMCommand records) of every file of the program, in translation order.
+        write_file: The function that writes one file, given the code_writer, the .vm file, and its commands.
+    """
+    with instrumentation.phase('plan statics'):
+        static_addresses, overflows = plan_static_layout(program_files)
+    if config.STATIC_LAYOUT:
+        code_writer.set_static_layout(static_addresses)
+    code_writer.set_frame_layout(plan_frames(program_files))
 
     # Write the bootstrap code at the top of the .asm file.
     code_writer.write_init()
 
-    # Process all the .vm files, parsing them and writing the translated .asm code to the output file.
-    for input_file in vm_files:
-        print(f"\nTRANSLATING FILE {input_file}")
+    # Write the translated .asm code of all the .vm files to the output file.
+    for input_file, commands in program_files:
         code_writer.set_file_name(input_file)
-        parser = Parser(input_file)
-
-        print("Conducting first pass to collect labels.")
-        while parser.has_more_commands():
-            parser.advance()
-            parser.collect_fn_labels()
-
-        parser.reset_parser()
-
-        print("\n\n\n\n\nSecond pass\n\n")
-        while parser.has_more_commands():
-            parser.advance()
-            print(f"\n\nCurrent command: {parser.current_command}")
-            parser.current_command_type = parser.command_type()
-            print(f"Current command type: {parser.current_command_type}")
-
-            # If the command returns and error, it is invalid, so record the error and skip to the next command.
-            if parser.current_command_type == 'INVALID':
-                continue
-
-            if parser.current_command_type == 'C_PUSH':
-                code_writer.write_push_pop('C_PUSH', parser.arg1(), parser.arg2())
-            elif parser.current_command_type == 'C_POP':
-                code_writer.write_push_pop('C_POP', parser.arg1(), parser.arg2())
-            elif parser.current_command_type == 'C_ARITHMETIC':
-                code_writer.write_arithmetic(parser.arg1())
-            elif parser.current_command_type == 'C_LABEL':
-                code_writer.write_label(parser.arg1())
-            elif parser.current_command_type == 'C_GOTO':
-                code_writer.write_goto(parser.arg1())
-            elif parser.current_command_type == 'C_IF':
-                code_writer.write_if(parser.arg1())
-            elif parser.current_command_type == 'C_FUNCTION':
-                code_writer.write_function(parser.arg1(), parser.arg2())
-            elif parser.current_command_type == 'C_CALL':
-                code_writer.write_call(parser.arg1(), parser.arg2())
-            elif parser.current_command_type == 'C_RETURN':
-                code_writer.write_return()
+        with instrumentation.phase('write', input_file):
+            write_file(code_writer, input_file, commands)
 
     # Close the output file.
-    code_writer.close()
+    with instrumentation.phase('close'):
+        code_writer.close()
+    return static_addresses, overflows
+
+
+def process_vm_files(vm_files, output_path, input_path):
+    """
+    Processes each of the .vm files, which includes both parsing them (one parser per file) and writing the translated
+    .asm code to output using one code_writer. All the files are parsed first, so the statics of the whole program can
+    be laid out in RAM before any code is written. Return the planned address of each (file name, index) static.
+    Arguments:
+        vm_files: The list of .vm files to be translated, from find_vm_files().
+        output_path: The location of where the translated .asm code should go.
+    """
+    # With instrumentation on, the translator times its own phases and counts what it parses and writes.
+    instruments = instrumentation.start(output_path) if config.INSTRUMENTATION else None
+    try:
+        # Instantiate a code_writer, opening the .asm output file and preparing it for being written to.
+        code_writer = CodeWriter(output_path, input_path)
+
+        # Parse all the .vm files, then write the whole program.
+        program_files = []
+        for input_file in vm_files:
+            print(f"\nPARSING FILE {input_file}")
+            with instrumentation.phase('parse', input_file):
+                program_files.append((input_file, parse_vm_file(input_file)))
+            if instruments is not None:
+                instruments.count_commands(program_files[-1][1])
+        static_addresses, overflows = write_program(code_writer, program_files)
+        for file_name, index, line in overflows:
+            write_error(line, overflow_message(file_name, index))
+
+        if code_writer.prologues:
+            print(format_prologue_report(code_writer.prologues))
+        functions = analyze_commands([command for _, commands in program_files for command in commands],
+                                     code_writer.shared_routines)[1]
+        print(format_stack_report(functions, code_writer.frames, code_writer.hot_functions))
+        if instruments is not None:
+            print(f"\nTRANSLATOR INSTRUMENTATION: {instrumentation.stop(output_path, config.INSTRUMENTATION)}")
+    finally:
+        # A translation that fails must not leave the timers in place for the rest of the process.
+        if instruments is not None:
+            instrumentation.cancel()
+    return static_addresses
+
+
+def format_prologue_report(prologues):
+    """
+    Return a line summarizing the function prologues chosen by the cost model, and what they save over pushing 0 for
+    every local.
+    Arguments:
+        prologues: The (function, strategy, words, cycles, push words, push cycles) records of a code_writer.
+    """
+    strategies = {}
+    for prologue in prologues:
+        strategies[prologue[1]] = strategies.get(prologue[1], 0) + 1
+    saved_words = sum(prologue[4] - prologue[2] for prologue in prologues)
+    saved_cycles = sum(prologue[5] - prologue[3] for prologue in prologues)
+    return (f"\nFUNCTION PROLOGUES: {', '.join(f'{count} {strategy}' for strategy, count in sorted(strategies.items()))}"
+            f"; saved {saved_words} ROM words, and {saved_cycles} cycles over one call of each function.")
+
+
+def translate_program(program_name):
+    """
+    Translate the named program (a .vm file or a directory of .vm files under vm_input) into one .asm file under
+    asm_output, and return the path of the .asm file.
+    Arguments:
+        program_name: The name of the program, relative to vm_input, without the .vm extension.
+    """
+    # Open a .asm file for writing the assembly output code to.
+    # Relative file location code from
+    # https://stackoverflow.com/questions/7165749/open-file-in-a-relative-location-in-python
+    input_file_or_dir_path = os.path.join(PROGRAM_DIR, "vm_input", program_name)
+    output_file_path = os.path.join(PROGRAM_DIR, "asm_output", program_name + ".asm")
+
+    # Create and open an error file if the option to is set.
+    if config.WRITE_ERRORS_TO_LOG:
+        open(create_error_file(program_name), "w").close()
+
+    input_files = find_vm_files(input_file_or_dir_path)
+    process_vm_files(input_files, output_file_path, input_file_or_dir_path)
+    return output_file_path
+
+
+def find_vm_files(path):
+    """
+    Return every .vm file in the given path: the file itself, or every .vm file in the directory and its
+    subdirectories. Paths that don't exist are looked up under vm_input, like the programs translate_program() takes.
+    Arguments:
+        path: A .vm file or a directory, with or without the .vm extension for a file.
+    """
+    if not os.path.exists(path):
+        path = os.path.join(PROGRAM_DIR, "vm_input", path)
+    if os.path.isdir(path):
+        return sorted(os.path.join(directory, file) for directory, _, files in os.walk(path)
+                      for file in files if file.endswith('.vm'))
+    return [path if path.endswith('.vm') or os.path.exists(path) else path + '.vm']
+
+
+def read_program(program):
+    """
+    Quietly parse every .vm file of a program, for the tools that analyze programs without translating them: nothing
+    is printed, and errors are not written to the error log. Return the (.vm file, list of VMCommand records) of every
+    file, in the order main.py translates them.
+    Arguments:
+        program: A .vm file (without the extension) or directory under vm_input, as for main.py, or the path of one.
+    """
+    write_errors_to_log = config.WRITE_ERRORS_TO_LOG
+    config.WRITE_ERRORS_TO_LOG = False
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return [(vm_file, parse_vm_file(vm_file)) for vm_file in find_vm_files(program)]
+    finally:
+        config.WRITE_ERRORS_TO_LOG = write_errors_to_log
+
+
+def check_programs(paths, workers=None):
+    """
+    Check the .vm files of the given files and directories for errors without translating them, printing each error.
+    Return the number of errors found.
+    Arguments:
+        paths: The .vm files and directories to check.
+        workers: The number of worker processes to check the files with (by default, one per CPU).
+    """
+    vm_files = [vm_file for path in paths for vm_file in find_vm_files(path)]
+    results = lint_vm_files(vm_files, workers)
+
+    num_errors = 0
+    for vm_file, errors in results.items():
+        for line, message in errors:
+            print(f'{vm_file}:{line}: {message}')
+        num_errors += len(errors)
+    print(f'Checked {len(vm_files)} files: {num_errors} errors in '
+          f'{sum(1 for errors in results.values() if errors)} files.')
+    return num_errors
 
 
 # ************************************************************************************************
 # Program begins here:
 
-# Open a .asm file for writing the assembly output code to.
-# Relative file location code from
-# https://stackoverflow.com/questions/7165749/open-file-in-a-relative-location-in-python
-program_path = os.path.abspath(__file__)
-program_dir = os.path.split(program_path)[0]
-input_file_or_dir_path = os.path.join(program_dir, "vm_input", argv[1])
-output_file_path = os.path.join(program_dir, "asm_output", argv[1] + ".asm")
-
-# Create and open an error file if the option to is set.
-error_file = None
-if config.WRITE_ERRORS_TO_LOG:
-    error_file = open(create_error_file(argv[1]), "w")
-
-input_files = get_vm_files(input_file_or_dir_path)
-process_vm_files(input_files, output_file_path, input_file_or_dir_path)
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Translate a VM program into Hack assembly.')
+    arg_parser.add_argument('program', nargs='+', help='The .vm file (without extension) or directory under vm_input. '
+                                                       'With --check, any number of .vm files and directories.')
+    arg_parser.add_argument('--check', action='store_true', help='Only check the programs for errors, without '
+                                                                 'translating them. Exits with 1 if there are errors.')
+    arg_parser.add_argument('--workers', type=int, help='With --check, the number of worker processes to use.')
+    arg_parser.add_argument('--optimize', choices=['speed', 'size'], help='Use the speed or size templates throughout.')
+    arg_parser.add_argument('--profile', help='A profile recorded by pgo.py, to optimize hot functions for speed and '
+                                              'the rest for size.')
+    arg_parser.add_argument('--defer-sp', action='store_true', help='Update SP once per basic block instead of on '
+                                                                    'every push and pop.')
+    arg_parser.add_argument('--simplify-jumps', action='store_true', help='Thread jumps, and drop jumps to the next '
+                                                                          'label and unreachable code.')
+    arg_parser.add_argument('--share-calls', action='store_true', help='Make every call jump to a stub shared by '
+                                                                       'the calls of the same function.')
+    arg_parser.add_argument('--elide-frame-saves', action='store_true', help='Save THIS and THAT in the frame of a '
+                                                                             'call only if the callee may change them.')
+    arg_parser.add_argument('--dead-stores', action='store_true', help='Discard pops to temp, local, and pointer '
+                                                                       'slots that nothing reads after them.')
+    arg_parser.add_argument('--symbolic-statics', action='store_true', help='Write statics as File.i symbols for '
+                                                                            'the assembler to allocate.')
+    arg_parser.add_argument('--instrument', choices=['json', 'trace'], help="Time the translator's own phases, and "
+                                                                            'write a JSON report or a Chrome trace.')
+    arg_parser.add_argument('--hack', action='store_true', help='Also assemble the program and write a .hack file.')
+    arg_parser.add_argument('--hack-only', action='store_true', help='Write only the .hack file, without the .asm.')
+    args = arg_parser.parse_args()
+
+    config.EMIT_HACK = args.hack or args.hack_only or config.EMIT_HACK
+    config.WRITE_ASM = not args.hack_only and config.WRITE_ASM
+    if args.check:
+        exit(1 if check_programs(args.program, args.workers) else 0)
+
+    config.DEFER_SP_UPDATES = args.defer_sp or config.DEFER_SP_UPDATES
+    config.SIMPLIFY_CONTROL_FLOW = args.simplify_jumps or config.SIMPLIFY_CONTROL_FLOW
+    config.STATIC_LAYOUT = not args.symbolic_statics and config.STATIC_LAYOUT
+    config.SHARE_CALL_STUBS = args.share_calls or config.SHARE_CALL_STUBS
+    config.ELIDE_FRAME_SAVES = args.elide_frame_saves or config.ELIDE_FRAME_SAVES
+    config.ELIMINATE_DEAD_STORES = args.dead_stores or config.ELIMINATE_DEAD_STORES
+    config.INSTRUMENTATION = args.instrument or config.INSTRUMENTATION
+    config.OPTIMIZATION = args.optimize or config.OPTIMIZATION
+    config.PROFILE_FILE = args.profile or config.PROFILE_FILE
+    for program in args.program:
+        translate_program(program)
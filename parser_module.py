@@ -1,12 +1,18 @@
 """
-The parser module exports the Parser class.
+The parser module exports the Parser class and the VMCommand record.
 
 Parser class: Handles the parsing of a single .vm file. One parser will be created for each input file.
+VMCommand: One parsed, error-checked VM command, as handed from the parser to the code_writer.
 """
 import re
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 
 from error_checker import *
+from instrumentation import timed
+
+# One parsed VM command. type is the command type (like 'C_PUSH'), arg1 and arg2 are the values of Parser.arg1() and
+# Parser.arg2() (None where they don't apply), line is the line number in the .vm file, and text is the command itself.
+VMCommand = namedtuple('VMCommand', ['type', 'arg1', 'arg2', 'line', 'text'])
 
 
 class Parser:
@@ -32,6 +38,7 @@ class Parser:
     regex_binary = re.compile(r'^0b|0B.*')
     regex_hex = re.compile(r'^0x|0X.*')
 
+    @timed('read file')
     def __init__(self, input_file):
         """Construct the Parser object and open the given .vm input file to enable parsing of it.
 
@@ -48,6 +55,7 @@ class Parser:
 
         # Initialize variables.
         self.command_idx = 0
+        self.current_line = 0
         self.current_command = None
         self.current_command_type = None
         self.current_function = None
@@ -73,6 +81,11 @@ class Parser:
             'l-and': 'C_ARITHMETIC',    # XVM
             'l-or': 'C_ARITHMETIC',     # XVM
             'l-xor': 'C_ARITHMETIC',    # XVM
+            'mult': 'C_ARITHMETIC',     # XVM
+            'div': 'C_ARITHMETIC',      # XVM
+            'mod': 'C_ARITHMETIC',      # XVM
+            'shl': 'C_ARITHMETIC',      # XVM
+            'shr': 'C_ARITHMETIC',      # XVM
             'push': 'C_PUSH',
             'pop': 'C_POP',
             'label': 'C_LABEL',
@@ -95,6 +108,7 @@ class Parser:
         otherwise."""
         self.current_command = self.command_list[self.command_idx]
         self.command_idx += 1
+        self.current_line = self.command_idx     # Line numbers are 1-based, so this is the line just read.
         return self.current_command
 
     def command_type(self):
@@ -189,6 +203,7 @@ class Parser:
         translated_arg = self.translate_bin_hex(self.current_command[2])
         return int(translated_arg)
 
+    @timed('strip comments')
     def strip_comments(self, current_command):
         """Edit the current command, stripping off any inline comments."""
         comment_text = self.regex_comment.search(current_command)
@@ -200,6 +215,7 @@ class Parser:
     def reset_parser(self):
         """Reset the command index of the parser so that the VMT can run through the VM code multiple times."""
         self.command_idx = 0
+        self.current_line = 0
         self.current_command = None
 
     def collect_fn_labels(self):
@@ -224,6 +240,7 @@ class Parser:
                 self.function_dict[self.current_function].append(self.current_command[1])
                 print(f"CURRENT FN DICT: {self.function_dict}")
 
+    @timed('translate bin/hex')
     def translate_bin_hex(self, content):
         """Detect if the content of the command is written in binary or hexadecimal, then translate and redefine the
         content into decimal and return that value."""
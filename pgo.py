@@ -0,0 +1,206 @@
+"""
+The pgo module drives profile-guided optimization, which is a two-phase build:
+
+    1. Translate the program with the plain templates, run it in the hack_executor, and record how many times each
+       VM function and each basic block executed (and how many cycles they took) in a profile file.
+    2. Translate the program again with config.PROFILE_FILE set to that profile. The CodeWriter then uses the
+       'speed' templates (inlined and fused) only in hot basic blocks and the 'size' templates (shared routines)
+       everywhere else. A profile without block counts picks the templates of whole functions instead.
+
+Usage:
+    python pgo.py <program> [--profile FILE] [--max-cycles N]
+"""
+import argparse
+import contextlib
+import io
+import json
+
+import config
+
+PROFILE_VERSION = 1
+
+# VM commands that end a basic block, and those that start one.
+BLOCK_ENDING_COMMANDS = ['goto', 'if-goto', 'call', 'return']
+BLOCK_STARTING_COMMANDS = ['function', 'label']
+
+
+def block_leaders(source_map):
+    """Return the indices of the source map rows that start a basic block of VM commands."""
+    leaders = []
+    previous = None
+    for row_idx, row in enumerate(source_map.rows):
+        command = source_map.commands[row[4]].split()[0]
+        if previous is None or command in BLOCK_STARTING_COMMANDS or previous in BLOCK_ENDING_COMMANDS or \
+                row[3] != source_map.rows[row_idx - 1][3]:
+            leaders.append(row_idx)
+        previous = command
+    return leaders
+
+
+def record_profile(program_name, profile_file, max_cycles=10_000_000):
+    """
+    Do the first phase of a profile-guided build: translate the named program with the plain templates, run it, and
+    write the per-function and per-basic-block execution counts to profile_file. Return the recorded profile.
+
+    Arguments:
+        program_name: The .vm file (without extension) or directory under vm_input.
+        profile_file: The path of the profile file to write.
+        max_cycles: The most cycles to run the program for.
+    """
+    from profiler import build_program
+
+    optimization, profile = config.OPTIMIZATION, config.PROFILE_FILE
+    config.OPTIMIZATION, config.PROFILE_FILE = None, None
+    try:
+        asm_file, map_file = build_program(program_name)
+    finally:
+        config.OPTIMIZATION, config.PROFILE_FILE = optimization, profile
+
+    return write_profile(program_name, asm_file, map_file, profile_file, max_cycles)
+
+
+def write_profile(program_name, asm_file, map_file, profile_file, max_cycles=10_000_000):
+    """
+    Run an .asm file translated with the plain templates, and write the per-function and per-basic-block execution
+    counts to profile_file. Return the recorded profile.
+
+    Arguments:
+        program_name: The name of the program, recorded in the profile.
+        asm_file: The .asm file to run.
+        map_file: The source map written alongside it.
+        profile_file: The path of the profile file to write.
+        max_cycles: The most cycles to run the program for.
+    """
+    from profiler import profile_program
+    from source_map import SourceMap
+
+    run = profile_program(asm_file, map_file, max_cycles)
+    source_map = SourceMap.load(map_file)
+    counts = run.instruction_counts
+
+    # A block runs as many times as its first instruction, and its cycles are those of all its instructions.
+    blocks = {}
+    leaders = block_leaders(source_map)
+    for leader_idx, row_idx in enumerate(leaders):
+        start, file_id, line, function_id, command_id = source_map.rows[row_idx]
+        end = source_map.rows[leaders[leader_idx + 1]][0] if leader_idx + 1 < len(leaders) else len(counts)
+        blocks.setdefault(source_map.functions[function_id], []).append({
+            'file': source_map.files[file_id],
+            'line': line,
+            'command': source_map.commands[command_id],
+            'count': counts[start] if start < len(counts) else 0,
+            'cycles': sum(counts[start:end]),
+        })
+
+    recorded = {
+        'version': PROFILE_VERSION,
+        'program': program_name,
+        'total_cycles': run.total_cycles,
+        'halted': run.halted,
+        'functions': {function: {'cycles': run.self_cycles[function],
+                                 'inclusive_cycles': run.inclusive_cycles[function],
+                                 'calls': run.calls[function]}
+                      for function in source_map.functions if function and function != '..BOOT..'},
+        'blocks': blocks,
+    }
+    with open(profile_file, 'w') as file:
+        json.dump(recorded, file, indent=1)
+    return recorded
+
+
+def load_profile(profile_file):
+    """Read a profile written by record_profile()."""
+    with open(profile_file, 'r') as file:
+        return json.load(file)
+
+
+def hottest(cycles, fraction=None):
+    """
+    Return the set of the fewest keys of the given dictionary of cycles that together account for the given fraction
+    (by default config.HOT_CYCLE_FRACTION) of all its cycles.
+    """
+    if fraction is None:
+        fraction = config.HOT_CYCLE_FRACTION
+    total = sum(cycles.values())
+
+    hot = set()
+    covered = 0
+    for key, key_cycles in sorted(cycles.items(), key=lambda item: -item[1]):
+        if covered >= fraction * total or not key_cycles:
+            break
+        hot.add(key)
+        covered += key_cycles
+    return hot
+
+
+def hot_functions(profile, fraction=None):
+    """
+    Return the set of hot functions in the given profile: those with a hot basic block (see block_templates()), which
+    are the functions that may use the 'speed' templates. Without block counts, they are the fewest functions that
+    together account for the given fraction (by default config.HOT_CYCLE_FRACTION) of the cycles spent in functions.
+    """
+    templates = block_templates(profile, fraction)
+    if templates is not None:
+        return {function for function, blocks in profile['blocks'].items()
+                if any(templates.get((block['file'], block['line'])) == 'speed' for block in blocks)}
+    return hottest({function: stats['cycles'] for function, stats in profile['functions'].items()}, fraction)
+
+
+def block_templates(profile, fraction=None):
+    """
+    Return the templates ('speed' or 'size') of every basic block in the given profile, by the (.vm file, line) of its
+    first command, or None if the profile has no block counts. The hot blocks, the fewest that together account for
+    the given fraction (by default config.HOT_CYCLE_FRACTION) of the cycles spent in functions, get 'speed'.
+    """
+    if 'blocks' not in profile:
+        return None
+    cycles = {(block['file'], block['line']): block['cycles'] for function, blocks in profile['blocks'].items()
+              if function and function != '..BOOT..' for block in blocks}
+    hot = hottest(cycles, fraction)
+    return {block: 'speed' if block in hot else 'size' for block in cycles}
+
+
+def build_with_profile(program_name, profile_file):
+    """Do the second phase of a profile-guided build: translate the named program using the given profile, and
+    return the path of the .asm file."""
+    import main
+
+    profile = config.PROFILE_FILE
+    config.PROFILE_FILE = profile_file
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return main.translate_program(program_name)
+    finally:
+        config.PROFILE_FILE = profile
+
+
+# ************************************************************************************************
+# Program begins here:
+
+if __name__ == '__main__':
+    import os
+
+    import main
+    from hack_assembler import assemble_file
+    from hack_executor import HackExecutor
+
+    arg_parser = argparse.ArgumentParser(description='Build a VM program with profile-guided optimization.')
+    arg_parser.add_argument('program', help='The .vm file (without extension) or directory under vm_input.')
+    arg_parser.add_argument('--profile', help='Where to write the profile (default asm_output/<program>.profile.json).')
+    arg_parser.add_argument('--max-cycles', type=int, default=10_000_000, help='Stop profiling after this many cycles.')
+    args = arg_parser.parse_args()
+
+    asm_path = os.path.join(main.PROGRAM_DIR, 'asm_output', args.program + '.asm')
+    profile_path = args.profile or os.path.splitext(asm_path)[0] + '.profile.json'
+    program_profile = record_profile(args.program, profile_path, args.max_cycles)
+    baseline_size = len(assemble_file(asm_path))
+    print(f"Recorded profile of {program_profile['total_cycles']} cycles to {profile_path}")
+    print(f"Hot functions: {', '.join(sorted(hot_functions(program_profile))) or '(none)'}")
+    program_blocks = block_templates(program_profile)
+    print(f"Hot basic blocks: {list(program_blocks.values()).count('speed')} of {len(program_blocks)}")
+
+    optimized_asm = build_with_profile(args.program, profile_path)
+    executor = HackExecutor.from_asm_file(optimized_asm)
+    executor.run(max_cycles=args.max_cycles)
+    print(f"ROM words: {baseline_size} -> {len(executor.rom)}")
+    print(f"Cycles:    {program_profile['total_cycles']} -> {executor.cycles}")
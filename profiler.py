@@ -0,0 +1,236 @@
+"""
+The profiler module runs a translated program in the hack_executor and reports where its cycles go: per VM function
+(flat profile and call graph), per kind of VM command, and per VM source line.
+
+Usage:
+    python profiler.py <program> [--max-cycles N] [--top N] [--json FILE]
+
+Hack executes one instruction per clock cycle, so the cycle counts here are the same as instruction counts.
+"""
+import argparse
+import contextlib
+import io
+import json
+from collections import Counter, defaultdict
+
+import config
+from hack_executor import HackExecutor
+from source_map import SourceMap, source_map_path
+
+COMPARISON_COMMANDS = ['eq', 'gt', 'lt', 'le', 'ge', 'ne']
+
+
+def command_kind(command):
+    """Return the kind of a VM command used to group the profile, such as 'push local', 'call', or 'compare eq'."""
+    parts = command.split()
+    if not parts:
+        return 'unknown'
+    if parts[0] in ['push', 'pop'] and len(parts) > 1:
+        return f'{parts[0]} {parts[1]}'
+    if parts[0] in COMPARISON_COMMANDS:
+        return f'compare {parts[0]}'
+    return parts[0]
+
+
+def build_program(program_name):
+    """Translate the named program with a source map, silencing the translator's console output, and return the
+    paths of the .asm file and its source map."""
+    import main
+
+    write_source_map = config.WRITE_SOURCE_MAP
+    config.WRITE_SOURCE_MAP = True
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            asm_file = main.translate_program(program_name)
+    finally:
+        config.WRITE_SOURCE_MAP = write_source_map
+    return asm_file, source_map_path(asm_file)
+
+
+class Profile:
+    """
+    The Profile class holds the results of one profiled run.
+
+    Attributes:
+        total_cycles: The number of cycles the run took.
+        halted: True if the program halted before the cycle limit.
+        self_cycles: Cycles spent in each function's own instructions.
+        inclusive_cycles: Cycles spent in each function and everything it called.
+        calls: The number of times each function was called.
+        edges: (calls, inclusive cycles) for each (caller, callee) pair.
+        kinds: (cycles, executions) for each kind of VM command.
+        lines: Cycles for each (vm file, line, VM command).
+        instruction_counts: The number of times each ROM address was executed.
+    """
+
+    def __init__(self):
+        self.total_cycles = 0
+        self.halted = False
+        self.self_cycles = Counter()
+        self.inclusive_cycles = Counter()
+        self.calls = Counter()
+        self.edges = defaultdict(lambda: [0, 0])
+        self.kinds = defaultdict(lambda: [0, 0])
+        self.lines = Counter()
+        self.instruction_counts = []
+
+    def to_dict(self):
+        """Return the profile as a JSON-serializable dictionary."""
+        return {
+            'total_cycles': self.total_cycles,
+            'halted': self.halted,
+            'functions': {function: {'self_cycles': self.self_cycles[function],
+                                     'inclusive_cycles': self.inclusive_cycles[function],
+                                     'calls': self.calls[function]}
+                          for function in self.self_cycles},
+            'call_graph': [{'caller': caller, 'callee': callee, 'calls': calls, 'inclusive_cycles': cycles}
+                           for (caller, callee), (calls, cycles) in self.edges.items()],
+            'kinds': {kind: {'cycles': cycles, 'executions': executions}
+                      for kind, (cycles, executions) in self.kinds.items()},
+            'lines': [{'file': vm_file, 'line': line, 'command': command, 'cycles': cycles}
+                      for (vm_file, line, command), cycles in self.lines.most_common()],
+        }
+
+
+def profile_program(asm_file, map_file, max_cycles=10_000_000):
+    """
+    Run the given .asm file in the hack_executor and attribute every executed instruction to its VM source using the
+    given source map. Return a Profile.
+
+    Arguments:
+        asm_file: The translated .asm file.
+        map_file: The source map written alongside it.
+        max_cycles: The most cycles to run before stopping.
+    """
+    executor = HackExecutor.from_asm_file(asm_file)
+    source_map = SourceMap.load(map_file)
+    num_instructions = len(executor.rom)
+
+    # Expand the source map into per-instruction lookups.
+    row_of = [None] * num_instructions
+    starts = [row[0] for row in source_map.rows] + [num_instructions]
+    for row_idx, row in enumerate(source_map.rows):
+        for address in range(starts[row_idx], min(starts[row_idx + 1], num_instructions)):
+            row_of[address] = row_idx
+    kind_of = [command_kind(source_map.commands[source_map.rows[row_idx][4]]) if row_idx is not None else 'unknown'
+               for row_idx in row_of]
+
+    # Each function's entry point is the first instruction of its 'function' command.
+    entries = {}
+    for row in source_map.rows:
+        if source_map.commands[row[4]].startswith('function '):
+            entries[row[0]] = source_map.functions[row[3]]
+
+    profile = Profile()
+    stack = []      # The shadow call stack of (callee, caller, cycle of the call, return address) frames.
+    # A call through a shared call stub jumps to the stub first; the call returns to the instruction after that jump.
+    stub_return = [None]
+
+    def jump_hook(from_pc, to_pc, cycle):
+        if to_pc in entries and kind_of[from_pc] == 'call':
+            callee = entries[to_pc]
+            caller = stack[-1][0] if stack else source_map.functions[source_map.rows[row_of[from_pc]][3]]
+            return_address = stub_return[0] if stub_return[0] is not None else from_pc + 1
+            stub_return[0] = None
+            stack.append((callee, caller, cycle, return_address))
+            profile.calls[callee] += 1
+            profile.edges[(caller, callee)][0] += 1
+        elif kind_of[from_pc] == 'call':
+            stub_return[0] = from_pc + 1
+        elif stack and to_pc == stack[-1][3]:
+            # Only the jump back to the caller ends the call: a return may first jump to a shared return routine.
+            close_frame(cycle)
+
+    def close_frame(cycle):
+        callee, caller, start, _ = stack.pop()
+        elapsed = cycle - start
+        # Don't count the time of a recursive call twice.
+        if callee not in [frame[0] for frame in stack]:
+            profile.inclusive_cycles[callee] += elapsed
+        profile.edges[(caller, callee)][1] += elapsed
+
+    profile.halted = executor.run(max_cycles=max_cycles, jump_hook=jump_hook)
+    profile.total_cycles = executor.cycles
+    profile.instruction_counts = executor.counts[:num_instructions]
+
+    # Functions that never returned (like Sys.init) ran until the end.
+    while stack:
+        close_frame(profile.total_cycles)
+
+    # Attribute the executed instructions to their functions, command kinds, and source lines.
+    for address in range(num_instructions):
+        count = executor.counts[address]
+        row_idx = row_of[address]
+        if not count or row_idx is None:
+            continue
+        _, file_id, line, function_id, command_id = source_map.rows[row_idx]
+        function = source_map.functions[function_id]
+        profile.self_cycles[function] += count
+        profile.kinds[kind_of[address]][0] += count
+        # The first instruction of a command runs once per execution of the command.
+        if address == source_map.rows[row_idx][0]:
+            profile.kinds[kind_of[address]][1] += count
+        profile.lines[(source_map.files[file_id], line, source_map.commands[command_id])] += count
+
+    return profile
+
+
+def format_report(profile, top=20):
+    """Return a text report of the given profile: a flat profile, a call graph, the command kinds, and the hottest
+    source lines."""
+    total = max(profile.total_cycles, 1)
+    out = [f"Total cycles: {profile.total_cycles}" + ("" if profile.halted else " (cycle limit reached)"), ""]
+
+    out.append("Flat profile")
+    out.append(f"{'self %':>7} {'self':>10} {'inclusive':>10} {'calls':>7} {'self/call':>10}  function")
+    for function, cycles in profile.self_cycles.most_common():
+        calls = profile.calls[function]
+        per_call = f'{cycles / calls:.1f}' if calls else '-'
+        out.append(f"{100 * cycles / total:7.2f} {cycles:10} {profile.inclusive_cycles[function]:10} {calls:7} "
+                   f"{per_call:>10}  {function}")
+    out.append("")
+
+    out.append("Call graph")
+    for function, _ in sorted(profile.self_cycles.items(), key=lambda item: -profile.inclusive_cycles[item[0]]):
+        out.append(f"{function}  (inclusive {profile.inclusive_cycles[function]}, self "
+                   f"{profile.self_cycles[function]}, {profile.calls[function]} calls)")
+        for (caller, callee), (calls, cycles) in sorted(profile.edges.items()):
+            if callee == function:
+                out.append(f"    called by {caller}: {calls} calls")
+        for (caller, callee), (calls, cycles) in sorted(profile.edges.items()):
+            if caller == function:
+                out.append(f"    calls {callee}: {calls} calls, {cycles} cycles")
+    out.append("")
+
+    out.append("VM command kinds")
+    out.append(f"{'%':>7} {'cycles':>10} {'executed':>9} {'cycles/exec':>11}  kind")
+    for kind, (cycles, executions) in sorted(profile.kinds.items(), key=lambda item: -item[1][0]):
+        per_exec = f'{cycles / executions:.1f}' if executions else '-'
+        out.append(f"{100 * cycles / total:7.2f} {cycles:10} {executions:9} {per_exec:>11}  {kind}")
+    out.append("")
+
+    out.append(f"Hottest {top} VM lines")
+    for (vm_file, line, command), cycles in profile.lines.most_common(top):
+        location = f'{vm_file}:{line}' if vm_file else '(bootstrap)'
+        out.append(f"{100 * cycles / total:7.2f} {cycles:10}  {location:<20} {command}")
+
+    return '\n'.join(out)
+
+
+# ************************************************************************************************
+# Program begins here:
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Profile a translated VM program in the Hack executor.')
+    arg_parser.add_argument('program', help='The .vm file (without extension) or directory under vm_input.')
+    arg_parser.add_argument('--max-cycles', type=int, default=10_000_000, help='Stop after this many cycles.')
+    arg_parser.add_argument('--top', type=int, default=20, help='How many of the hottest VM lines to list.')
+    arg_parser.add_argument('--json', help='Also write the profile to this JSON file.')
+    args = arg_parser.parse_args()
+
+    asm_path, map_path = build_program(args.program)
+    program_profile = profile_program(asm_path, map_path, args.max_cycles)
+    print(format_report(program_profile, args.top))
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(program_profile.to_dict(), json_file, indent=2)
@@ -0,0 +1,103 @@
+"""
+The source_map module exports the SourceMap class.
+
+SourceMap class: Records which VM file, line, function, and command each emitted assembly instruction came from, and
+reads/writes that mapping as a compact side-car JSON file next to the .asm output.
+"""
+import bisect
+import json
+
+
+class SourceMap:
+    """
+    The SourceMap class maps assembly instruction indices (ROM addresses, not counting labels or comments) back to the
+    VM command they were translated from. Consecutive instructions from the same VM command share one row, and file
+    names, function names, and command strings are each stored once in a string table, so the map stays small.
+
+    Methods:
+        __init__: Constructs an empty source map.
+        record: Records that the instructions starting at the given index belong to the given VM command.
+        lookup: Returns the (vm file, line, function, VM command) that produced the given instruction index.
+        write: Writes the source map to a JSON file.
+        load: Reads a source map back from a JSON file.
+    """
+
+    VERSION = 1
+
+    def __init__(self):
+        """Construct an empty source map."""
+        self.files = []
+        self.functions = []
+        self.commands = []
+        # Each row is [first instruction index, file id, line, function id, command id].
+        self.rows = []
+
+        self._starts = []
+        self._string_ids = ({}, {}, {})
+
+    def _intern(self, table_idx, table, value):
+        """Return the id of value in the given string table, adding it if it is not there yet."""
+        ids = self._string_ids[table_idx]
+        if value not in ids:
+            ids[value] = len(table)
+            table.append(value)
+        return ids[value]
+
+    def record(self, instruction_index, vm_file, line, function, command):
+        """Record that the instructions starting at instruction_index were translated from the given VM command.
+
+        Arguments:
+            instruction_index: The ROM address of the first instruction emitted for the command.
+            vm_file: The name of the .vm file the command came from ('' for the bootstrap code).
+            line: The (1-based) line number of the command in its .vm file (0 for the bootstrap code).
+            function: The VM function the command belongs to.
+            command: The VM command text, such as 'push local 0'.
+        """
+        row = [instruction_index,
+               self._intern(0, self.files, vm_file or ''),
+               line,
+               self._intern(1, self.functions, function or ''),
+               self._intern(2, self.commands, command)]
+
+        # Commands that emit no instructions (labels) are kept as empty rows, since they mark basic block boundaries.
+        self.rows.append(row)
+        self._starts.append(instruction_index)
+
+    def lookup(self, instruction_index):
+        """Return the (vm file, line, function, VM command) tuple for the given instruction index, or None if the
+        index comes before the first recorded row. Of several rows starting at the index, the last one is used."""
+        pos = bisect.bisect_right(self._starts, instruction_index) - 1
+        if pos < 0:
+            return None
+        _, file_id, line, function_id, command_id = self.rows[pos]
+        return self.files[file_id], line, self.functions[function_id], self.commands[command_id]
+
+    def write(self, map_file):
+        """Write the source map to the given file path as JSON."""
+        with open(map_file, 'w') as file:
+            json.dump({'version': self.VERSION,
+                       'files': self.files,
+                       'functions': self.functions,
+                       'commands': self.commands,
+                       'rows': self.rows}, file, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, map_file):
+        """Read a source map previously written by write() and return it."""
+        with open(map_file, 'r') as file:
+            data = json.load(file)
+
+        source_map = cls()
+        source_map.files = data['files']
+        source_map.functions = data['functions']
+        source_map.commands = data['commands']
+        source_map.rows = data['rows']
+        source_map._starts = [row[0] for row in source_map.rows]
+        return source_map
+
+
+def source_map_path(output_file):
+    """Return the path of the side-car source map for the given .asm output file."""
+    if output_file.endswith('.asm'):
+        output_file = output_file[:-len('.asm')]
+    return output_file + '.map.json'
@@ -0,0 +1,203 @@
+"""
+The stack_analysis module works out statically how deep the VM stack gets: the stack depth before every VM command,
+the maximum depth of every function, and the deepest the whole program's stack can get through its call graph. This
+helps to size the stack of a program (it has RAM[256] to RAM[2047] on the Hack platform).
+
+The depths count what the translated code really puts on the stack: the frame each call pushes (as many of the segment
+pointers as the frame layout saves), the words an inline call pushes while it works out the new ARG, and the words the
+shared math routines use above their operands.
+
+Usage:
+    python stack_analysis.py <program>
+"""
+import argparse
+
+import config
+from code_writer_module import CALL_SCRATCH, MATH_ROUTINES, ROUTINE_SCRATCH
+from frame_layout import saved_pointers
+
+# Arithmetic commands that take one value and push one; every other arithmetic command takes two and pushes one.
+UNARY_COMMANDS = {'neg', 'not', 'bool', 'l-not'}
+
+STACK_SIZE = 2048 - 256
+
+
+def stack_effect(command):
+    """Return how many values the given VMCommand leaves on the stack, less how many it takes off."""
+    if command.type == 'C_PUSH':
+        return 1
+    elif command.type in ['C_POP', 'C_IF']:
+        return -1
+    elif command.type == 'C_ARITHMETIC':
+        return 0 if command.arg1 in UNARY_COMMANDS else -1
+    elif command.type == 'C_CALL':
+        return 1 - command.arg2
+    return 0
+
+
+class FunctionStack:
+    """
+    The FunctionStack class holds the stack analysis of one VM function.
+
+    Attributes:
+        name: The name of the function.
+        num_locals: The number of local variables, which are the bottom of the function's stack.
+        max_depth: The most words the function itself has on its stack (locals, and the scratch words of the math
+            routines it calls, included) at any point.
+        callees: The functions it calls, with the depth of its own stack (the arguments included) at each call.
+    """
+
+    def __init__(self, name, num_locals):
+        self.name = name
+        self.num_locals = num_locals
+        self.max_depth = num_locals
+        self.callees = {}
+
+
+def analyze_commands(commands, routines=None):
+    """
+    Compute the stack depth before each of the given VMCommand records, within its function: the number of values
+    above the function's frame, counting its locals. Depths are carried along each basic block and to the labels the
+    block jumps to; a block that can only be reached by a jump back to it (the depth after a goto or return is unknown)
+    takes the depth of its label. Return the list of depths (None where unknown) and a dictionary of FunctionStack
+    records.
+
+    Arguments:
+        commands: The list of VMCommand records of the program.
+        routines: The labels of the shared routines the translated code uses, or None to count every math command as a
+            call of its routine.
+    """
+    depths = []
+    functions = {}
+    label_depths = {}
+    function = None
+    depth = None
+
+    for command in commands:
+        if command.type == 'C_FUNCTION':
+            function = functions.setdefault(command.arg1, FunctionStack(command.arg1, command.arg2))
+            label_depths = {}
+            depth = 0
+        elif command.type == 'C_LABEL':
+            if depth is None:
+                depth = label_depths.get(command.arg1)
+            else:
+                label_depths.setdefault(command.arg1, depth)
+
+        depths.append(depth)
+        if depth is None or function is None:
+            continue
+
+        if command.type == 'C_FUNCTION':
+            depth = command.arg2
+        elif command.type == 'C_CALL':
+            previous = function.callees.get(command.arg1, 0)
+            function.callees[command.arg1] = max(previous, depth)
+            depth += stack_effect(command)
+        elif command.type in ['C_GOTO', 'C_IF']:
+            depth += stack_effect(command)
+            label_depths.setdefault(command.arg1, depth)
+            if command.type == 'C_GOTO':
+                depth = None
+        elif command.type == 'C_RETURN':
+            depth = None
+        else:
+            routine = MATH_ROUTINES.get(command.arg1) if command.type == 'C_ARITHMETIC' else None
+            if routine is not None and (routines is None or routine in routines):
+                function.max_depth = max(function.max_depth, depth - 1 + ROUTINE_SCRATCH[routine])
+            depth += stack_effect(command)
+        if depth is not None:
+            function.max_depth = max(function.max_depth, depth)
+
+    return depths, functions
+
+
+def calls_through_stubs(function_name, hot_functions=None):
+    """
+    Return whether the translator writes the calls in the named function through call stubs, which push only the frame,
+    rather than inline, under the current config.
+
+    Arguments:
+        function_name: The name of the calling function.
+        hot_functions: The functions that a profile has optimized for speed (the rest are optimized for size), or None
+            without a profile.
+    """
+    if hot_functions is not None:
+        return config.SHARE_CALL_STUBS or function_name not in hot_functions
+    return config.SHARE_CALL_STUBS or config.OPTIMIZATION == 'size'
+
+
+def deepest_stack(functions, function_name, frames, hot_functions=None, active=()):
+    """
+    Return the most words of stack the named function can use, with its frame and everything it calls (or None if it
+    can recurse, which makes the depth unbounded).
+
+    Arguments:
+        functions: The dictionary of FunctionStack records of the program, from analyze_commands().
+        function_name: The name of the function.
+        frames: The frame layout the program is translated with, as given to CodeWriter.set_frame_layout().
+        hot_functions: The functions that a profile has optimized for speed, as for calls_through_stubs().
+    """
+    frame_size = 1 + len(saved_pointers(frames, function_name))   # The return address, and the saved pointers.
+    if function_name in active:
+        return None
+    function = functions.get(function_name)
+    if function is None:
+        return frame_size      # A function that isn't part of the program, like an OS one: count only its frame.
+
+    call_scratch = 0 if calls_through_stubs(function_name, hot_functions) else CALL_SCRATCH
+    deepest = function.max_depth
+    for callee, depth_at_call in function.callees.items():
+        callee_depth = deepest_stack(functions, callee, frames, hot_functions, active + (function_name,))
+        if callee_depth is None:
+            return None
+        callee_frame_size = 1 + len(saved_pointers(frames, callee))
+        deepest = max(deepest, depth_at_call + max(callee_depth, callee_frame_size + call_scratch))
+    return frame_size + deepest
+
+
+def analyze_program(program_name):
+    """Parse the named program with main.read_program() and return the dictionary of FunctionStack records of its
+    functions, and the frame layout that main.py translates it with."""
+    import main
+
+    program_files = main.read_program(program_name)
+    functions = analyze_commands([command for _, commands in program_files for command in commands])[1]
+    return functions, main.plan_frames(program_files)
+
+
+def format_report(functions, frames, hot_functions=None):
+    """
+    Return a text table of the maximum stack depth of every function, and of the deepest call chains.
+
+    Arguments:
+        functions: The dictionary of FunctionStack records of the program, from analyze_commands().
+        frames: The frame layout the program is translated with, as given to CodeWriter.set_frame_layout().
+        hot_functions: The functions that a profile has optimized for speed, as for calls_through_stubs().
+    """
+    out = [f"{'locals':>6} {'max depth':>9} {'with calls':>10}  function"]
+    for name, function in sorted(functions.items()):
+        deepest = deepest_stack(functions, name, frames, hot_functions)
+        out.append(f"{function.num_locals:>6} {function.max_depth:>9} "
+                   f"{deepest if deepest is not None else 'recursive':>10}  {name}")
+    out.append("(max depth: words on the function's own stack, locals and math routine scratch included; with calls: "
+               "words of stack used by the function, its frame, and everything it calls)")
+
+    if 'Sys.init' in functions:
+        deepest = deepest_stack(functions, 'Sys.init', frames, hot_functions)
+        if deepest is None:
+            out.append("The program can recurse, so its stack depth has no static bound.")
+        else:
+            out.append(f"The program uses at most {deepest} of its {STACK_SIZE} words of stack.")
+    return '\n'.join(out)
+
+
+# ************************************************************************************************
+# Program begins here:
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Report the maximum stack depth of each VM function.')
+    arg_parser.add_argument('program', help='The .vm file (without extension) or directory under vm_input.')
+    args = arg_parser.parse_args()
+
+    print(format_report(*analyze_program(args.program)))
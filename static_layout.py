@@ -0,0 +1,88 @@
+"""
+The static_layout module plans where the static variables of a whole program go in RAM. Statics are written as
+symbols like File.3 in plain Hack assembly, and the assembler gives each new symbol the next free address from RAM[16],
+with nothing to stop them from running into the stack at RAM[256]. The planner looks at every .vm file of the program
+before any code is written, packs the statics that are actually used densely into RAM[16] to RAM[255] (in order of
+first use, which is the order the assembler would have used), and reports those that don't fit.
+
+With the layout, the translator writes statics as numeric addresses, which also leaves the assembler with far fewer
+symbols to resolve in a large program.
+
+Usage:
+    python static_layout.py <program>
+"""
+import argparse
+import os
+
+STATIC_BASE = 16
+STATIC_LIMIT = 256      # The stack starts here.
+
+
+def static_file_name(vm_file):
+    """Return the name the statics of a .vm file are qualified with: the file name without its extension."""
+    return os.path.basename(vm_file).replace('.vm', '')
+
+
+def plan_static_layout(program_files):
+    """
+    Pack the statics used by a program into RAM[16] to RAM[255], in order of first use. Return a dictionary of the
+    address of each (file name, index), and a list of the (file name, index, line) first uses of the statics that don't
+    fit.
+
+    Arguments:
+        program_files: The (.vm file, list of VMCommand records) of every file of the program, in translation order.
+    """
+    addresses = {}
+    overflows = []
+    overflowed = set()
+    for vm_file, commands in program_files:
+        file_name = static_file_name(vm_file)
+        for command in commands:
+            if command.type not in ['C_PUSH', 'C_POP'] or command.arg1 != 'static':
+                continue
+            static = (file_name, command.arg2)
+            if static in addresses or static in overflowed:
+                continue
+            address = STATIC_BASE + len(addresses)
+            if address < STATIC_LIMIT:
+                addresses[static] = address
+            else:
+                overflowed.add(static)
+                overflows.append(static + (command.line,))
+    return addresses, overflows
+
+
+def overflow_message(file_name, index):
+    """Return the error message for a static that doesn't fit in the static segment."""
+    return (f"'static {index}' of {file_name}.vm does not fit in RAM[{STATIC_BASE}-{STATIC_LIMIT - 1}]: the program "
+            f"uses more than {STATIC_LIMIT - STATIC_BASE} statics.")
+
+
+def analyze_program(program_name):
+    """Parse the named program with main.read_program() and return its static layout and overflows, like
+    plan_static_layout()."""
+    import main
+
+    return plan_static_layout(main.read_program(program_name))
+
+
+def format_report(addresses, overflows):
+    """Return a text table of the address of every static, and a line on how much of the static segment is used."""
+    out = [f"{'address':>7}  static"]
+    for (file_name, index), address in sorted(addresses.items(), key=lambda item: item[1]):
+        out.append(f"{address:>7}  {file_name}.{index}")
+    for file_name, index, line in overflows:
+        out.append(f"{'-':>7}  {file_name}.{index} (line {line}): does not fit")
+    out.append(f"The program uses {len(addresses) + len(overflows)} of its {STATIC_LIMIT - STATIC_BASE} static words.")
+    return '\n'.join(out)
+
+
+# ************************************************************************************************
+# Program begins here:
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Report the RAM address of each static variable of a program.')
+    arg_parser.add_argument('program', help='The .vm file (without extension) or directory under vm_input.')
+    args = arg_parser.parse_args()
+
+    print(format_report(*analyze_program(args.program)))
@@ -0,0 +1,7 @@
+"""
+The tests import the translator's modules, which live at the top of the repository, like its scripts do.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,157 @@
+"""
+Tests that the translated XVM arithmetic, logical, and comparison commands compute what their reference semantics say,
+at every optimization setting: each case is translated, run in the hack_executor, and its result read back from RAM.
+"""
+import itertools
+import random
+
+import pytest
+
+from diff_harness import translate
+from hack_executor import HackExecutor
+
+# The optimization settings to translate with, as the config values of each.
+SETTINGS = {
+    'plain': {},
+    'speed': {'OPTIMIZATION': 'speed'},
+    'size': {'OPTIMIZATION': 'size'},
+    'sp': {'DEFER_SP_UPDATES': True},
+    'speed+sp': {'OPTIMIZATION': 'speed', 'DEFER_SP_UPDATES': True},
+    'size+sp': {'OPTIMIZATION': 'size', 'DEFER_SP_UPDATES': True},
+}
+
+# The results of the cases are popped to RAM[RESULT_BASE] onwards.
+RESULT_BASE = 4000
+
+# The cases of one program, few enough that the plain build fits in ROM.
+CASES_PER_PROGRAM = 200
+
+VALUES = [0, 1, -1, 2, -2, 3, 7, -7, 15, 16, 17, 100, -1000, 16384, 32767, -32767, -32768]
+
+
+def to_signed(value):
+    """Return a value wrapped to a signed 16-bit word."""
+    value &= 0xFFFF
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def divide(x, y):
+    """Return x / y rounded towards zero, and the remainder, which has the sign of x. Dividing by zero gives 0, with x
+    as the remainder."""
+    if y == 0:
+        return 0, x
+    quotient = abs(x) // abs(y) * (-1 if (x < 0) != (y < 0) else 1)
+    return to_signed(quotient), to_signed(x - quotient * y)
+
+
+def shift_right(x, count):
+    """Return x shifted right count bits (an unsigned count), filling with the sign of x."""
+    count &= 0xFFFF
+    return (-1 if x < 0 else 0) if count >= 16 else x >> count
+
+
+def to_boolean(value):
+    """Return the VM Boolean of a truth value: -1 for true, 0 for false."""
+    return -1 if value else 0
+
+
+# The reference semantics of each command, as a function of its operands.
+REFERENCE = {
+    'mult': lambda x, y: to_signed(x * y),
+    'div': lambda x, y: divide(x, y)[0],
+    'mod': lambda x, y: divide(x, y)[1],
+    'shl': lambda x, y: 0 if y & 0xFFFF >= 16 else to_signed(x << (y & 0xFFFF)),
+    'shr': shift_right,
+    'bool': lambda x: to_boolean(x),
+    'l-not': lambda x: to_boolean(not x),
+    'l-and': lambda x, y: to_boolean(x and y),
+    'l-or': lambda x, y: to_boolean(x or y),
+    'l-xor': lambda x, y: to_boolean(bool(x) != bool(y)),
+    'eq': lambda x, y: to_boolean(x == y),
+    'ne': lambda x, y: to_boolean(x != y),
+    'gt': lambda x, y: to_boolean(x > y),
+    'lt': lambda x, y: to_boolean(x < y),
+    'ge': lambda x, y: to_boolean(x >= y),
+    'le': lambda x, y: to_boolean(x <= y),
+}
+
+UNARY_COMMANDS = ['bool', 'l-not']
+
+
+def push(value):
+    """Return the VM commands that push a signed value."""
+    if value >= 0:
+        return [f'push constant {value}']
+    elif value == -32768:
+        return ['push constant 32767', 'neg', 'push constant 1', 'sub']
+    return [f'push constant {-value}', 'neg']
+
+
+def case_commands(command, operands, constant):
+    """Return the VM commands of one case. With constant, a non-negative last operand is pushed as a constant, which
+    the optimized templates can fold into the command; otherwise it is pushed from a temp."""
+    commands = [line for operand in operands[:-1] for line in push(operand)]
+    if constant and operands[-1] >= 0:
+        commands += push(operands[-1])
+    else:
+        commands += push(operands[-1]) + ['pop temp 0', 'push temp 0']
+    return commands + [command]
+
+
+def run_cases(tmp_path, setting, cases):
+    """Translate and run a program of (command, operands, constant) cases at the given setting. Return the signed
+    result of each case."""
+    results = []
+    for chunk_idx in range(0, len(cases), CASES_PER_PROGRAM):
+        chunk = cases[chunk_idx:chunk_idx + CASES_PER_PROGRAM]
+        lines = ['function Main.main 0']
+        for case_idx, (command, operands, constant) in enumerate(chunk):
+            lines += case_commands(command, operands, constant) + [f'pop ram {RESULT_BASE + case_idx}']
+        lines += ['label END', 'goto END']
+
+        program_dir = tmp_path / f'{setting}{chunk_idx}'
+        program_dir.mkdir()
+        (program_dir / 'Main.vm').write_text('\n'.join(lines) + '\n')
+        asm_lines, _ = translate(str(program_dir), str(tmp_path / f'{setting}{chunk_idx}.asm'), SETTINGS[setting])
+
+        executor = HackExecutor.from_asm(asm_lines)
+        assert executor.run(max_cycles=5_000_000)
+        results += [executor.peek(RESULT_BASE + case_idx) for case_idx in range(len(chunk))]
+    return results
+
+
+def check_cases(tmp_path, setting, cases):
+    """Assert that every case gives the result of its reference semantics."""
+    results = run_cases(tmp_path, setting, cases)
+    wrong = [(command, operands, result, REFERENCE[command](*operands))
+             for (command, operands, _), result in zip(cases, results)
+             if result != REFERENCE[command](*operands)]
+    assert not wrong, f'{len(wrong)} wrong results, like (command, operands, result, expected) {wrong[:5]}'
+
+
+@pytest.mark.parametrize('setting', SETTINGS)
+def test_math_commands(tmp_path, setting):
+    rng = random.Random(1)
+    cases = [(command, (x, y), constant) for command in ['mult', 'div', 'mod', 'shl', 'shr']
+             for x, y in itertools.product(VALUES, VALUES + [4, 8, 1024]) for constant in [False, True]]
+    cases += [(command, (rng.randint(-32768, 32767), rng.randint(-32768, 32767)), False)
+              for command in ['mult', 'div', 'mod'] for _ in range(50)]
+    check_cases(tmp_path, setting, cases)
+
+
+@pytest.mark.parametrize('setting', SETTINGS)
+def test_logical_commands(tmp_path, setting):
+    values = [0, 1, -1, 42, 256, 32767, -32768]
+    cases = [(command, (x,), False) for command in UNARY_COMMANDS for x in values]
+    cases += [(command, (x, y), constant) for command in ['l-and', 'l-or', 'l-xor']
+              for x, y in itertools.product(values, values) for constant in [False, True]]
+    check_cases(tmp_path, setting, cases)
+
+
+@pytest.mark.parametrize('setting', SETTINGS)
+def test_comparison_commands(tmp_path, setting):
+    # Comparisons test the sign of x - y, like the standard VM translation, so they only hold where it fits in a word.
+    values = [0, 1, -1, 2, 100, -100, 16384, -16384, 32767, -32767, -32768]
+    cases = [(command, (x, y), constant) for command in ['eq', 'ne', 'gt', 'lt', 'ge', 'le']
+             for x, y in itertools.product(values, values) if -32768 <= x - y <= 32767 for constant in [False, True]]
+    check_cases(tmp_path, setting, cases)
@@ -0,0 +1,58 @@
+"""
+Tests that the batch builder's cache of translated files never changes what a program does: programs that share files
+are built in one worker, so the later ones reuse the cached translations, and every .asm file is then run.
+"""
+import pytest
+
+import batch_build
+import main
+from hack_executor import HackExecutor
+
+SYS_VM = """function Sys.init 0
+call A.a 0
+pop temp 0
+call B.b 0
+pop ram 4000
+label END
+goto END
+"""
+
+# B.vm is the same in both programs; only one of the A.vm files uses mult, so B's mult writes __VM_MULT in one program
+# and jumps to it in the other.
+B_VM = 'function B.b 0\npush constant 3\npush constant 3\nmult\nreturn\n'
+A_VMS = {
+    'Multiplies': 'function A.a 0\npush constant 2\npush constant 5\nmult\nreturn\n',
+    'Adds': 'function A.a 0\npush constant 2\npush constant 5\nadd\nreturn\n',
+}
+
+
+def write_program(tmp_path, name, padding=''):
+    """Write one of the programs, with the given padding at the end of its A.vm, and return its directory."""
+    program_dir = tmp_path / 'programs' / name
+    program_dir.mkdir(parents=True)
+    (program_dir / 'Sys.vm').write_text(SYS_VM)
+    (program_dir / 'A.vm').write_text(A_VMS[name] + padding)
+    (program_dir / 'B.vm').write_text(B_VM)
+    return str(program_dir)
+
+
+@pytest.mark.parametrize('order', [['Multiplies', 'Adds'], ['Adds', 'Multiplies']])
+@pytest.mark.parametrize('optimization', [None, 'speed'])
+def test_programs_sharing_a_file(tmp_path, monkeypatch, order, optimization):
+    monkeypatch.setattr(main, 'PROGRAM_DIR', str(tmp_path))
+    monkeypatch.setattr(batch_build, 'BUILD_CACHE', batch_build.BuildCache())
+    (tmp_path / 'asm_output').mkdir()
+
+    # The largest program is built first, so pad the A.vm of the one to build first.
+    programs = [write_program(tmp_path, order[0], '// padding\n'), write_program(tmp_path, order[1])]
+    summaries = batch_build.build_programs(programs, {'OPTIMIZATION': optimization}, workers=1)
+    assert [summary['program'] for summary in summaries] == order
+    assert sum(summary['cached_translations'] for summary in summaries) > 0
+
+    for summary in summaries:
+        with open(summary['output']) as asm_file:
+            labels = [line.strip() for line in asm_file if line.startswith('(')]
+        assert len(labels) == len(set(labels)), f"{summary['program']} defines a label twice"
+        executor = HackExecutor.from_asm_file(summary['output'])
+        assert executor.run(max_cycles=100_000), f"{summary['program']} does not halt"
+        assert executor.peek(4000) == 9
@@ -0,0 +1,32 @@
+"""
+Smoke tests of the differential harness: every program under vm_input, and a few random programs, must behave the same
+at every optimization setting as the plain build.
+"""
+import pytest
+
+from diff_harness import check_program, vm_input_programs
+from vm_generator import VMProgramGenerator
+
+MAX_CYCLES = 2_000_000
+
+PROGRAMS = vm_input_programs()
+
+
+def check(name, input_path, work_dir):
+    """Assert that every build of a program matches the plain build."""
+    results = check_program(name, input_path, str(work_dir), MAX_CYCLES)
+    assert results, f'the plain build of {name} does not fit in ROM'
+    mismatches = {setting: differences[:5] for setting, _, differences in results if differences}
+    assert not mismatches
+
+
+@pytest.mark.parametrize('name, input_path', PROGRAMS, ids=[name for name, _ in PROGRAMS])
+def test_vm_input_program(tmp_path, name, input_path):
+    check(name, input_path, tmp_path)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_random_program(tmp_path, seed):
+    program_dir = tmp_path / f'random{seed}'
+    VMProgramGenerator(seed).write(str(program_dir))
+    check(f'random{seed}', str(program_dir), tmp_path)
@@ -0,0 +1,23 @@
+"""
+Tests that the fast checker rejects malformed commands, as the parser does.
+"""
+import pytest
+
+from error_checker import lint_vm_file
+
+
+@pytest.mark.parametrize('command', ['mult 3', 'div 2', 'mod x', 'shl 2', 'shr 1', 'add 1'])
+def test_arithmetic_command_with_arguments(tmp_path, command):
+    vm_file = tmp_path / 'Main.vm'
+    vm_file.write_text(f'function Main.main 0\npush constant 6\npush constant 3\n{command}\nreturn\n')
+    errors = lint_vm_file(str(vm_file))
+    assert [line for line, _ in errors] == [4]
+    assert 'does not conform to its specified format' in errors[0][1]
+
+
+def test_arithmetic_commands_without_arguments(tmp_path):
+    vm_file = tmp_path / 'Main.vm'
+    vm_file.write_text('function Main.main 0\n' + ''.join(f'push constant 6\npush constant 3\n{command}\npop temp 0\n'
+                                                         for command in ['mult', 'div', 'mod', 'shl', 'shr'])
+                       + 'push constant 0\nreturn\n')
+    assert lint_vm_file(str(vm_file)) == []
@@ -0,0 +1,59 @@
+"""
+Tests that instrumenting a translation leaves nothing behind once it is over, whether the translation succeeds or not.
+"""
+import pytest
+
+import code_writer_module
+import error_checker
+import instrumentation
+import main
+import parser_module
+from diff_harness import translate
+
+OWNERS = [parser_module.Parser, parser_module, error_checker, code_writer_module.CodeWriter]
+
+
+def marked_functions():
+    """Return the current function of every name of the instrumented classes and modules that holds a marked one."""
+    return {(owner, name): function for owner in OWNERS for name, function in vars(owner).items()
+            if callable(function) and hasattr(function, 'instrumented_phase')}
+
+
+def write_program(tmp_path):
+    """Write a small program, and return its directory."""
+    program_dir = tmp_path / 'Program'
+    program_dir.mkdir()
+    (program_dir / 'Main.vm').write_text('function Main.main 1\npush constant 2\npop local 0\nlabel END\ngoto END\n')
+    return program_dir
+
+
+def test_start_and_stop_restore_the_functions(tmp_path):
+    originals = marked_functions()
+    assert originals
+    instrumentation.start(str(tmp_path / 'Program.asm'))
+    assert instrumentation.ACTIVE is not None
+    assert any(vars(owner)[name] is not function for (owner, name), function in originals.items())
+
+    instrumentation.stop(str(tmp_path / 'Program.asm'), 'json')
+    assert instrumentation.ACTIVE is None
+    assert marked_functions() == originals
+
+
+def test_instrumented_translation_restores_the_functions(tmp_path):
+    originals = marked_functions()
+    translate(str(write_program(tmp_path)), str(tmp_path / 'Program.asm'), {'INSTRUMENTATION': 'json'})
+    assert (tmp_path / 'Program.instrumentation.json').exists()
+    assert instrumentation.ACTIVE is None
+    assert marked_functions() == originals
+
+
+def test_failed_translation_restores_the_functions(tmp_path, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError('write failed')
+
+    originals = marked_functions()
+    monkeypatch.setattr(main, 'write_program', fail)
+    with pytest.raises(RuntimeError):
+        translate(str(write_program(tmp_path)), str(tmp_path / 'Program.asm'), {'INSTRUMENTATION': 'json'})
+    assert instrumentation.ACTIVE is None
+    assert marked_functions() == originals
@@ -0,0 +1,89 @@
+"""
+Tests that a profile records the counts of each basic block, and that a build with it picks the templates of each
+block by them without changing what the program does.
+"""
+from diff_harness import translate
+from hack_executor import HackExecutor
+from pgo import PROFILE_VERSION, block_templates, hot_functions, load_profile, write_profile
+
+# Loop.run spends nearly all the cycles in its loop; the blocks before and after the loop, and Once.run, run once.
+SYS_VM = """function Sys.init 0
+call Once.run 0
+pop temp 0
+call Loop.run 0
+pop ram 4000
+label END
+goto END
+"""
+LOOP_VM = """function Loop.run 1
+push constant 100
+pop local 0
+label LOOP
+push local 0
+push constant 3
+mult
+pop temp 1
+push local 0
+push constant 1
+sub
+pop local 0
+push local 0
+if-goto LOOP
+push temp 1
+push constant 1
+add
+return
+"""
+ONCE_VM = 'function Once.run 0\npush constant 6\npush constant 7\nmult\nreturn\n'
+
+
+def record(tmp_path):
+    """Write the program, record its profile, and return the program's directory and the profile's path."""
+    program_dir = tmp_path / 'Program'
+    program_dir.mkdir()
+    (program_dir / 'Sys.vm').write_text(SYS_VM)
+    (program_dir / 'Loop.vm').write_text(LOOP_VM)
+    (program_dir / 'Once.vm').write_text(ONCE_VM)
+
+    plain_file = str(tmp_path / 'Plain.asm')
+    translate(str(program_dir), plain_file, {'WRITE_SOURCE_MAP': True})
+    profile_file = str(tmp_path / 'Program.profile.json')
+    write_profile('Program', plain_file, str(tmp_path / 'Plain.map.json'), profile_file, 100_000)
+    return program_dir, profile_file
+
+
+def test_profile_records_block_counts(tmp_path):
+    _, profile_file = record(tmp_path)
+    profile = load_profile(profile_file)
+    assert profile['version'] == PROFILE_VERSION
+    assert profile['halted']
+
+    loop_blocks = {block['line']: block for block in profile['blocks']['Loop.run']}
+    assert loop_blocks[1]['count'] == 1
+    assert loop_blocks[4]['count'] == 100
+    assert loop_blocks[15]['count'] == 1
+    assert [block['count'] for block in profile['blocks']['Once.run']] == [1]
+
+
+def test_templates_follow_the_hot_blocks(tmp_path):
+    _, profile_file = record(tmp_path)
+    profile = load_profile(profile_file)
+    templates = block_templates(profile)
+    assert templates[('Loop.vm', 4)] == 'speed'
+    assert templates[('Loop.vm', 15)] == 'size'
+    assert templates[('Once.vm', 1)] == 'size'
+    assert hot_functions(profile) == {'Loop.run'}
+
+    # Without block counts, the functions are picked as a whole.
+    del profile['blocks']
+    assert block_templates(profile) is None
+    assert hot_functions(profile) == {'Loop.run'}
+
+
+def test_profiled_build_runs_the_same(tmp_path):
+    program_dir, profile_file = record(tmp_path)
+    asm_lines, _ = translate(str(program_dir), str(tmp_path / 'Program.asm'), {}, profile_file)
+    executor = HackExecutor.from_asm_file(str(tmp_path / 'Program.asm'))
+    assert executor.run(max_cycles=100_000)
+    assert executor.peek(4000) == 4
+    assert asm_lines != open(tmp_path / 'Plain.asm').readlines()
@@ -0,0 +1,273 @@
+"""
+The vm_generator module exports the VMProgramGenerator class.
+
+VMProgramGenerator class: Generates random (but always terminating and deterministic) XVM programs, for fuzzing the
+translator's optimizations with the diff_harness module.
+
+Usage:
+    python vm_generator.py <output directory> [--seed S]
+"""
+import argparse
+import os
+import random
+
+UNARY_COMMANDS = ['neg', 'not', 'bool', 'l-not']
+BINARY_COMMANDS = ['add', 'sub', 'and', 'or', 'eq', 'gt', 'lt', 'le', 'ge', 'ne', 'l-and', 'l-or', 'l-xor',
+                   'mult', 'div', 'mod', 'shl', 'shr']
+COMPARISON_COMMANDS = ['eq', 'gt', 'lt', 'le', 'ge', 'ne']
+
+INTERESTING_CONSTANTS = [0, 1, 2, 3, 7, 8, 15, 16, 255, 256, 1000, 16384, 32767]
+
+# The generated programs keep all of their data in RAM[3000] to RAM[3299].
+THIS_BASES = [3000, 3016, 3032, 3048]
+THAT_BASES = [3064, 3080, 3096, 3112]
+SEGMENT_SIZE = 16
+RAM_DATA = range(3200, 3216)
+RESULTS_BASE = 3280
+NUM_STATICS = 6
+
+
+class VMProgramGenerator:
+    """
+    The VMProgramGenerator class generates a random multi-file XVM program with a Sys.init, several Main functions,
+    and a Util class. It covers every memory segment, every arithmetic and XVM logical command, if/else and counted
+    loops, and call/return with arguments, locals, and bounded recursion.
+
+    Programs always terminate: loops are counted down from small constants by a local that nothing else writes,
+    functions only call functions defined before them (apart from the bounded recursive one), and Sys.init ends in
+    the usual 'label HALT / goto HALT' trap. Only initialized memory is read, so every correct translation leaves the
+    same values in RAM.
+
+    Methods:
+        __init__: Constructs the generator from a random seed.
+        generate: Returns a generated program as a dictionary of file names to VM code.
+        write: Writes a generated program to a directory.
+    """
+
+    def __init__(self, seed=None, num_functions=6, max_statements=10):
+        """Construct the generator.
+
+        Arguments:
+            seed: The random seed; the same seed always generates the same program.
+            num_functions: How many Main functions to generate.
+            max_statements: The most statements in any block of a function body.
+        """
+        self.random = random.Random(seed)
+        self.num_functions = num_functions
+        self.max_statements = max_statements
+        self.functions = []     # The (name, number of arguments) of every function callable so far.
+        self.label_idx = 0
+        self.lines = []
+
+    def generate(self):
+        """Generate a program and return it as a dictionary mapping file names to VM code."""
+        files = {'Util.vm': self.generate_util(), 'Main.vm': self.generate_main()}
+        files['Sys.vm'] = self.generate_sys()
+        return files
+
+    def write(self, directory):
+        """Generate a program and write its files into the given directory, which is created if needed."""
+        os.makedirs(directory, exist_ok=True)
+        for file_name, code in self.generate().items():
+            with open(os.path.join(directory, file_name), 'w') as file:
+                file.write(code)
+
+    # ************************************************************************************
+    # **** Files *****
+
+    def generate_util(self):
+        """Generate the Util class: a bounded recursive function and a function with its own statics."""
+        self.lines = [
+            '// Sums n + (n-1) + ... + 1 recursively.',
+            'function Util.sum 0',
+            'push argument 0',
+            'if-goto RECURSE',
+            'push constant 0',
+            'return',
+            'label RECURSE',
+            'push argument 0',
+            'push constant 1',
+            'sub',
+            'call Util.sum 1',
+            'push argument 0',
+            'add',
+            'return',
+        ]
+        self.functions.append(('Util.sum', 1))
+        self.generate_function('Util.mix', self.random.randint(1, 3), self.random.randint(0, 3))
+        return '\n'.join(self.lines) + '\n'
+
+    def generate_main(self):
+        """Generate the Main class of random functions."""
+        self.lines = []
+        for function_idx in range(self.num_functions):
+            self.generate_function(f'Main.f{function_idx}', self.random.randint(0, 3), self.random.randint(0, 12))
+        return '\n'.join(self.lines) + '\n'
+
+    def generate_sys(self):
+        """Generate Sys.init, which sets up the pointers, calls every function, and stores their results."""
+        self.lines = [
+            'function Sys.init 0',
+            f'push constant {THIS_BASES[0]}',
+            'pop pointer 0',
+            f'push constant {THAT_BASES[0]}',
+            'pop pointer 1',
+            f'push constant {self.random.randint(0, 6)}',
+            'call Util.sum 1',
+            f'pop ram {RESULTS_BASE}',
+        ]
+        for result_idx, (name, num_args) in enumerate(self.functions[1:], 1):
+            for _ in range(num_args):
+                self.push_value(0, 0)
+            self.lines.append(f'call {name} {num_args}')
+            self.lines.append(f'pop ram {RESULTS_BASE + result_idx}')
+        self.lines += ['label HALT', 'goto HALT']
+        return '\n'.join(self.lines) + '\n'
+
+    # ************************************************************************************
+    # **** Functions and statements *****
+
+    def generate_function(self, name, num_args, num_locals):
+        """Generate one function, and make it callable by the functions generated after it."""
+        self.lines.append(f'function {name} {num_locals}')
+        # Reserve the last local as a loop counter that nothing else writes.
+        loop_counter = num_locals - 1 if num_locals else None
+        writable_locals = num_locals - 1 if num_locals else 0
+
+        self.generate_block(num_args, writable_locals, loop_counter, depth=0)
+
+        # Return a value, sometimes leaving extra values on the stack, which return discards.
+        for _ in range(self.random.choice([1, 1, 1, 2])):
+            self.push_value(num_args, num_locals)
+        self.lines.append('return')
+        self.functions.append((name, num_args))
+
+    def generate_block(self, num_args, num_locals, loop_counter, depth):
+        """Generate a stack-neutral block of random statements."""
+        for _ in range(self.random.randint(1, self.max_statements)):
+            choice = self.random.random()
+            if choice < 0.45:
+                self.push_value(num_args, num_locals)
+                self.pop_value(num_args, num_locals)
+            elif choice < 0.55:
+                self.lines.append(f'push constant {self.random.choice(THIS_BASES + THAT_BASES)}')
+                self.lines.append(f'pop pointer {self.random.randint(0, 1)}')
+            elif choice < 0.65:
+                self.push_value(num_args, num_locals)
+                self.lines.append('pop constant 0')
+            elif choice < 0.8 and depth < 2:
+                self.generate_if(num_args, num_locals, loop_counter, depth)
+            elif choice < 0.9 and depth < 1 and loop_counter is not None:
+                self.generate_loop(num_args, num_locals, loop_counter, depth)
+            else:
+                self.push_value(num_args, num_locals)
+                self.lines.append(f'pop temp {self.random.randint(0, 7)}')
+
+    def generate_if(self, num_args, num_locals, loop_counter, depth):
+        """Generate an if/else statement."""
+        true_label, end_label = self.new_label(), self.new_label()
+        self.push_condition(num_args, num_locals)
+        self.lines.append(f'if-goto {true_label}')
+        self.generate_block(num_args, num_locals, loop_counter, depth + 1)
+        self.lines.append(f'goto {end_label}')
+        self.lines.append(f'label {true_label}')
+        self.generate_block(num_args, num_locals, loop_counter, depth + 1)
+        self.lines.append(f'label {end_label}')
+
+    def generate_loop(self, num_args, num_locals, loop_counter, depth):
+        """Generate a loop that runs a small, constant number of times."""
+        loop_label, end_label = self.new_label(), self.new_label()
+        self.lines.append(f'push constant {self.random.randint(0, 4)}')
+        self.lines.append(f'pop local {loop_counter}')
+        self.lines.append(f'label {loop_label}')
+        self.lines.append(f'push local {loop_counter}')
+        self.lines.append('push constant 0')
+        self.lines.append('eq')
+        self.lines.append(f'if-goto {end_label}')
+        self.generate_block(num_args, num_locals, loop_counter, depth + 1)
+        self.lines.append(f'push local {loop_counter}')
+        self.lines.append('push constant 1')
+        self.lines.append('sub')
+        self.lines.append(f'pop local {loop_counter}')
+        self.lines.append(f'goto {loop_label}')
+        self.lines.append(f'label {end_label}')
+
+    def new_label(self):
+        """Return a new label name."""
+        self.label_idx += 1
+        return f'L{self.label_idx}'
+
+    # ************************************************************************************
+    # **** Expressions *****
+
+    def push_condition(self, num_args, num_locals):
+        """Push a value to test with if-goto, usually a comparison."""
+        self.push_value(num_args, num_locals)
+        if self.random.random() < 0.7:
+            self.push_value(num_args, num_locals)
+            self.lines.append(self.random.choice(COMPARISON_COMMANDS))
+
+    def push_value(self, num_args, num_locals, depth=0):
+        """Push one random expression's value onto the stack."""
+        choice = self.random.random()
+        if depth < 3 and choice < 0.25:
+            self.push_value(num_args, num_locals, depth + 1)
+            self.push_value(num_args, num_locals, depth + 1)
+            self.lines.append(self.random.choice(BINARY_COMMANDS))
+        elif depth < 3 and choice < 0.35:
+            self.push_value(num_args, num_locals, depth + 1)
+            self.lines.append(self.random.choice(UNARY_COMMANDS))
+        elif depth < 2 and choice < 0.42 and self.functions:
+            name, callee_args = self.random.choice(self.functions)
+            if name == 'Util.sum':
+                self.lines.append(f'push constant {self.random.randint(0, 5)}')
+            else:
+                for _ in range(callee_args):
+                    self.push_value(num_args, num_locals, depth + 1)
+            self.lines.append(f'call {name} {callee_args}')
+        else:
+            self.lines.append('push ' + self.random_location(num_args, num_locals, readable=True))
+
+    def pop_value(self, num_args, num_locals):
+        """Pop the top of the stack into a random writable location."""
+        self.lines.append('pop ' + self.random_location(num_args, num_locals, readable=False))
+
+    def random_location(self, num_args, num_locals, readable):
+        """Return a random '<segment> <index>' to push from (if readable) or pop to."""
+        segments = ['this', 'that', 'temp', 'static', 'ram']
+        if readable:
+            segments += ['constant', 'constant', 'constant', 'pointer']
+        if num_args:
+            segments.append('argument')
+        if num_locals:
+            segments.append('local')
+
+        segment = self.random.choice(segments)
+        if segment == 'constant':
+            return f'constant {self.random.choice(INTERESTING_CONSTANTS + [self.random.randint(0, 32767)])}'
+        elif segment == 'argument':
+            return f'argument {self.random.randrange(num_args)}'
+        elif segment == 'local':
+            return f'local {self.random.randrange(num_locals)}'
+        elif segment in ['this', 'that']:
+            return f'{segment} {self.random.randrange(SEGMENT_SIZE)}'
+        elif segment == 'temp':
+            return f'temp {self.random.randint(0, 7)}'
+        elif segment == 'static':
+            return f'static {self.random.randrange(NUM_STATICS)}'
+        elif segment == 'pointer':
+            return f'pointer {self.random.randint(0, 1)}'
+        else:
+            return f'ram {self.random.choice(RAM_DATA)}'
+
+
+# ************************************************************************************************
+# Program begins here:
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Generate a random XVM program.')
+    arg_parser.add_argument('directory', help='The directory to write the program\'s .vm files to.')
+    arg_parser.add_argument('--seed', type=int, help='The random seed.')
+    args = arg_parser.parse_args()
+
+    VMProgramGenerator(args.seed).write(args.directory)